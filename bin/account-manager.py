@@ -3,8 +3,9 @@
 """Manage accounts in an AWS Organization.
 
 Usage:
-  account-manager.py report [-d] [--boto-log]
-  account-manager.py create (--spec-file FILE) [--exec] [-vd] [--boto-log]
+  account-manager.py report [--format FMT] [-d] [--boto-log] [--save-snapshot FILE | --from-snapshot FILE] [--profile] [--profile-out FILE]
+  account-manager.py create (--spec-file FILE)... [--exec] [--full] [--max-in-flight N] [-vd] [--boto-log] [--save-snapshot FILE] [--profile] [--profile-out FILE]
+  account-manager.py create (--spec-file FILE)... (--from-snapshot FILE) [-vd] [--profile] [--profile-out FILE]
   account-manager.py (-h | --help)
   account-manager.py --version
 
@@ -15,125 +16,388 @@ Modes of operation:
 Options:
   -h, --help                 Show this help message and exit.
   --version                  Display version info and exit.
-  -s FILE, --spec-file FILE  AWS account specification file in yaml format.
+  -s FILE, --spec-file FILE  AWS account specification file in yaml format, or
+                             a directory of yaml fragments merged into one spec.
+                             Repeat to create the accounts of several specs
+                             in one run.
   --exec                     Execute proposed changes to AWS accounts.
+  --full                     Start over, discarding the journal of an
+                             interrupted --exec run instead of resuming it.
+  --format FMT               Report output format: text, json, csv or ndjson.
+                             [default: text]
+  --max-in-flight N          Max number of account creation requests pending
+                             at once. [default: 5]
   -v, --verbose              Log to activity to STDOUT at log level INFO.
   -d, --debug                Increase log level to 'DEBUG'. Implies '--verbose'.
   --boto-log                 Include botocore and boto3 logs in log stream.
+  --save-snapshot FILE       Save deployed Organization state to FILE.
+  --from-snapshot FILE       Read deployed Organization state from a saved
+                             snapshot FILE instead of AWS.  Makes no API calls.
+  --profile                  Print API call statistics and phase timings to
+                             STDERR at exit.
+  --profile-out FILE         Write API call statistics and phase timings to
+                             FILE in json format.
 
 """
 
-import boto3
+from apistats import ApiProfile, report_profile
+import atexit
 from docopt import docopt
+import random
 import time
+from incremental import spec_digest
+from inventory import get_org_snapshot
+from journal import Journal, journal_file, latest
+from orgclient import error_code, get_org_client
+from report import account_report, write_report
+from snapshot import save_snapshot
 from utils import *
 
-def scan_created_accounts(log, org_client):
+# account creation status polling (seconds)
+POLL_INITIAL_DELAY = 5
+POLL_MAX_DELAY = 60
+POLL_TIMEOUT = 1800
+
+def scan_create_account_status(log, org_client, states):
     """
-    Query AWS Organization for accounts with creation status of 'SUCCEEDED'.
-    Returns a list of dictionary.
+    Query AWS Organization for account creation requests in any of
+    'states'.  Returns a list of dictionary.
     """
     log.debug('running')
-    status = org_client.list_create_account_status(States=['SUCCEEDED'])
-    created_accounts = status['CreateAccountStatuses']
+    status = org_client.list_create_account_status(States=states)
+    create_statuses = status['CreateAccountStatuses']
     while 'NextToken' in status and status['NextToken']:
         log.debug("NextToken: %s" % status['NextToken'])
         status = org_client.list_create_account_status(
-                States=['SUCCEEDED'],
+                States=states,
                 NextToken=status['NextToken'])
-        created_accounts += status['CreateAccountStatuses']
+        create_statuses += status['CreateAccountStatuses']
+    return create_statuses
+
+def scan_created_accounts(log, org_client):
+    """
+    Query AWS Organization for accounts with creation status of
+    'SUCCEEDED' or 'IN_PROGRESS'.  Returns a dictionary of creation
+    status keyed by account name.  In progress requests take precedence.
+    """
+    created_accounts = {}
+    for status in scan_create_account_status(log, org_client,
+            ['SUCCEEDED', 'IN_PROGRESS']):
+        name = status.get('AccountName')
+        if name not in created_accounts or status['State'] == 'IN_PROGRESS':
+            created_accounts[name] = status
     return created_accounts
 
-def display_provisioned_accounts(log, deployed_accounts):
+def account_email(a_spec, account_spec):
+    """
+    Return the email address to use when creating account 'a_spec'.
+    """
+    if 'Email' in a_spec and a_spec['Email']:
+        return a_spec['Email']
+    return '%s@%s' % (a_spec['Name'], account_spec['default_domain'])
+
+def combine_account_specs(log, specs):
+    """
+    Combine list of (spec_file, account_spec) into one account spec.
+    Account emails are resolved against the default_domain of their own
+    spec.  An account listed in several specs must be identical in all
+    of them, and no two accounts may share an email address.  Exit on
+    any conflict.
+    """
+    if len(specs) == 1:
+        return specs[0][1]
+    conflicts = []
+    first_file, first_spec = specs[0]
+    accounts = {}
+    sources = {}
+    emails = {}
+    teams = {}
+    for spec_file, spec in specs:
+        if spec['master_account_id'] != first_spec['master_account_id']:
+            conflicts.append("%s: master_account_id '%s' differs from '%s' "
+                    "in %s" % (spec_file, spec['master_account_id'],
+                    first_spec['master_account_id'], first_file))
+        for team in spec.get('teams') or []:
+            teams.setdefault(team['Name'], team)
+        for a_spec in spec.get('accounts') or []:
+            account = dict(a_spec, Email=account_email(a_spec, spec))
+            name = account['Name']
+            if name in accounts:
+                if accounts[name] != account:
+                    conflicts.append("%s: account '%s' differs from its "
+                            "definition in %s" % (spec_file, name,
+                            sources[name]))
+                continue
+            if account['Email'] in emails:
+                conflicts.append("%s: account '%s' uses email '%s' of "
+                        "account '%s'" % (spec_file, name, account['Email'],
+                        emails[account['Email']]))
+                continue
+            accounts[name] = account
+            sources[name] = spec_file
+            emails[account['Email']] = name
+    exit_on_conflicts(log, conflicts)
+    log.info("Combined %d accounts from %d spec files" % (len(accounts),
+            len(specs)))
+    return dict(
+        master_account_id = first_spec['master_account_id'],
+        default_domain = first_spec['default_domain'],
+        teams = list(teams.values()),
+        accounts = [accounts[name] for name in sorted(accounts)],
+    )
+
+def poll_delay(attempt):
+    """
+    Return seconds to wait before status poll number 'attempt'.
+    Exponential backoff with jitter, capped at POLL_MAX_DELAY.
+    """
+    delay = min(POLL_MAX_DELAY, POLL_INITIAL_DELAY * (2 ** attempt))
+    return random.uniform(delay / 2.0, delay)
+
+def poll_create_account_requests(log, org_client, pending):
+    """
+    Poll all pending account creation requests in one pass.  A single
+    listing of in progress requests tells which of 'pending' have
+    finished.  Only those are described individually.  Returns a list
+    of final CreateAccountStatus dictionaries.
+    """
+    in_progress = set(s['Id'] for s in scan_create_account_status(
+            log, org_client, ['IN_PROGRESS']))
+    finished = []
+    for request_id in list(pending):
+        if request_id in in_progress:
+            continue
+        creation = org_client.describe_create_account_status(
+                CreateAccountRequestId=request_id)['CreateAccountStatus']
+        if creation['State'] != 'IN_PROGRESS':
+            finished.append(creation)
+    return finished
+
+def submit_create_account(log, org_client, result, email_addr, journal):
     """
-    Print report of currently deployed accounts in AWS Organization.
+    Submit one account creation request.  Update 'result' with the
+    request Id and state.  The request is journaled before it is sent,
+    so a rerun knows it may exist even if this run dies waiting for it.
     """
-    header = "Provisioned Accounts in Org:"
-    overbar = '_' * len(header)
-    log.info("\n%s\n%s" % (overbar, header))
-    for a_name in sorted([a['Name'] for a in deployed_accounts]):
-        a_id = lookup(deployed_accounts, 'Name', a_name, 'Id')
-        a_email = lookup(deployed_accounts, 'Name', a_name, 'Email')
-        spacer = ' ' * (24 - len(a_name))
-        log.info("%s%s%s\t\t%s" % (a_name, spacer, a_id, a_email))
+    log.info("Creating account '%s'" % (result['Name']))
+    log.debug('account email: %s' % email_addr)
+    journal.append('create_account', name=result['Name'], status='submitting')
+    try:
+        creation = org_client.create_account(
+                AccountName=result['Name'], Email=email_addr
+                )['CreateAccountStatus']
+    except Exception as e:
+        if error_code(e) is None:
+            raise
+        log.error("Account creation failed for '%s': %s" % (result['Name'], e))
+        result.update(State='FAILED', Detail=str(e))
+        journal.append('create_account', name=result['Name'], status='FAILED')
+        return
+    log.info("CreateAccountStatus Id: %s" % (creation['Id']))
+    record_creation_status(result, creation)
+    journal_creation_status(journal, result)
 
-def create_accounts(org_client, args, log, deployed_accounts, account_spec):
+def journal_creation_status(journal, result):
+    journal.append('create_account', name=result['Name'],
+            request_id=result['RequestId'], status=result['State'])
+
+def journaled_creations(log, org_client, entries):
+    """
+    Return the creation status of the requests in the journal 'entries'
+    of an interrupted run, keyed by account name, or None if a request
+    may have been sent without its Id being journaled.  Only the
+    journaled requests are described.
     """
-    Compare deployed_accounts to list of accounts in the accounts spec.
-    Create accounts not found in deployed_accounts.
+    creations = latest(entries, 'create_account', 'name')
+    if any(c['status'] == 'submitting' for c in creations.values()):
+        log.info("The interrupted run left account creations unconfirmed")
+        return None
+    found = {}
+    for name, creation in sorted(creations.items()):
+        if creation.get('request_id') and creation['status'] != 'FAILED':
+            found[name] = org_client.describe_create_account_status(
+                    CreateAccountRequestId=creation['request_id']
+                    )['CreateAccountStatus']
+    log.info("Resuming %d account creations of the interrupted run" %
+            len(found))
+    return found
+
+def record_creation_status(result, creation):
     """
+    Copy CreateAccountStatus 'creation' into summary row 'result'.
+    """
+    result['RequestId'] = creation['Id']
+    result['State'] = creation['State']
+    if creation['State'] == 'SUCCEEDED':
+        result['Detail'] = creation.get('AccountId', '')
+    elif creation['State'] == 'FAILED':
+        result['Detail'] = creation.get('FailureReason', '')
+
+def create_accounts(org_client, args, log, snapshot, account_spec,
+        journal=None, interrupted=None):
+    """
+    Compare deployed accounts to list of accounts in the accounts spec.
+    Create accounts not found in the deployed organization.  Requests are
+    submitted up to '--max-in-flight' at a time and all pending requests
+    are polled together.  Submission stops when no request finished for
+    POLL_TIMEOUT seconds: requests still in flight are reported PENDING
+    and accounts never requested NOT_SUBMITTED.  With --exec every
+    request is recorded in 'journal'.  When resuming the 'interrupted'
+    run journaled there, its requests are checked by Id instead of
+    listing all creation requests.  Returns list of summary rows.
+    """
+    max_in_flight = int(args['--max-in-flight'])
+    created_accounts = None
+    if interrupted:
+        created_accounts = journaled_creations(log, org_client, interrupted)
+    if created_accounts is None:
+        created_accounts = scan_created_accounts(log, org_client)
+    results = []
+    queue = []
+    pending = {}
     for a_spec in account_spec['accounts']:
-        if not lookup(deployed_accounts, 'Name', a_spec['Name'],):
-            # check if it is still being provisioned
-            created_accounts = scan_created_accounts(log, org_client)
-            if lookup(created_accounts, 'AccountName', a_spec['Name']):
-                log.warn("New account '%s' is not yet available" %
-                        a_spec['Name'])
-                break
-            # create a new account
-            if 'Email' in a_spec and a_spec['Email']:
-                email_addr = a_spec['Email']
-            else:
-                email_addr = '%s@%s' % (a_spec['Name'], account_spec['default_domain'])
+        if a_spec['Name'] in snapshot.accounts:
+            continue
+        result = dict(Name=a_spec['Name'], State='PLANNED', RequestId='', Detail='')
+        results.append(result)
+        # check if it is still being provisioned
+        creation = created_accounts.get(a_spec['Name'])
+        if creation:
+            log.warn("New account '%s' is not yet available" % a_spec['Name'])
+            record_creation_status(result, creation)
+            if creation['State'] == 'IN_PROGRESS':
+                pending[creation['Id']] = result
+            continue
+        if args['--exec']:
+            queue.append((result, account_email(a_spec, account_spec)))
+        else:
             log.info("Creating account '%s'" % (a_spec['Name']))
-            log.debug('account email: %s' % email_addr)
-            if args['--exec']:
-                new_account = org_client.create_account(
-                        AccountName=a_spec['Name'], Email=email_addr)
-                create_id = new_account['CreateAccountStatus']['Id']
-                log.info("CreateAccountStatus Id: %s" % (create_id))
-                # validate creation status
-                counter = 0
-                maxtries = 5
-                while counter < maxtries:
-                    creation = org_client.describe_create_account_status(
-                            CreateAccountRequestId=create_id
-                            )['CreateAccountStatus']
-                    if creation['State'] == 'IN_PROGRESS':
-                        time.sleep(5)
-                        log.info("Account creation in progress for '%s'" %
-                                a_spec['Name'])
-                    elif creation['State'] == 'SUCCEEDED':
-                        log.info("Account creation succeeded")
-                        break
-                    elif creation['State'] == 'FAILED':
-                        log.error("Account creation failed: %s" %
-                                creation['FailureReason'])
-                        break
-                    counter += 1
-                if counter == maxtries and creation['State'] == 'IN_PROGRESS':
-                     log.warn("Account creation still pending. Moving on!")
-
-def unmanaged_accounts(log, deployed_accounts, account_spec):
+            log.debug('account email: %s' % account_email(a_spec, account_spec))
+    if not args['--exec']:
+        return results
+    for result in pending.values():
+        journal_creation_status(journal, result)
+    # pipeline: keep up to max_in_flight requests pending, poll them together
+    deadline = time.time() + POLL_TIMEOUT
+    attempt = 0
+    while queue or pending:
+        while queue and len(pending) < max_in_flight:
+            result, email_addr = queue.pop(0)
+            submit_create_account(log, org_client, result, email_addr,
+                    journal)
+            if result['State'] == 'IN_PROGRESS':
+                pending[result['RequestId']] = result
+        if not pending:
+            continue
+        if time.time() > deadline:
+            log.warn("No account creation finished in %d seconds. Moving on!"
+                    % POLL_TIMEOUT)
+            break
+        time.sleep(poll_delay(attempt))
+        attempt += 1
+        finished = poll_create_account_requests(log, org_client, pending)
+        for creation in finished:
+            result = pending.pop(creation['Id'])
+            record_creation_status(result, creation)
+            journal_creation_status(journal, result)
+            if creation['State'] == 'SUCCEEDED':
+                log.info("Account creation succeeded for '%s'" % result['Name'])
+            else:
+                log.error("Account creation failed for '%s': %s" %
+                        (result['Name'], result['Detail']))
+        if finished:
+            # slots were freed: go back to short poll intervals
+            attempt = 0
+            deadline = time.time() + POLL_TIMEOUT
+        else:
+            log.info("Account creation in progress for: %s" %
+                    ', '.join(sorted(r['Name'] for r in pending.values())))
+    for result in results:
+        if result['State'] == 'IN_PROGRESS':
+            result['State'] = 'PENDING'
+    for result, email_addr in queue:
+        result['State'] = 'NOT_SUBMITTED'
+    return results
+
+def display_creation_summary(results):
+    """
+    Print one table summarizing the state of all account creations.
+    """
+    if not results:
+        return
+    header = "Account creation summary:"
+    sys.stdout.write("\n%s\n%s\n" % ('_' * len(header), header))
+    for result in sorted(results, key=lambda r: (r['State'], r['Name'])):
+        spacer = ' ' * (24 - len(result['Name']))
+        row = "%s%s%-12s%-24s%s" % (result['Name'], spacer,
+                result['State'], result['RequestId'], result['Detail'])
+        sys.stdout.write(row.rstrip() + '\n')
+
+def unmanaged_accounts(log, snapshot, account_spec):
     # compare accounts that in spec file which that are created under root.
-    deployed_account_names = [a['Name'] for a in deployed_accounts]
-    spec_account_names = [a['Name'] for a in account_spec['accounts']]
+    deployed_account_names = snapshot.accounts.names()
+    spec_account_names = set(a['Name'] for a in account_spec['accounts'])
     log.debug('deployed_account_names: %s' % deployed_account_names)
-    log.debug('spec_account_names: %s' % spec_account_names)
+    log.debug('spec_account_names: %s' % sorted(spec_account_names))
     return [a for a in deployed_account_names if a not in spec_account_names]
 
 def main():
     args = docopt(__doc__, version='1.0')
     log = get_logger(args, os.path.basename(__file__).split('.')[0])
 
+    profile = ApiProfile()
+    if args['--profile'] or args['--profile-out']:
+        atexit.register(report_profile, args, profile)
+
+    # invalid specs fail before any client is created
+    if args['--spec-file']:
+        profile.phase('validation')
+        account_spec = combine_account_specs(log, validate_spec_files(log,
+                args['--spec-file'], 'account_spec'))
+
     #create the client
-    org_client = boto3.client('organizations')
-    root_id = get_root_org_id(org_client)
-    deployed_accounts = get_deployed_accounts(log, org_client)
+    profile.phase('inventory')
+    org_client = get_org_client(log, args['--from-snapshot'], CRAWL_WORKERS,
+            profile=profile)
+    snapshot = get_org_snapshot(log, org_client,
+            accounts_only=not args['--save-snapshot'])
+    if args['--save-snapshot']:
+        save_snapshot(log, org_client, snapshot, args['--save-snapshot'])
 
     if args['--spec-file']:
-        account_spec = validate_spec_file(log, args['--spec-file'], 'account_spec')
-        validate_master_id(org_client, account_spec)
+        validate_master_id(snapshot.master_account_id, account_spec)
 
 
     if args['report']:
-        display_provisioned_accounts(log, deployed_accounts)
+        profile.phase('report')
+        write_report(sys.stdout, args['--format'], [account_report(snapshot)])
 
     if args['create']:
-        create_accounts(org_client, args, log, deployed_accounts, account_spec)
-        unmanaged = unmanaged_accounts(log, deployed_accounts, account_spec)
+        profile.phase('account creation')
+        journal = interrupted = None
+        if args['--exec']:
+            journal = Journal(log, journal_file(args['--spec-file']))
+            digest = spec_digest(account_spec)
+            if not args['--full']:
+                interrupted = journal.interrupted('create', digest)
+            if interrupted:
+                log.info("Resuming interrupted run from journal '%s'" %
+                        journal.file_name)
+                journal.resume()
+            else:
+                journal.begin('create', digest)
+        results = create_accounts(org_client, args, log, snapshot, account_spec,
+                journal, interrupted)
+        if journal is not None:
+            if any(r['State'] in ('PENDING', 'NOT_SUBMITTED')
+                    for r in results):
+                journal.close()
+            else:
+                journal.end()
+        unmanaged = unmanaged_accounts(log, snapshot, account_spec)
         if unmanaged:
             log.warn("Unmanaged accounts in Org: %s" % (', '.join(unmanaged)))
+        display_creation_summary(results)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""Per-operation API call statistics and phase timing for --profile """
+import json
+import sys
+import threading
+import time
+
+# latency percentiles shown in the profile
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, pct):
+    """
+    Return the 'pct' percentile of sorted list 'values' (nearest rank).
+    """
+    if not values:
+        return 0.0
+    rank = int(round(pct / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(len(values) - 1, rank))]
+
+
+class OperationStats(object):
+    """
+    Counters for one API operation.  'calls' counts logical requests,
+    'pages' every response including follow-up pages, 'retries' repeated
+    attempts and 'throttles' attempts the service throttled.  Latencies
+    of all attempts are kept in seconds.
+    """
+    __slots__ = ('calls', 'pages', 'retries', 'throttles', 'errors',
+            'latencies')
+
+    def __init__(self):
+        self.calls = 0
+        self.pages = 0
+        self.retries = 0
+        self.throttles = 0
+        self.errors = 0
+        self.latencies = []
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        result = dict(calls=self.calls, pages=self.pages,
+                retries=self.retries, throttles=self.throttles,
+                errors=self.errors,
+                max_ms=round(1000 * latencies[-1], 3) if latencies else 0.0)
+        for pct in PERCENTILES:
+            result['p%d_ms' % pct] = round(1000 * percentile(latencies, pct), 3)
+        return result
+
+
+class ApiProfile(object):
+    """
+    Thread safe collector of API call statistics per operation, fed by
+    ThrottledClient, and of wall time per phase of a script run.  Phases
+    are sequential: starting a phase ends the running one.
+    """
+    def __init__(self):
+        self.operations = {}
+        self.phases = []
+        self._phase = None
+        self._started = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, operation, latency, page=False, retry=False,
+            throttled=False, error=False):
+        """
+        Record one attempt of API call 'operation' that took 'latency'
+        seconds.  Set 'page' when the attempt fetched a follow-up page.
+        """
+        with self._lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = OperationStats()
+            stats.latencies.append(latency)
+            if retry:
+                stats.retries += 1
+            elif not page:
+                stats.calls += 1
+            if throttled:
+                stats.throttles += 1
+            elif error:
+                stats.errors += 1
+            else:
+                stats.pages += 1
+                if self._phase is not None:
+                    self._phase['api_calls'] += 1
+
+    def phase(self, name):
+        """
+        Start timing phase 'name'.  Ends the running phase.
+        """
+        self.end_phase()
+        with self._lock:
+            self._phase = dict(name=name, start=time.time(), api_calls=0)
+
+    def end_phase(self):
+        with self._lock:
+            if self._phase is not None:
+                self._phase['seconds'] = time.time() - self._phase.pop('start')
+                self.phases.append(self._phase)
+                self._phase = None
+
+    def summary(self):
+        """
+        Return the profile as a dictionary ready for JSON output.
+        """
+        self.end_phase()
+        with self._lock:
+            operations = dict((op, stats.summary())
+                    for op, stats in self.operations.items())
+        return dict(
+            seconds = round(time.time() - self._started, 3),
+            operations = operations,
+            phases = [dict(name=p['name'], seconds=round(p['seconds'], 3),
+                    api_calls=p['api_calls']) for p in self.phases],
+        )
+
+    def display(self, out):
+        """
+        Write the profile as a compact table to file object 'out'.
+        """
+        summary = self.summary()
+        columns = ['calls', 'pages', 'retries', 'throttles', 'errors'] + [
+                'p%d_ms' % pct for pct in PERCENTILES] + ['max_ms']
+        out.write("\n%-40s%s\n" % ('operation',
+                ''.join('%10s' % c for c in columns)))
+        totals = dict((c, 0) for c in columns[:5])
+        for op, stats in sorted(summary['operations'].items()):
+            out.write("%-40s%s%s\n" % (op,
+                    ''.join('%10d' % stats[c] for c in columns[:5]),
+                    ''.join('%10.1f' % stats[c] for c in columns[5:])))
+            for c in totals:
+                totals[c] += stats[c]
+        out.write("%-40s%s\n" % ('total',
+                ''.join('%10d' % totals[c] for c in columns[:5])))
+        out.write("\n%-40s%10s%10s\n" % ('phase', 'seconds', 'api'))
+        for phase in summary['phases']:
+            out.write("%-40s%10.3f%10d\n" % (phase['name'], phase['seconds'],
+                    phase['api_calls']))
+        out.write("%-40s%10.3f\n" % ('total', summary['seconds']))
+
+    def write(self, file_name):
+        """
+        Write the profile as JSON to 'file_name'.
+        """
+        with open(file_name, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+def report_profile(args, profile):
+    """
+    Output 'profile' as requested by the --profile and --profile-out
+    command line options.
+    """
+    if args.get('--profile'):
+        profile.display(sys.stderr)
+    if args.get('--profile-out'):
+        profile.write(args['--profile-out'])
@@ -0,0 +1,292 @@
+"""asyncio engine for the inventory crawl and plan apply (Python 3 only) """
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from inventory import AttachmentIndex, OrgSnapshot, PolicyStore
+from orgclient import (CONFLICT_ERRORS, MAX_ATTEMPTS, THROTTLE_ERRORS,
+        ThrottledClient, error_code, is_read_operation, retry_delay)
+
+# max API calls in flight at once
+ASYNC_CONCURRENCY = 64
+
+
+class AsyncOrgClient(object):
+    """
+    Coroutine interface to an Organizations client.  At most
+    'concurrency' calls are in flight.  When wrapping a ThrottledClient
+    its token buckets, retry policy and profile are shared.  botocore has
+    no asyncio transport, so boto3 calls run on a pool of 'threads'
+    threads, by default one per call in flight.  Clients offering
+    without_latency(), like the fake backend, have their latency awaited
+    on the event loop.  Any other client, like the snapshot client, is
+    called inline.
+    """
+    def __init__(self, org_client, concurrency=ASYNC_CONCURRENCY, log=None,
+            threads=None):
+        self.concurrency = concurrency
+        self.threads = threads or concurrency
+        self.log = log or logging.getLogger(__name__)
+        self.throttled = None
+        self.profile = None
+        self.max_attempts = MAX_ATTEMPTS
+        self.latency = 0.0
+        self._executor = None
+        self._semaphore = None
+        client = org_client
+        if isinstance(org_client, ThrottledClient):
+            self.throttled = org_client
+            self.profile = org_client.profile
+            self.max_attempts = org_client.max_attempts
+            client = org_client.client
+        if hasattr(client, 'without_latency'):
+            self.latency = client.latency
+            client = client.without_latency()
+        elif self.throttled is not None:
+            self.log.debug("running boto3 calls on %d threads" % self.threads)
+            self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.client = client
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    async def _invoke(self, operation, kwargs):
+        api_call = getattr(self.client, operation)
+        if self._executor is not None:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self._executor,
+                    functools.partial(api_call, **kwargs))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return api_call(**kwargs)
+
+    async def _acquire(self, operation):
+        if self.throttled is None:
+            return None
+        bucket = self.throttled.bucket(operation)
+        while True:
+            wait = bucket.reserve()
+            if not wait:
+                return bucket
+            await asyncio.sleep(wait)
+
+    async def call(self, operation, **kwargs):
+        """
+        Await API 'operation' with the same rate limiting and retries as
+        ThrottledClient.call().
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        retry_conflicts = not is_read_operation(operation)
+        page = bool(kwargs.get('NextToken'))
+        attempt = 0
+        while True:
+            async with self._semaphore:
+                bucket = await self._acquire(operation)
+                start = time.time()
+                try:
+                    response = await self._invoke(operation, kwargs)
+                except Exception as e:
+                    code = error_code(e)
+                    if self.profile is not None:
+                        self.profile.record(operation, time.time() - start,
+                                page=page, retry=attempt > 0,
+                                throttled=code in THROTTLE_ERRORS, error=True)
+                    attempt += 1
+                    if code in THROTTLE_ERRORS and bucket is not None:
+                        bucket.throttled()
+                    elif not (retry_conflicts and code in CONFLICT_ERRORS):
+                        raise
+                    if attempt >= self.max_attempts:
+                        raise
+                else:
+                    if self.profile is not None:
+                        self.profile.record(operation, time.time() - start,
+                                page=page, retry=attempt > 0)
+                    if bucket is not None:
+                        bucket.succeeded()
+                    return response
+            # back off outside the semaphore
+            delay = retry_delay(attempt)
+            self.log.debug("%s: %s, retry %d in %.2fs" %
+                    (operation, code, attempt, delay))
+            await asyncio.sleep(delay)
+
+    async def paginate(self, operation, result_key, **kwargs):
+        """
+        Await all pages of 'operation'.  Return the combined list of items
+        found under 'result_key'.
+        """
+        response = await self.call(operation, **kwargs)
+        items = list(response[result_key])
+        while response.get('NextToken'):
+            response = await self.call(operation,
+                    NextToken=response['NextToken'], **kwargs)
+            items += response[result_key]
+        return items
+
+
+async def get_deployed_ou(aclient, root_id, account_parents=None):
+    """
+    Crawl the OU tree with every parent listed as soon as it is found,
+    not level by level.  Return the same list as utils.get_deployed_ou(),
+    in breadth-first order starting with the root.
+    """
+    root = dict(Name='root', Id=root_id)
+    children = {}
+    async def visit(parent):
+        child_ou, accounts = await asyncio.gather(
+                aclient.paginate('list_organizational_units_for_parent',
+                    'OrganizationalUnits', ParentId=parent['Id']),
+                aclient.paginate('list_accounts_for_parent', 'Accounts',
+                    ParentId=parent['Id']))
+        parent['Child_OU'] = [ou['Name'] for ou in child_ou if 'Name' in ou]
+        parent['Accounts'] = [acc['Name'] for acc in accounts if 'Name' in acc]
+        if account_parents is not None:
+            for acc in accounts:
+                account_parents[acc['Id']] = parent['Id']
+        for ou in child_ou:
+            ou['ParentId'] = parent['Id']
+        children[parent['Id']] = child_ou
+        await asyncio.gather(*[visit(ou) for ou in child_ou])
+    await visit(root)
+    deployed_ou = [root]
+    level = [root]
+    while level:
+        level = [ou for parent in level for ou in children[parent['Id']]]
+        deployed_ou += level
+    return deployed_ou
+
+
+async def get_org_snapshot(log, aclient):
+    """
+    Coroutine version of inventory.get_org_snapshot().  All listings run
+    concurrently.
+    """
+    log.debug('running')
+    roots, organization = await asyncio.gather(
+            aclient.paginate('list_roots', 'Roots'),
+            aclient.call('describe_organization'))
+    if len(roots) > 1:
+        raise RuntimeError("org_client.list_roots returned multiple roots.")
+    root = roots[0]
+    account_parents = {}
+    deployed_ou, accounts, policies = await asyncio.gather(
+            get_deployed_ou(aclient, root['Id'], account_parents),
+            aclient.paginate('list_accounts', 'Accounts'),
+            aclient.paginate('list_policies', 'Policies',
+                Filter='SERVICE_CONTROL_POLICY'))
+    return OrgSnapshot(root, organization['Organization']['MasterAccountId'],
+            accounts=[a for a in accounts if 'Name' in a],
+            ou=deployed_ou,
+            policies=policies,
+            parents=account_parents)
+
+
+async def get_policy_store(aclient, snapshot):
+    """
+    Coroutine version of inventory.get_policy_store().
+    """
+    policy_store = PolicyStore()
+    async def describe(policy_id):
+        response = await aclient.call('describe_policy', PolicyId=policy_id)
+        policy_store.add(policy_id, response['Policy']['Content'])
+    await asyncio.gather(*[describe(p['Id']) for p in snapshot.policies])
+    return policy_store
+
+
+async def get_attachment_index(aclient, snapshot, complete=False):
+    """
+    Coroutine version of inventory.get_attachment_index().  Makes the
+    same choice between querying per policy and per OU.
+    """
+    policy_ids = [p['Id'] for p in snapshot.policies]
+    target_ids = [ou['Id'] for ou in snapshot.ou]
+    by_policy = complete or len(policy_ids) <= len(target_ids)
+    index = AttachmentIndex(complete=by_policy)
+    async def index_policy(policy_id):
+        for target in await aclient.paginate('list_targets_for_policy',
+                'Targets', PolicyId=policy_id):
+            index.add(policy_id, target['TargetId'])
+    async def index_target(target_id):
+        for policy in await aclient.paginate('list_policies_for_target',
+                'Policies', TargetId=target_id,
+                Filter='SERVICE_CONTROL_POLICY'):
+            index.add(policy['Id'], target_id)
+    if by_policy:
+        await asyncio.gather(*[index_policy(p_id) for p_id in policy_ids])
+    else:
+        await asyncio.gather(*[index_target(t_id) for t_id in target_ids])
+    return index
+
+
+async def apply_plan(plan, aclient, log):
+    """
+    Coroutine version of Plan.apply().  Every op is started as soon as
+    its dependencies succeeded.  Returns list of failed ops.
+    """
+    tasks = {}
+    async def run(op):
+        deps_ok = await asyncio.gather(*[tasks[d] for d in op.deps])
+        if not all(deps_ok):
+            log.error("Skipped: %s. A dependency failed" % op.describe())
+            op.finish('SKIPPED', 'a dependency failed')
+            plan.note(op, 'skipped')
+            return False
+        log.info(op.describe())
+        plan.note(op, 'started')
+        try:
+            op.handle(await aclient.call(op.action, **op.params()))
+        except Exception as e:
+            log.error("Failed: %s: %s" % (op.describe(), e))
+            op.finish('FAILED', str(e))
+            plan.note(op, 'failed', detail=op.detail)
+            return False
+        op.record(plan.snapshot)
+        op.finish('APPLIED')
+        plan.note(op, 'done', result=op.result)
+        return True
+    # levels() lists every op after its dependencies
+    for level in plan.levels():
+        for op in level:
+            tasks[op] = asyncio.ensure_future(run(op))
+    await asyncio.gather(*tasks.values())
+    return [op for op in plan.ops if not tasks[op].result()]
+
+
+class AsyncEngine(object):
+    """
+    Synchronous front end used by organization-manager --engine async.
+    Owns the event loop and the AsyncOrgClient.
+    """
+    def __init__(self, org_client, log, concurrency=ASYNC_CONCURRENCY,
+            threads=None):
+        self.log = log
+        self.loop = asyncio.new_event_loop()
+        self.aclient = AsyncOrgClient(org_client, concurrency, log, threads)
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def inventory(self):
+        """
+        Return (snapshot, policy_store, attachment_index) like the
+        threaded path in organization-manager main().
+        """
+        async def crawl():
+            snapshot = await get_org_snapshot(self.log, self.aclient)
+            policy_store, attachment_index = await asyncio.gather(
+                    get_policy_store(self.aclient, snapshot),
+                    get_attachment_index(self.aclient, snapshot))
+            return snapshot, policy_store, attachment_index
+        return self.run(crawl())
+
+    def apply(self, plan):
+        return self.run(apply_plan(plan, self.aclient, self.log))
+
+    def close(self):
+        self.aclient.close()
+        self.loop.close()
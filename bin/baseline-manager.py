@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""Deploy baseline CloudFormation stacks to the accounts of an AWS Organization.
+
+Usage:
+  baseline-manager.py deploy [--config FILE] [--template-dir DIR] [--account NAME]... [--region REGION]... [--stack-prefix PREFIX] [--max-per-region N] [--poll-interval N] [--timeout N] [--force] [--exec] [-vd] [--boto-log] [--profile] [--profile-out FILE]
+  baseline-manager.py (-h | --help)
+  baseline-manager.py --version
+
+Modes of operation:
+  deploy         Create or update the baseline stack of every account in
+                 the config file that has a 'cloudformationTemplate'.
+                 Each account's 'iamRoleName' is assumed from the master
+                 account.  Stacks whose template and parameters are
+                 unchanged since their last successful deploy are
+                 skipped.
+
+Options:
+  -h, --help                 Show this help message and exit.
+  --version                  Display version info and exit.
+  --config FILE              Account config in create-account.json format.
+                             Defaults to config/create-account.json of
+                             this repository.
+  --template-dir DIR         Directory of the templates named in the config.
+                             Defaults to cloudformation/ of this repository.
+  --account NAME             Deploy only config entry NAME.  Repeatable.
+  --region REGION            Deploy in REGION.  Repeatable.  Defaults to the
+                             region of the AWS configuration.
+  --stack-prefix PREFIX      Stack name prefix.  The template name without
+                             extension follows it. [default: baseline-]
+  --max-per-region N         Max number of stacks in flight per region.
+                             At least 1. [default: 10]
+  --poll-interval N          Seconds between stack status polls.
+                             [default: 15]
+  --timeout N                Seconds to wait for stacks in flight.
+                             [default: 3600]
+  --force                    Deploy unchanged stacks too.
+  --exec                     Execute proposed changes to AWS accounts.
+  -v, --verbose              Log to activity to STDOUT at log level INFO.
+  -d, --debug                Increase log level to 'DEBUG'. Implies '--verbose'.
+  --boto-log                 Include botocore and boto3 logs in log stream.
+  --profile                  Print API call statistics and phase timings to
+                             STDERR at exit.
+  --profile-out FILE         Write API call statistics and phase timings to
+                             FILE in json format.
+
+"""
+
+from apistats import ApiProfile, report_profile
+import atexit
+from docopt import docopt
+from orgclient import get_org_client
+from stacks import (BASELINE_CONFIG_FILE, TEMPLATE_DIR, RoleClients,
+        deploy_stacks, deployed_record_file, get_deployments,
+        load_baseline_config, load_deployed, save_deployed, skip_unchanged)
+from utils import *
+
+
+def default_region():
+    import boto3
+    return boto3.session.Session().region_name
+
+def display_deployment_summary(deployments):
+    """
+    Print one table summarizing the state of all stack deployments.
+    """
+    if not deployments:
+        return
+    header = "Stack deployment summary:"
+    sys.stdout.write("\n%s\n%s\n" % ('_' * len(header), header))
+    for d in sorted(deployments, key=lambda d: (d.state, d.name, d.region)):
+        row = "%-24s%-16s%-12s%-12s%s" % (d.name, d.region, d.state,
+                d.action or '', d.detail)
+        sys.stdout.write(row.rstrip() + '\n')
+
+def main():
+    args = docopt(__doc__, version='1.0')
+    args['report'] = False
+    log = get_logger(args, os.path.basename(__file__).split('.')[0])
+
+    profile = ApiProfile()
+    if args['--profile'] or args['--profile-out']:
+        atexit.register(report_profile, args, profile)
+
+    profile.phase('validation')
+    max_per_region = args['--max-per-region']
+    if not max_per_region.isdigit() or int(max_per_region) < 1:
+        log.critical("--max-per-region must be a whole number of 1 or more, "
+                "not '%s'" % max_per_region)
+        sys.exit(1)
+    config_file = args['--config'] or BASELINE_CONFIG_FILE
+    entries = load_baseline_config(log, config_file)
+    unknown = [name for name in args['--account'] if name not in entries]
+    if unknown:
+        log.critical("Unknown accounts in '%s': %s" % (config_file,
+                ', '.join(unknown)))
+        sys.exit(1)
+    if args['--account']:
+        entries = dict((name, entries[name]) for name in args['--account'])
+    regions = sorted(set(args['--region'])) or [default_region()]
+    if None in regions:
+        log.critical("No region configured. Use --region")
+        sys.exit(1)
+
+    profile.phase('inventory')
+    account_ids = {}
+    if any(not entry.get('accountId') for entry in entries.values()):
+        org_client = get_org_client(log, profile=profile)
+        account_ids = dict((a['Name'], a['Id'])
+                for a in get_deployed_accounts(log, org_client))
+    deployments = get_deployments(log, entries, regions, account_ids,
+            args['--stack-prefix'], args['--template-dir'] or TEMPLATE_DIR)
+    record_file = deployed_record_file(config_file)
+    deployed = load_deployed(log, record_file)
+    if not args['--force']:
+        skip_unchanged(log, deployments, deployed)
+
+    profile.phase('stack deployment')
+    pending = [d for d in deployments if d.state == 'PENDING']
+    if args['--exec']:
+        deploy_stacks(log, deployments, RoleClients(log, profile),
+                int(max_per_region), float(args['--poll-interval']),
+                float(args['--timeout']))
+        save_deployed(log, record_file, deployed, deployments)
+    else:
+        for d in pending:
+            log.info("Deploying %s" % d.describe())
+    display_deployment_summary(deployments)
+    if any(d.state == 'FAILED' for d in deployments):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the AWS Organization management scripts.
+
+Usage:
+  benchmark validate [--size N] [--repeat N] [-d]
+  benchmark suite [--accounts LIST] [--depth LIST] [--latency MS] [--scenario NAME]... [--budget FILE | --record FILE] [-vd]
+  benchmark (-h | --help)
+
+Modes of operation:
+  validate       Time syntax validation of a synthetic org spec.
+  suite          Run account-manager and organization-manager against an
+                 in-memory fake Organizations client.  Report wall time,
+                 API calls and peak memory, and the memory an inventory
+                 holds per account.  Fail if API calls exceed the
+                 recorded budget.
+
+Options:
+  -h, --help                 Show this help message and exit.
+  --size N                   Number of OUs and of accounts in the synthetic
+                             spec. [default: 10000]
+  --repeat N                 Number of timed runs.  The best is reported.
+                             [default: 3]
+  --accounts LIST            Comma separated organization sizes in accounts.
+                             [default: 10,100,1000,10000]
+  --depth LIST               Comma separated OU tree depths. [default: 2,6]
+  --latency MS               Latency added to every fake API call in
+                             milliseconds. [default: 0]
+  --scenario NAME            Run only the named scenario.  May be repeated.
+  --budget FILE              API call budget file.  Defaults to
+                             data/benchmark-budget.json.
+  --record FILE              Write the API calls of this run as the budget
+                             to FILE instead of checking them.
+  -v, --verbose              Show API calls per operation.
+  -d, --debug                Increase log level to 'DEBUG'.
+
+"""
+
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import yaml
+from docopt import docopt
+from fakeorg import DEFAULT_POLICY, MASTER_ACCOUNT_ID, synthetic_org
+from inventory import get_org_snapshot
+from utils import get_spec_validators, load_script
+
+# child OUs per OU in synthetic org specs
+BRANCHING = 10
+# spec drift in suite runs: every DRIFT_EVERY'th account is placed in
+# another OU, every UNMANAGED_EVERY'th account is left out of the spec
+# and one new account per NEW_ACCOUNT_EVERY accounts is requested.
+DRIFT_EVERY = 50
+UNMANAGED_EVERY = 100
+NEW_ACCOUNT_EVERY = 100
+# API call budgets recorded with 'benchmark suite --record'
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'data', 'benchmark-budget.json')
+
+# (name, script, arguments).  '{org_spec}' and '{account_spec}' are
+# replaced by the synthetic spec files.  Every run starts from a fresh
+# organization, so organization runs use --full instead of the
+# last-applied record of the previous run.
+SCENARIOS = [
+    ('account-report', 'account-manager.py', ['report']),
+    ('account-create', 'account-manager.py',
+        ['create', '--spec-file', '{account_spec}']),
+    ('account-create-exec', 'account-manager.py',
+        ['create', '--spec-file', '{account_spec}', '--exec']),
+    ('org-report', 'organization-manager.py', ['report']),
+    ('organization', 'organization-manager.py',
+        ['organization', '--spec-file', '{org_spec}', '--full']),
+    ('organization-exec', 'organization-manager.py',
+        ['organization', '--spec-file', '{org_spec}', '--exec', '--full']),
+    ('organization-watch', 'organization-manager.py',
+        ['watch', '--spec-file', '{org_spec}', '--interval', '0',
+            '--count', '2']),
+    ('org-report-async', 'organization-manager.py',
+        ['report', '--engine', 'async']),
+    ('organization-async', 'organization-manager.py',
+        ['organization', '--spec-file', '{org_spec}', '--full',
+            '--engine', 'async']),
+    ('organization-exec-async', 'organization-manager.py',
+        ['organization', '--spec-file', '{org_spec}', '--exec', '--full',
+            '--engine', 'async']),
+]
+# measures the memory held by an inventory of the organization
+INVENTORY_SCENARIO = 'inventory'
+# the async engine needs Python 3
+if sys.version_info[0] < 3:
+    SCENARIOS = [s for s in SCENARIOS if not s[0].endswith('-async')]
+
+try:
+    from yaml import CSafeDumper as SpecDumper
+except ImportError:
+    from yaml import SafeDumper as SpecDumper
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def synthetic_org_spec(size, branching=BRANCHING):
+    """
+    Return an org spec with 'size' OUs in a tree of 'branching' child OUs
+    per OU, 'size' accounts spread over the OUs and one policy per 100 OUs.
+    """
+    policies = ['policy_%d' % i for i in range(max(1, size // 100))]
+    root = dict(Name='root', Child_OU=[])
+    ou_list = [root]
+    level = [root]
+    while len(ou_list) < size + 1:
+        next_level = []
+        for parent in level:
+            for i in range(branching):
+                if len(ou_list) > size:
+                    break
+                ou = dict(Name='ou_%d' % len(ou_list),
+                        SC_Policies=[policies[len(ou_list) % len(policies)]],
+                        Accounts=[])
+                parent.setdefault('Child_OU', []).append(ou)
+                ou_list.append(ou)
+                next_level.append(ou)
+        level = next_level
+    for i in range(size):
+        ou_list[1 + i % size]['Accounts'].append('account_%d' % i)
+    return dict(
+        master_account_id = '123456789012',
+        default_policy = 'FullAWSAccess',
+        default_ou = 'root',
+        organizational_units = [root],
+        sc_policies = [dict(Name=name, Ensure='present',
+                Description='synthetic policy', Effect='Allow',
+                Actions=['s3:*', 'ec2:*']) for name in policies],
+    )
+
+
+def fake_org_specs(org):
+    """
+    Return (org_spec, account_spec) describing fake organization 'org'
+    with some drift, so the managers have work to plan: accounts placed
+    in other OUs, unmanaged accounts, a changed policy description, a new
+    OU with a new policy, and new accounts to create.
+    """
+    policy_names = dict((p_id, p['Name']) for p_id, p in org.policies.items())
+    root_id = org.root['Id']
+    ou_order = [root_id] + sorted(org.ou)
+    position = dict((ou_id, i) for i, ou_id in enumerate(ou_order))
+    ou_spec = {}
+    for ou_id in ou_order:
+        ou_spec[ou_id] = dict(
+            Name = 'root' if ou_id == root_id else org.ou[ou_id]['Name'],
+            Accounts = [],
+            SC_Policies = sorted(policy_names[p_id]
+                    for p_id in org.attached.get(ou_id, ())
+                    if p_id != org.default_policy_id),
+        )
+    for ou_id in ou_order[1:]:
+        ou_spec[org.parent[ou_id]].setdefault('Child_OU', []).append(
+                ou_spec[ou_id])
+    accounts = sorted(org.accounts.values(), key=lambda a: a['Name'])
+    for i, account in enumerate(accounts):
+        if account['Id'] == MASTER_ACCOUNT_ID:
+            ou_spec[root_id]['Accounts'].append(account['Name'])
+        elif i % UNMANAGED_EVERY == UNMANAGED_EVERY - 1:
+            continue
+        elif i % DRIFT_EVERY == DRIFT_EVERY - 1:
+            other = ou_order[(position[org.parent[account['Id']]] + 1)
+                    % len(ou_order)]
+            ou_spec[other]['Accounts'].append(account['Name'])
+        else:
+            ou_spec[org.parent[account['Id']]]['Accounts'].append(
+                    account['Name'])
+    root_spec = ou_spec[root_id]
+    root_spec.setdefault('Child_OU', []).append(dict(Name='benchmark_ou',
+            Accounts=[], SC_Policies=['benchmark_policy']))
+    sc_policies = [dict(Name=p['Name'], Description=p['Description'],
+            Effect='Allow', Actions=['s3:*', 'ec2:*'])
+            for p in sorted(org.policies.values(), key=lambda p: p['Name'])
+            if p['Name'] != DEFAULT_POLICY]
+    sc_policies[0]['Description'] += ' (changed)'
+    sc_policies.append(dict(Name='benchmark_policy',
+            Description='benchmark policy', Effect='Deny', Actions=['iam:*']))
+    org_spec = dict(
+        master_account_id = MASTER_ACCOUNT_ID,
+        default_policy = DEFAULT_POLICY,
+        default_ou = 'root',
+        organizational_units = [root_spec],
+        sc_policies = sc_policies,
+    )
+    new_accounts = ['new_account_%05d' % i
+            for i in range(max(1, len(accounts) // NEW_ACCOUNT_EVERY))]
+    account_spec = dict(
+        master_account_id = MASTER_ACCOUNT_ID,
+        default_domain = 'example.com',
+        teams = [dict(Name='benchmark', BusinessContacts=['b@example.com'],
+                TechnicalContacts=['t@example.com'])],
+        accounts = [dict(Name=name, Team='benchmark') for name in
+                [a['Name'] for a in accounts] + new_accounts],
+    )
+    return org_spec, account_spec
+
+
+def best_time(func, repeat):
+    """
+    Call 'func' 'repeat' times.  Return (best seconds, last result).
+    """
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        timings.append(time.time() - start)
+    return min(timings), result
+
+
+def benchmark_validate(log, size, repeat):
+    validator = get_spec_validators(log)['org_spec']
+    spec = synthetic_org_spec(size)
+    seconds, errors = best_time(lambda: validator.validate(spec), repeat)
+    print("validate org_spec: %d OUs, %d accounts: %.3fs (%d findings)" %
+            (size, size, seconds, len(errors)))
+
+
+def run_script(file_name, argv, org_client):
+    """
+    Run main() of a manager script with command line 'argv' against
+    'org_client'.  Output and logs are discarded and account creation
+    polling does not sleep.  Returns the exit status.
+    """
+    script = load_script(file_name)
+    script.get_org_client = lambda *args, **kwargs: org_client
+    if hasattr(script, 'POLL_INITIAL_DELAY'):
+        script.POLL_INITIAL_DELAY = 0
+    root_logger = logging.getLogger()
+    handlers = list(root_logger.handlers)
+    level = root_logger.level
+    saved = sys.argv, sys.stdout, sys.stderr
+    sys.argv = [file_name] + argv
+    status = 0
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = sys.stderr = devnull
+        root_logger.handlers = []
+        try:
+            script.main()
+        except SystemExit as e:
+            status = e.code or 0
+        finally:
+            sys.argv, sys.stdout, sys.stderr = saved
+            root_logger.handlers = handlers
+            root_logger.setLevel(level)
+    return status
+
+
+def measure(func):
+    """
+    Call 'func'.  Return (peak memory in bytes or None, result).
+    Uses tracemalloc where available.
+    """
+    if tracemalloc is None:
+        return None, func()
+    tracemalloc.start()
+    try:
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak, result
+
+
+def write_specs(spec_dir, org):
+    org_spec, account_spec = fake_org_specs(org)
+    files = {}
+    for name, spec in (('org_spec', org_spec), ('account_spec', account_spec)):
+        files[name] = os.path.join(spec_dir, '%s.yaml' % name)
+        with open(files[name], 'w') as f:
+            yaml.dump(spec, f, Dumper=SpecDumper, default_flow_style=False)
+    return files
+
+
+def run_scenario(scenario, accounts, depth, latency, spec_files):
+    """
+    Run one scenario twice on fresh synthetic organizations: once timed,
+    once with memory tracing.  Return a result dictionary.
+    """
+    name, script, argv = scenario
+    argv = [arg.format(**spec_files) for arg in argv]
+    org = synthetic_org(accounts, depth, latency)
+    start = time.time()
+    status = run_script(script, argv, org)
+    seconds = time.time() - start
+    calls = org.counts()
+    peak, _ = measure(lambda: run_script(script, argv,
+            synthetic_org(accounts, depth, latency)))
+    return dict(scenario=name, accounts=accounts, depth=depth,
+            seconds=seconds, calls=calls, peak=peak, status=status)
+
+
+class DecodedResponses(object):
+    """
+    Wrapper of a fake Organizations client returning freshly decoded
+    copies of its responses, as botocore does, so the objects the
+    inventory keeps are not shared with the fake.
+    """
+    def __init__(self, org_client):
+        self._org_client = org_client
+
+    def __getattr__(self, name):
+        api_call = getattr(self._org_client, name)
+        def decoded(**kwargs):
+            return json.loads(json.dumps(api_call(**kwargs), default=str))
+        return decoded
+
+
+def run_inventory(log, accounts, depth, latency):
+    """
+    Take an inventory of a fresh synthetic organization.  Return a
+    result dictionary whose 'peak' is the memory the inventory holds
+    once taken, and 'per_account' that memory divided by 'accounts'.
+    """
+    org = synthetic_org(accounts, depth, latency)
+    start = time.time()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        snapshot = get_org_snapshot(log, DecodedResponses(org))
+        held = tracemalloc.get_traced_memory()[0] if tracemalloc else None
+    finally:
+        if tracemalloc is not None:
+            tracemalloc.stop()
+    seconds = time.time() - start
+    return dict(scenario=INVENTORY_SCENARIO, accounts=accounts, depth=depth,
+            seconds=seconds, calls=org.counts(), peak=held,
+            per_account=held // accounts if held is not None else None,
+            status=0)
+
+
+def budget_key(result):
+    return '%s accounts=%d depth=%d' % (result['scenario'],
+            result['accounts'], result['depth'])
+
+
+def over_budget(result, budget):
+    """
+    Return list of (operation, calls, budget) for operations of 'result'
+    that made more API calls than 'budget' allows.
+    """
+    allowed = budget.get(budget_key(result))
+    if allowed is None:
+        return []
+    return [(op, count, allowed.get(op, 0))
+            for op, count in sorted(result['calls'].items())
+            if count > allowed.get(op, 0)]
+
+
+def display_result(result, verbose):
+    peak = result['peak']
+    per_account = result.get('per_account')
+    print("%-24s %6d %5d %9.3fs %8d calls %10s%s%s" % (result['scenario'],
+            result['accounts'], result['depth'], result['seconds'],
+            sum(result['calls'].values()),
+            '%.1f MB' % (peak / 1048576.0) if peak is not None else '-',
+            '  %d B/account' % per_account if per_account is not None else '',
+            '  exit %s' % result['status'] if result['status'] else ''))
+    if verbose:
+        for op, count in sorted(result['calls'].items()):
+            print("    %-40s %8d" % (op, count))
+
+
+def benchmark_suite(log, args):
+    sizes = [int(n) for n in args['--accounts'].split(',')]
+    depths = [int(n) for n in args['--depth'].split(',')]
+    latency = float(args['--latency']) / 1000
+    scenarios = [s for s in SCENARIOS
+            if not args['--scenario'] or s[0] in args['--scenario']]
+    inventory = (not args['--scenario']
+            or INVENTORY_SCENARIO in args['--scenario'])
+    unknown = set(args['--scenario']) - set(s[0] for s in SCENARIOS) - set(
+            [INVENTORY_SCENARIO])
+    if unknown:
+        log.critical("Unknown scenario: %s" % ', '.join(sorted(unknown)))
+        sys.exit(1)
+    budget = {}
+    budget_file = args['--budget'] or BUDGET_FILE
+    if not args['--record'] and os.path.exists(budget_file):
+        with open(budget_file) as f:
+            budget = json.load(f)
+    print("%-24s %6s %5s %10s %14s %10s" % ('scenario', 'accts', 'depth',
+            'wall', 'api', 'peak mem'))
+    results = []
+    failures = []
+    spec_dir = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        for accounts in sizes:
+            for depth in depths:
+                spec_files = write_specs(spec_dir,
+                        synthetic_org(accounts, depth))
+                runs = [lambda s=s: run_scenario(s, accounts, depth, latency,
+                        spec_files) for s in scenarios]
+                if inventory:
+                    runs.append(lambda: run_inventory(log, accounts, depth,
+                            latency))
+                for run in runs:
+                    result = run()
+                    display_result(result, args['--verbose'])
+                    results.append(result)
+                    for op, count, allowed in over_budget(result, budget):
+                        failures.append("%s: %s made %d calls, budget %d" %
+                                (budget_key(result), op, count, allowed))
+                    if result['status']:
+                        failures.append("%s: exit status %s" %
+                                (budget_key(result), result['status']))
+    finally:
+        shutil.rmtree(spec_dir)
+    if args['--record']:
+        recorded = dict((budget_key(r), r['calls']) for r in results)
+        with open(args['--record'], 'w') as f:
+            json.dump(recorded, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print("Recorded API call budget in '%s'" % args['--record'])
+    if failures:
+        for failure in failures:
+            log.error(failure)
+        log.critical("%d benchmark checks failed" % len(failures))
+        sys.exit(1)
+
+
+def main():
+    args = docopt(__doc__, version='1.0')
+    logging.basicConfig(level=logging.DEBUG if args['--debug'] else logging.WARN)
+    log = logging.getLogger()
+    if args['validate']:
+        benchmark_validate(log, int(args['--size']), int(args['--repeat']))
+    if args['suite']:
+        benchmark_suite(log, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+"""In-memory fake AWS Organizations client for benchmarks and dry tests """
+import copy
+import itertools
+import json
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+DEFAULT_POLICY = 'FullAWSAccess'
+MASTER_ACCOUNT_ID = '123456789012'
+ROOT_ID = 'r-fake'
+# max items per page, as returned by the Organizations list APIs
+PAGE_SIZE = 20
+# list_create_account_status calls before a creation request succeeds
+CREATE_ACCOUNT_POLLS = 1
+# shape of synthetic organizations
+ACCOUNTS_PER_OU = 10
+OU_PER_POLICY = 10
+
+
+def policy_content(actions, effect='Allow'):
+    """
+    Return the policy document JSON text organization-manager.py renders
+    for an sc_policy spec.
+    """
+    statement = dict(Effect=effect, Action=actions, Resource='*')
+    return json.dumps(dict(Version='2012-10-17', Statement=[statement]))
+
+
+class FakeOrganizationsClient(object):
+    """
+    Thread safe in-memory stand-in for the boto3 Organizations client.
+    Implements the API calls used by the managers, with pagination and
+    the errors AWS raises for bad Ids.  Every call is counted in 'calls'
+    and delayed by 'latency' seconds.
+    """
+    def __init__(self, latency=0.0, page_size=PAGE_SIZE,
+            create_account_polls=CREATE_ACCOUNT_POLLS):
+        self.latency = latency
+        self.page_size = page_size
+        self.create_account_polls = create_account_polls
+        self.calls = {}
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self.root = dict(Id=ROOT_ID, Name='Root',
+                Arn='arn:aws:organizations::%s:root/o-fake/%s' % (
+                    MASTER_ACCOUNT_ID, ROOT_ID),
+                PolicyTypes=[dict(Type='SERVICE_CONTROL_POLICY',
+                    Status='ENABLED')])
+        self.ou = {}
+        self.accounts = {}
+        self.parent = {}
+        self.children = {ROOT_ID: []}
+        self.policies = {}
+        self.attached = {}
+        self.targets = {}
+        self.create_requests = {}
+        self.default_policy_id = self._add_policy(DEFAULT_POLICY,
+                'Allows access to every operation', policy_content('*'),
+                aws_managed=True)
+        self._attach(self.default_policy_id, ROOT_ID)
+        self.add_account('master', parent_id=ROOT_ID,
+                account_id=MASTER_ACCOUNT_ID)
+
+    # bookkeeping
+
+    def _new_id(self, fmt):
+        return fmt % next(self._ids)
+
+    def _call(self, operation):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def _error(self, operation, code, message=''):
+        return ClientError(dict(Error=dict(Code=code, Message=message)),
+                operation)
+
+    def _page(self, items, result_key, render=dict, NextToken=None,
+            MaxResults=None):
+        # only the items on the requested page are rendered
+        start = int(NextToken or 0)
+        end = start + min(MaxResults or self.page_size, self.page_size)
+        response = {result_key: [render(item) for item in items[start:end]]}
+        if end < len(items):
+            response['NextToken'] = str(end)
+        return response
+
+    def _add_policy(self, name, description, content, aws_managed=False):
+        policy_id = self._new_id('p-%08d')
+        self.policies[policy_id] = dict(Id=policy_id, Name=name,
+                Description=description, Type='SERVICE_CONTROL_POLICY',
+                AwsManaged=aws_managed, Content=content)
+        self.targets[policy_id] = set()
+        return policy_id
+
+    def _attach(self, policy_id, target_id):
+        self.attached.setdefault(target_id, set()).add(policy_id)
+        self.targets[policy_id].add(target_id)
+
+    def _check_parent(self, operation, parent_id):
+        if parent_id not in self.children:
+            raise self._error(operation, 'ParentNotFoundException', parent_id)
+
+    def _summary(self, policy):
+        return dict((k, v) for k, v in policy.items() if k != 'Content')
+
+    def _public(self, status):
+        return dict((k, v) for k, v in status.items() if not k.startswith('_'))
+
+    def without_latency(self):
+        """
+        Return a view of this organization that shares all its state and
+        counters but does not sleep.  Used by callers that wait out the
+        latency themselves, like the async engine.
+        """
+        view = copy.copy(self)
+        view.latency = 0.0
+        return view
+
+    def counts(self):
+        """
+        Return a copy of the per operation call counters.
+        """
+        with self._lock:
+            return dict(self.calls)
+
+    # direct setup, not counted as API calls
+
+    def add_ou(self, name, parent_id=ROOT_ID):
+        with self._lock:
+            ou_id = self._new_id('ou-fake-%08d')
+            self.ou[ou_id] = dict(Id=ou_id, Name=name,
+                    Arn='arn:aws:organizations::%s:ou/o-fake/%s' % (
+                        MASTER_ACCOUNT_ID, ou_id))
+            self.parent[ou_id] = parent_id
+            self.children[ou_id] = []
+            self.children[parent_id].append(ou_id)
+            self._attach(self.default_policy_id, ou_id)
+            return ou_id
+
+    def add_account(self, name, parent_id=ROOT_ID, account_id=None,
+            email=None):
+        with self._lock:
+            if account_id is None:
+                account_id = self._new_id('%012d')
+            self.accounts[account_id] = dict(Id=account_id, Name=name,
+                    Email=email or '%s@example.com' % name,
+                    Arn='arn:aws:organizations::%s:account/o-fake/%s' % (
+                        MASTER_ACCOUNT_ID, account_id),
+                    Status='ACTIVE', JoinedMethod='CREATED')
+            self.parent[account_id] = parent_id
+            self.children[parent_id].append(account_id)
+            return account_id
+
+    def add_policy(self, name, description, content, targets=()):
+        with self._lock:
+            policy_id = self._add_policy(name, description, content)
+            for target_id in targets:
+                self._attach(policy_id, target_id)
+            return policy_id
+
+    # read API
+
+    def list_roots(self, **kwargs):
+        self._call('list_roots')
+        return self._page([self.root], 'Roots', **kwargs)
+
+    def describe_organization(self):
+        self._call('describe_organization')
+        return dict(Organization=dict(Id='o-fake',
+                MasterAccountId=MASTER_ACCOUNT_ID,
+                FeatureSet='ALL'))
+
+    def list_accounts(self, **kwargs):
+        self._call('list_accounts')
+        with self._lock:
+            return self._page(list(self.accounts.values()), 'Accounts',
+                    **kwargs)
+
+    def describe_account(self, AccountId):
+        self._call('describe_account')
+        with self._lock:
+            if AccountId not in self.accounts:
+                raise self._error('DescribeAccount',
+                        'AccountNotFoundException', AccountId)
+            return dict(Account=dict(self.accounts[AccountId]))
+
+    def list_organizational_units_for_parent(self, ParentId, **kwargs):
+        self._call('list_organizational_units_for_parent')
+        with self._lock:
+            self._check_parent('ListOrganizationalUnitsForParent', ParentId)
+            child_ou = [self.ou[c] for c in self.children[ParentId]
+                    if c in self.ou]
+            return self._page(child_ou, 'OrganizationalUnits', **kwargs)
+
+    def describe_organizational_unit(self, OrganizationalUnitId):
+        self._call('describe_organizational_unit')
+        with self._lock:
+            if OrganizationalUnitId not in self.ou:
+                raise self._error('DescribeOrganizationalUnit',
+                        'OrganizationalUnitNotFoundException',
+                        OrganizationalUnitId)
+            return dict(OrganizationalUnit=dict(self.ou[OrganizationalUnitId]))
+
+    def list_accounts_for_parent(self, ParentId, **kwargs):
+        self._call('list_accounts_for_parent')
+        with self._lock:
+            self._check_parent('ListAccountsForParent', ParentId)
+            accounts = [self.accounts[c] for c in self.children[ParentId]
+                    if c in self.accounts]
+            return self._page(accounts, 'Accounts', **kwargs)
+
+    def list_children(self, ParentId, ChildType, **kwargs):
+        self._call('list_children')
+        with self._lock:
+            self._check_parent('ListChildren', ParentId)
+            kind = self.ou if ChildType == 'ORGANIZATIONAL_UNIT' else self.accounts
+            children = [c for c in self.children[ParentId] if c in kind]
+            return self._page(children, 'Children',
+                    lambda c: dict(Id=c, Type=ChildType), **kwargs)
+
+    def list_parents(self, ChildId, **kwargs):
+        self._call('list_parents')
+        with self._lock:
+            if ChildId not in self.parent:
+                raise self._error('ListParents', 'ChildNotFoundException',
+                        ChildId)
+            parent_id = self.parent[ChildId]
+        parent_type = 'ROOT' if parent_id == ROOT_ID else 'ORGANIZATIONAL_UNIT'
+        return self._page([dict(Id=parent_id, Type=parent_type)], 'Parents',
+                **kwargs)
+
+    def list_policies(self, Filter, **kwargs):
+        self._call('list_policies')
+        with self._lock:
+            policies = [p for p in self.policies.values()
+                    if p['Type'] == Filter]
+            return self._page(policies, 'Policies', self._summary, **kwargs)
+
+    def describe_policy(self, PolicyId):
+        self._call('describe_policy')
+        with self._lock:
+            if PolicyId not in self.policies:
+                raise self._error('DescribePolicy', 'PolicyNotFoundException',
+                        PolicyId)
+            policy = self.policies[PolicyId]
+            return dict(Policy=dict(PolicySummary=self._summary(policy),
+                    Content=policy['Content']))
+
+    def list_policies_for_target(self, TargetId, Filter, **kwargs):
+        self._call('list_policies_for_target')
+        with self._lock:
+            policies = [self.policies[p_id]
+                    for p_id in sorted(self.attached.get(TargetId, ()))]
+            return self._page(policies, 'Policies', self._summary, **kwargs)
+
+    def list_targets_for_policy(self, PolicyId, **kwargs):
+        self._call('list_targets_for_policy')
+        with self._lock:
+            if PolicyId not in self.policies:
+                raise self._error('ListTargetsForPolicy',
+                        'PolicyNotFoundException', PolicyId)
+            return self._page(sorted(self.targets[PolicyId]), 'Targets',
+                    lambda t: dict(TargetId=t), **kwargs)
+
+    def list_create_account_status(self, States=None, **kwargs):
+        self._call('list_create_account_status')
+        with self._lock:
+            self._progress_create_requests()
+            statuses = [s for s in self.create_requests.values()
+                    if not States or s['State'] in States]
+            return self._page(statuses, 'CreateAccountStatuses',
+                    self._public, **kwargs)
+
+    def describe_create_account_status(self, CreateAccountRequestId):
+        self._call('describe_create_account_status')
+        with self._lock:
+            if CreateAccountRequestId not in self.create_requests:
+                raise self._error('DescribeCreateAccountStatus',
+                        'CreateAccountStatusNotFoundException',
+                        CreateAccountRequestId)
+            return dict(CreateAccountStatus=self._public(
+                    self.create_requests[CreateAccountRequestId]))
+
+    # write API
+
+    def _progress_create_requests(self):
+        for status in self.create_requests.values():
+            if status['State'] != 'IN_PROGRESS':
+                continue
+            status['_polls'] = status.get('_polls', 0) + 1
+            if status['_polls'] > self.create_account_polls:
+                status['AccountId'] = self.add_account(status['AccountName'],
+                        email=status.pop('_email'))
+                status['State'] = 'SUCCEEDED'
+                del status['_polls']
+
+    def create_account(self, AccountName, Email, **kwargs):
+        self._call('create_account')
+        with self._lock:
+            request_id = self._new_id('car-%08d')
+            status = dict(Id=request_id, AccountName=AccountName,
+                    State='IN_PROGRESS', RequestedTimestamp=time.time(),
+                    _email=Email)
+            if any(a['Name'] == AccountName for a in self.accounts.values()):
+                status.update(State='FAILED', FailureReason='EMAIL_ALREADY_EXISTS')
+                del status['_email']
+            self.create_requests[request_id] = status
+            return dict(CreateAccountStatus=self._public(status))
+
+    def enable_policy_type(self, RootId, PolicyType):
+        self._call('enable_policy_type')
+        with self._lock:
+            self.root['PolicyTypes'] = [dict(Type=PolicyType, Status='ENABLED')]
+            return dict(Root=dict(self.root))
+
+    def create_organizational_unit(self, ParentId, Name):
+        self._call('create_organizational_unit')
+        with self._lock:
+            self._check_parent('CreateOrganizationalUnit', ParentId)
+            if any(self.ou[c]['Name'] == Name
+                    for c in self.children[ParentId] if c in self.ou):
+                raise self._error('CreateOrganizationalUnit',
+                        'DuplicateOrganizationalUnitException', Name)
+            ou_id = self.add_ou(Name, ParentId)
+            return dict(OrganizationalUnit=dict(self.ou[ou_id]))
+
+    def delete_organizational_unit(self, OrganizationalUnitId):
+        self._call('delete_organizational_unit')
+        with self._lock:
+            if OrganizationalUnitId not in self.ou:
+                raise self._error('DeleteOrganizationalUnit',
+                        'OrganizationalUnitNotFoundException',
+                        OrganizationalUnitId)
+            if self.children[OrganizationalUnitId]:
+                raise self._error('DeleteOrganizationalUnit',
+                        'OrganizationalUnitNotEmptyException',
+                        OrganizationalUnitId)
+            parent_id = self.parent.pop(OrganizationalUnitId)
+            self.children[parent_id].remove(OrganizationalUnitId)
+            del self.children[OrganizationalUnitId]
+            del self.ou[OrganizationalUnitId]
+            for policy_id in self.attached.pop(OrganizationalUnitId, ()):
+                self.targets[policy_id].discard(OrganizationalUnitId)
+
+    def move_account(self, AccountId, SourceParentId, DestinationParentId):
+        self._call('move_account')
+        with self._lock:
+            if AccountId not in self.accounts:
+                raise self._error('MoveAccount', 'AccountNotFoundException',
+                        AccountId)
+            self._check_parent('MoveAccount', DestinationParentId)
+            if self.parent[AccountId] != SourceParentId:
+                raise self._error('MoveAccount',
+                        'SourceParentNotFoundException', SourceParentId)
+            if SourceParentId == DestinationParentId:
+                raise self._error('MoveAccount',
+                        'DuplicateAccountException', AccountId)
+            self.children[SourceParentId].remove(AccountId)
+            self.children[DestinationParentId].append(AccountId)
+            self.parent[AccountId] = DestinationParentId
+
+    def create_policy(self, Content, Description, Name, Type):
+        self._call('create_policy')
+        with self._lock:
+            if any(p['Name'] == Name for p in self.policies.values()):
+                raise self._error('CreatePolicy', 'DuplicatePolicyException',
+                        Name)
+            policy_id = self._add_policy(Name, Description, Content)
+            return dict(Policy=dict(
+                    PolicySummary=self._summary(self.policies[policy_id]),
+                    Content=Content))
+
+    def update_policy(self, PolicyId, **kwargs):
+        self._call('update_policy')
+        with self._lock:
+            if PolicyId not in self.policies:
+                raise self._error('UpdatePolicy', 'PolicyNotFoundException',
+                        PolicyId)
+            policy = self.policies[PolicyId]
+            for key in ('Name', 'Description', 'Content'):
+                if key in kwargs:
+                    policy[key] = kwargs[key]
+            return dict(Policy=dict(PolicySummary=self._summary(policy),
+                    Content=policy['Content']))
+
+    def delete_policy(self, PolicyId):
+        self._call('delete_policy')
+        with self._lock:
+            if PolicyId not in self.policies:
+                raise self._error('DeletePolicy', 'PolicyNotFoundException',
+                        PolicyId)
+            if self.targets[PolicyId]:
+                raise self._error('DeletePolicy', 'PolicyInUseException',
+                        PolicyId)
+            del self.policies[PolicyId]
+            del self.targets[PolicyId]
+
+    def attach_policy(self, PolicyId, TargetId):
+        self._call('attach_policy')
+        with self._lock:
+            if PolicyId not in self.policies:
+                raise self._error('AttachPolicy', 'PolicyNotFoundException',
+                        PolicyId)
+            if TargetId not in self.parent and TargetId != ROOT_ID:
+                raise self._error('AttachPolicy', 'TargetNotFoundException',
+                        TargetId)
+            if PolicyId in self.attached.get(TargetId, ()):
+                raise self._error('AttachPolicy',
+                        'DuplicatePolicyAttachmentException', PolicyId)
+            self._attach(PolicyId, TargetId)
+
+    def detach_policy(self, PolicyId, TargetId):
+        self._call('detach_policy')
+        with self._lock:
+            if PolicyId not in self.attached.get(TargetId, ()):
+                raise self._error('DetachPolicy',
+                        'PolicyNotAttachedException', PolicyId)
+            self.attached[TargetId].discard(PolicyId)
+            self.targets[PolicyId].discard(TargetId)
+
+
+def synthetic_org(accounts, depth, latency=0.0):
+    """
+    Return a FakeOrganizationsClient holding an organization with
+    'accounts' accounts (plus the master account) spread round robin over
+    an OU tree 'depth' levels deep.  There is one OU per ACCOUNTS_PER_OU
+    accounts and one policy per OU_PER_POLICY OUs, each attached to
+    every OU_PER_POLICY'th OU.
+    """
+    org = FakeOrganizationsClient(latency=latency)
+    n_ou = max(depth, accounts // ACCOUNTS_PER_OU)
+    levels = [[ROOT_ID]] + [[] for i in range(depth)]
+    ou_ids = []
+    for i in range(n_ou):
+        level = 1 + i % depth
+        parents = levels[level - 1]
+        parent_id = parents[len(levels[level]) % len(parents)]
+        ou_id = org.add_ou('ou_%05d' % i, parent_id)
+        levels[level].append(ou_id)
+        ou_ids.append(ou_id)
+    parent_ids = [ROOT_ID] + ou_ids
+    for i in range(accounts):
+        org.add_account('account_%05d' % i, parent_ids[i % len(parent_ids)])
+    for i in range(max(1, n_ou // OU_PER_POLICY)):
+        org.add_policy('policy_%05d' % i, 'synthetic policy %d' % i,
+                policy_content(['s3:*', 'ec2:*']),
+                targets=ou_ids[i::OU_PER_POLICY])
+    return org
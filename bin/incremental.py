@@ -0,0 +1,308 @@
+"""Last-applied records for incremental organization reconciliation """
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from inventory import (OrgSnapshot, PolicyStore, canonical_json,
+        get_attachment_index)
+from orgclient import error_code
+from utils import CRAWL_WORKERS, get_deployed_accounts, paginate
+
+LAST_APPLIED_VERSION = 1
+# the record is kept next to the first spec file
+LAST_APPLIED_SUFFIX = '.last-applied.json'
+# org spec keys hashed per item.  All other keys are hashed together.
+ITEM_KEYS = ('organizational_units', 'sc_policies')
+
+
+def spec_digest(value):
+    """
+    Return sha256 hex digest of the canonical JSON of spec data 'value'.
+    """
+    return hashlib.sha256(canonical_json(value).encode('utf-8')).hexdigest()
+
+
+def _hash_ou(ou_spec_list, parent_name, hashes):
+    """
+    Fill 'hashes' with the digests of every OU in 'ou_spec_list'.  The
+    node digest covers the OU's own settings, the names of its child OUs
+    and its parent.  The subtree digest combines it with the subtree
+    digests of the child OUs.
+    """
+    for ou_spec in ou_spec_list or []:
+        children = ou_spec.get('Child_OU') or []
+        _hash_ou(children, ou_spec['Name'], hashes)
+        node = dict((k, v) for k, v in ou_spec.items() if k != 'Child_OU')
+        node['Child_OU'] = [child['Name'] for child in children]
+        node_digest = spec_digest([parent_name, node])
+        hashes[ou_spec['Name']] = dict(parent=parent_name, node=node_digest,
+                subtree=spec_digest([node_digest] + [hashes[child['Name']][
+                        'subtree'] for child in children]))
+    return hashes
+
+
+def spec_hashes(org_spec):
+    """
+    Return the content digests of 'org_spec': one for the global
+    settings, one per policy and node and subtree digests per OU.
+    """
+    return dict(
+        settings = spec_digest(dict((k, v) for k, v in org_spec.items()
+                if k not in ITEM_KEYS)),
+        policies = dict((p_spec['Name'], spec_digest(p_spec))
+                for p_spec in org_spec['sc_policies']),
+        ou = _hash_ou(org_spec['organizational_units'], None, {}),
+    )
+
+
+def last_applied_file(spec_files):
+    """
+    Return the name of the last-applied record for a run with
+    'spec_files'.
+    """
+    return spec_files[0].rstrip(os.sep) + LAST_APPLIED_SUFFIX
+
+
+def load_last_applied(log, file_name):
+    """
+    Return the last-applied record in 'file_name' or None if there is
+    no usable record.
+    """
+    try:
+        with open(file_name) as f:
+            record = json.load(f)
+    except (IOError, OSError, ValueError):
+        log.debug("no last-applied record '%s'" % file_name)
+        return None
+    if record.get('version') != LAST_APPLIED_VERSION:
+        log.info("Ignoring last-applied record '%s' with version '%s'" %
+                (file_name, record.get('version')))
+        return None
+    return record
+
+
+def managed_account_ids(snapshot, managed_accounts):
+    """
+    Return dict of the Ids of the accounts in 'managed_accounts' found
+    in 'snapshot', keyed by name.
+    """
+    accounts = {}
+    for name in managed_accounts:
+        account_id = snapshot.accounts.by_name(name, 'Id')
+        if account_id:
+            accounts[name] = account_id
+    return accounts
+
+
+def save_last_applied(log, file_name, spec_files, hashes, master_account_id,
+        account_ids, managed_accounts, record=None, full=False):
+    """
+    Write the last-applied record after a successful run.  Besides the
+    spec digests it keeps the Ids of managed accounts, from 'account_ids'
+    or the previous 'record', so later incremental runs can look accounts
+    up without listing them all.  A 'full' run looked up every account,
+    so none are kept from 'record'.  The generation counts successful
+    applies, full or not.  The file is replaced atomically.
+    """
+    accounts = dict(record['accounts']) if record and not full else {}
+    accounts.update(account_ids)
+    data = dict(
+        version = LAST_APPLIED_VERSION,
+        generation = record['generation'] + 1 if record else 1,
+        applied = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        spec_files = sorted(set(os.path.abspath(f) for f in spec_files)),
+        master_account_id = master_account_id,
+        accounts = dict((name, accounts[name]) for name in managed_accounts
+                if name in accounts),
+        **hashes
+    )
+    log.info("Saving last-applied record generation %d to '%s'" %
+            (data['generation'], file_name))
+    tmp_file = '%s.%d.tmp' % (file_name, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.rename(tmp_file, file_name)
+
+
+class SpecChanges(object):
+    """
+    Names of the OUs and policies whose spec changed since the last
+    applied record.  An OU is changed when its own settings, its child
+    OU names or its parent changed.  Subtrees with an unchanged digest
+    are not descended into.
+    """
+    def __init__(self, org_spec, hashes, record):
+        self.generation = record['generation']
+        self.policies = set(name for name, digest in
+                hashes['policies'].items()
+                if record['policies'].get(name) != digest)
+        self.ou = set()
+        self._find_ou(org_spec['organizational_units'], hashes['ou'],
+                record['ou'])
+
+    def _find_ou(self, ou_spec_list, hashes, known):
+        for ou_spec in ou_spec_list or []:
+            name = ou_spec['Name']
+            known_ou = known.get(name) or {}
+            if known_ou.get('subtree') == hashes[name]['subtree']:
+                continue
+            if known_ou.get('node') != hashes[name]['node']:
+                self.ou.add(name)
+            self._find_ou(ou_spec.get('Child_OU'), hashes, known)
+
+    def __bool__(self):
+        return bool(self.ou or self.policies)
+    __nonzero__ = __bool__
+
+    def prune(self, org_spec, keep_ou=()):
+        """
+        Return a copy of 'org_spec' holding only the changed policies and
+        the OU subtrees with changes, plus the path to the OUs in
+        'keep_ou'.  Unchanged OUs are kept where they lead to a change.
+        """
+        keep = self.ou.union(keep_ou)
+        def prune_ou(ou_spec):
+            children = [c for c in (prune_ou(child)
+                    for child in ou_spec.get('Child_OU') or []) if c]
+            if not children and ou_spec['Name'] not in keep:
+                return None
+            pruned = dict(ou_spec)
+            pruned['Child_OU'] = children
+            return pruned
+        pruned_spec = dict(org_spec)
+        pruned_spec['organizational_units'] = [ou for ou in (prune_ou(ou_spec)
+                for ou_spec in org_spec['organizational_units']) if ou]
+        pruned_spec['sc_policies'] = [p_spec for p_spec in
+                org_spec['sc_policies'] if p_spec['Name'] in self.policies]
+        return pruned_spec
+
+
+def find_changes(log, spec_files, hashes, record, org_spec):
+    """
+    Compare 'hashes' of 'org_spec' to the last-applied 'record'.  Return
+    SpecChanges, or None when a full pass is needed: there is no record,
+    it was written for other spec files, a global setting changed or an
+    OU changed its parent.
+    """
+    if record is None:
+        log.info("No last-applied record. Running a full pass")
+        return None
+    if record['spec_files'] != sorted(set(os.path.abspath(f)
+            for f in spec_files)):
+        log.info("Last-applied record is for other spec files. Running a "
+                "full pass")
+        return None
+    if record['settings'] != hashes['settings']:
+        log.info("Global spec settings changed. Running a full pass")
+        return None
+    for name, ou_hashes in hashes['ou'].items():
+        known = record['ou'].get(name)
+        if known and known['parent'] != ou_hashes['parent']:
+            log.info("OU '%s' changed its parent. Running a full pass" % name)
+            return None
+    return SpecChanges(org_spec, hashes, record)
+
+
+def get_partial_snapshot(log, org_client, org_spec, changes, record,
+        max_workers=CRAWL_WORKERS):
+    """
+    Query only the parts of the deployed AWS Organization needed to
+    reconcile pruned spec 'org_spec'.  The OU tree is crawled along the
+    OUs in the pruned spec.  Accounts are listed in changed OUs only.
+    Accounts the changed OUs should contain are looked up by the Id kept
+    in 'record', falling back to listing all accounts for accounts not
+    in the record.  Return an OrgSnapshot of what was found.
+    """
+    log.debug('running')
+    roots = org_client.list_roots()['Roots']
+    if len(roots) > 1:
+        raise RuntimeError("org_client.list_roots returned multiple roots.")
+    root = roots[0]
+    master_account_id = org_client.describe_organization(
+            )['Organization']['MasterAccountId']
+    deployed_root = dict(Name='root', Id=root['Id'])
+    deployed_ou = [deployed_root]
+    accounts = {}
+    account_parents = {}
+    level = [(deployed_root, ou_spec)
+            for ou_spec in org_spec['organizational_units']
+            if ou_spec['Name'] == 'root']
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while level:
+            child_ou_futures = [executor.submit(paginate,
+                    org_client.list_organizational_units_for_parent,
+                    'OrganizationalUnits', ParentId=ou['Id'])
+                    for ou, ou_spec in level]
+            accounts_futures = [executor.submit(paginate,
+                    org_client.list_accounts_for_parent, 'Accounts',
+                    ParentId=ou['Id']) if ou_spec['Name'] in changes.ou
+                    else None for ou, ou_spec in level]
+            next_level = []
+            for (parent, ou_spec), child_ou_future, accounts_future in zip(
+                    level, child_ou_futures, accounts_futures):
+                child_ou = child_ou_future.result()
+                parent['Child_OU'] = [ou['Name'] for ou in child_ou if 'Name' in ou]
+                for ou in child_ou:
+                    ou['ParentId'] = parent['Id']
+                deployed_ou += child_ou
+                if accounts_future is not None:
+                    found = accounts_future.result()
+                    parent['Accounts'] = [acc['Name'] for acc in found if 'Name' in acc]
+                    for acc in found:
+                        accounts[acc['Name']] = acc
+                        account_parents[acc['Id']] = parent['Id']
+                by_name = dict((ou['Name'], ou) for ou in child_ou)
+                for child_spec in ou_spec['Child_OU']:
+                    if child_spec['Name'] in by_name:
+                        next_level.append((by_name[child_spec['Name']],
+                                child_spec))
+            level = next_level
+        # accounts changed OUs should contain but do not yet
+        wanted = set()
+        def collect(ou_spec_list):
+            for ou_spec in ou_spec_list:
+                if ou_spec['Name'] in changes.ou:
+                    wanted.update(ou_spec.get('Accounts') or [])
+                collect(ou_spec['Child_OU'])
+        collect(org_spec['organizational_units'])
+        wanted.difference_update(accounts)
+        account_ids = dict((name, record['accounts'][name])
+                for name in wanted if name in record['accounts'])
+        if wanted.difference(account_ids):
+            for acc in get_deployed_accounts(log, org_client):
+                if acc['Name'] in wanted:
+                    account_ids[acc['Name']] = acc['Id']
+        def parent_of(account_id):
+            try:
+                return org_client.list_parents(ChildId=account_id)['Parents'][0]['Id']
+            except Exception as e:
+                if error_code(e) is None:
+                    raise
+                return None
+        names = sorted(account_ids)
+        for name, parent_id in zip(names, executor.map(parent_of,
+                [account_ids[name] for name in names])):
+            if parent_id:
+                accounts[name] = dict(Name=name, Id=account_ids[name])
+                account_parents[account_ids[name]] = parent_id
+    return OrgSnapshot(root, master_account_id,
+            accounts=list(accounts.values()),
+            ou=deployed_ou,
+            policies=paginate(org_client.list_policies, 'Policies',
+                    Filter='SERVICE_CONTROL_POLICY'),
+            parents=account_parents)
+
+
+def get_partial_inventory(log, org_client, org_spec, changes, record):
+    """
+    Return (snapshot, policy_store, attachment_index) for an incremental
+    pass over pruned spec 'org_spec'.  Only the documents of changed
+    policies are downloaded.
+    """
+    snapshot = get_partial_snapshot(log, org_client, org_spec, changes,
+            record)
+    policy_store = PolicyStore().fetch(org_client, [p['Id']
+            for p in snapshot.policies if p['Name'] in changes.policies])
+    return snapshot, policy_store, get_attachment_index(org_client, snapshot)
@@ -0,0 +1,476 @@
+"""Indexed inventory of a deployed AWS Organization """
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from records import account_records, intern_id, ou_records, policy_records
+from utils import (CRAWL_WORKERS, get_deployed_accounts, get_deployed_ou,
+        get_deployed_policies, paginate)
+
+
+class DeployedIndex(object):
+    """
+    Read-only table of deployed resources (list of records or
+    dictionaries) with hash indexes on 'Name' and 'Id'.  AWS allows
+    several accounts, or OUs under different parents, to share a name.
+    Duplicate names are found when the index is built and only looking
+    one up is an error.
+    """
+    def __init__(self, kind, items):
+        self._kind = kind
+        self._items = tuple(items)
+        self._by_name = {}
+        self._by_id = {}
+        self._duplicates = set()
+        for item in self._items:
+            if 'Name' in item:
+                if item['Name'] in self._by_name:
+                    self._duplicates.add(item['Name'])
+                self._by_name[item['Name']] = item
+            if 'Id' in item:
+                self._by_id[item['Id']] = item
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def names(self):
+        """
+        Return list of names of all indexed items.
+        """
+        return [item['Name'] for item in self._items if 'Name' in item]
+
+    def by_name(self, name, rkey=None):
+        """
+        Return the item named 'name' or None.  If rkey is provided,
+        return the value referenced by rkey or None.  Raise RuntimeError
+        if several items are named 'name'.
+        """
+        if name in self._duplicates:
+            raise RuntimeError("Data Error: %s name '%s' matches multiple "
+                    "items in deployed organization" % (self._kind, name))
+        return _select(self._by_name.get(name), rkey)
+
+    def by_id(self, item_id, rkey=None):
+        """
+        Return the item with Id 'item_id' or None.  If rkey is provided,
+        return the value referenced by rkey or None.
+        """
+        return _select(self._by_id.get(item_id), rkey)
+
+    def parent(self, item, rkey=None):
+        """
+        Return the item at position 'parent' of record 'item' or None.
+        If rkey is provided, return the value referenced by rkey or None.
+        """
+        position = item.get('parent', -1)
+        return _select(self._items[position] if position >= 0 else None,
+                rkey)
+
+
+def _select(item, rkey):
+    if item is None or not rkey:
+        return item
+    return item.get(rkey)
+
+
+class ParentIndex(object):
+    """
+    Mapping of account Id to the Id of its parent root or OU, built
+    during the OU crawl.  Each parent Id is stored once and accounts
+    refer to it by its position in the table of parents.  Unlike the
+    rest of the snapshot this index is updated in place as accounts are
+    moved.
+    """
+    def __init__(self, account_parents=None):
+        self._parent_ids = []
+        self._positions = {}
+        self._parent = {}
+        self._children = {}
+        for account_id, parent_id in (account_parents or {}).items():
+            self._place(intern_id(account_id), self._position(parent_id))
+
+    def _position(self, parent_id):
+        position = self._positions.get(parent_id)
+        if position is None:
+            position = self._positions[parent_id] = len(self._parent_ids)
+            self._parent_ids.append(intern_id(parent_id))
+        return position
+
+    def _place(self, account_id, position):
+        self._parent[account_id] = position
+        self._children.setdefault(position, set()).add(account_id)
+
+    def __contains__(self, account_id):
+        return account_id in self._parent
+
+    def parent_of(self, account_id):
+        """
+        Return the Id of the parent of 'account_id' or None.
+        """
+        position = self._parent.get(account_id)
+        return None if position is None else self._parent_ids[position]
+
+    def accounts_in(self, parent_id):
+        """
+        Return set of Ids of accounts contained by 'parent_id'.
+        """
+        return set(self._children.get(self._positions.get(parent_id), ()))
+
+    def record_move(self, account_id, parent_id):
+        """
+        Update the index after a successful 'move_account' call.
+        """
+        source = self._parent.get(account_id)
+        if source is not None:
+            self._children[source].discard(account_id)
+        self._place(intern_id(account_id), self._position(parent_id))
+
+
+class OrgSnapshot(object):
+    """
+    Immutable, indexed view of a deployed AWS Organization.  Build it once
+    per run with get_org_snapshot() and resolve all names and Ids through
+    its 'accounts', 'ou' and 'policies' indexes.  Account placement is
+    tracked by the 'parents' index.  Deployed resources are kept as
+    compact records (see records.py); OUs refer to their parent by
+    position in 'ou'.
+    """
+    __slots__ = ('_root', '_master_account_id', '_accounts', '_ou',
+            '_policies', '_parents')
+
+    def __init__(self, root, master_account_id, accounts, ou, policies,
+            parents=None):
+        if not isinstance(parents, ParentIndex):
+            parents = ParentIndex(parents)
+        for name, value in (
+                ('_root', dict(root)),
+                ('_master_account_id', master_account_id),
+                ('_accounts', _as_index('account', accounts,
+                        account_records)),
+                ('_ou', _as_index('organizational unit', ou, ou_records)),
+                ('_policies', _as_index('policy', policies, policy_records)),
+                ('_parents', parents)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("OrgSnapshot is immutable")
+
+    @property
+    def root(self):
+        return dict(self._root)
+
+    @property
+    def root_id(self):
+        return self._root['Id']
+
+    @property
+    def master_account_id(self):
+        return self._master_account_id
+
+    @property
+    def accounts(self):
+        return self._accounts
+
+    @property
+    def ou(self):
+        return self._ou
+
+    @property
+    def policies(self):
+        return self._policies
+
+    @property
+    def parents(self):
+        return self._parents
+
+
+def _as_index(kind, items, records):
+    if isinstance(items, DeployedIndex):
+        return items
+    return DeployedIndex(kind, records(items))
+
+
+def get_org_snapshot(log, org_client, accounts_only=False):
+    """
+    Query deployed AWS Organization once and return an OrgSnapshot.  Set
+    'accounts_only' to skip crawling the OU tree and listing policies.
+    """
+    log.debug('running')
+    roots = org_client.list_roots()['Roots']
+    if len(roots) > 1:
+        raise RuntimeError("org_client.list_roots returned multiple roots.")
+    root = roots[0]
+    master_account_id = org_client.describe_organization(
+            )['Organization']['MasterAccountId']
+    if accounts_only:
+        return OrgSnapshot(root, master_account_id,
+                accounts=get_deployed_accounts(log, org_client),
+                ou=[], policies=[])
+    account_parents = {}
+    deployed_ou = get_deployed_ou(org_client, root['Id'], account_parents)
+    return OrgSnapshot(root, master_account_id,
+            accounts=get_deployed_accounts(log, org_client),
+            ou=deployed_ou,
+            policies=get_deployed_policies(org_client),
+            parents=account_parents)
+
+
+def get_placement_snapshot(org_client, root, master_account_id):
+    """
+    Like get_org_snapshot() for an organization whose 'root' and
+    'master_account_id' are already known.  Accounts are collected by
+    the OU crawl instead of calling list_accounts.
+    """
+    account_parents = {}
+    accounts = []
+    deployed_ou = get_deployed_ou(org_client, root['Id'], account_parents,
+            deployed_accounts=accounts)
+    return OrgSnapshot(root, master_account_id,
+            accounts=accounts,
+            ou=deployed_ou,
+            policies=get_deployed_policies(org_client),
+            parents=account_parents)
+
+
+def canonical_json(document):
+    """
+    Serialize 'document' with sorted keys and no whitespace, so equal
+    documents always produce the same string.
+    """
+    return json.dumps(document, sort_keys=True, separators=(',', ':'))
+
+
+def policy_digest(document):
+    """
+    Return sha256 hex digest of the canonical JSON of a policy document.
+    'document' may be a parsed document or its JSON text.
+    """
+    if not isinstance(document, dict):
+        document = json.loads(document)
+    return hashlib.sha256(canonical_json(document).encode('utf-8')).hexdigest()
+
+
+class PolicyStore(object):
+    """
+    Content of deployed Service Control Policies.  Documents are fetched
+    concurrently, at most once per run, and stored by the digest of their
+    canonical JSON.  Shared by reporting and reconciliation.
+    """
+    def __init__(self):
+        self._digest = {}
+        self._documents = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, policy_id):
+        return policy_id in self._digest
+
+    def add(self, policy_id, content):
+        """
+        Store JSON text 'content' of policy 'policy_id'.
+        """
+        document = json.loads(content)
+        digest = policy_digest(document)
+        with self._lock:
+            self._documents.setdefault(digest, document)
+            self._digest[policy_id] = digest
+
+    def fetch(self, org_client, policy_ids, max_workers=CRAWL_WORKERS):
+        """
+        Download all documents of 'policy_ids' not yet in the store.
+        """
+        missing = [p_id for p_id in policy_ids if p_id not in self]
+        def describe(policy_id):
+            self.add(policy_id, org_client.describe_policy(
+                    PolicyId=policy_id)['Policy']['Content'])
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(describe, missing))
+        return self
+
+    def discard(self, policy_id):
+        """
+        Forget the document of 'policy_id', so the next fetch() downloads
+        it again.
+        """
+        with self._lock:
+            self._digest.pop(policy_id, None)
+
+    def digest(self, policy_id):
+        return self._digest.get(policy_id)
+
+    def document(self, policy_id):
+        """
+        Return parsed policy document of 'policy_id' or None.
+        """
+        return self._documents.get(self._digest.get(policy_id))
+
+    def content(self, policy_id):
+        """
+        Return canonical JSON text of policy 'policy_id' or None.
+        """
+        if policy_id not in self:
+            return None
+        return canonical_json(self.document(policy_id))
+
+
+def get_policy_store(org_client, snapshot):
+    """
+    Return a PolicyStore holding the documents of all policies in
+    'snapshot'.
+    """
+    return PolicyStore().fetch(org_client, [p['Id'] for p in snapshot.policies])
+
+
+def state_fingerprint(snapshot, attachment_index, policy_store):
+    """
+    Return dict of digests of the deployed state.  One per OU, keyed
+    'ou:<Id>', covers its child OUs, its accounts and its attached
+    policies.  One per policy, keyed 'policy:<Id>', covers its name,
+    description and, when in 'policy_store', its content.
+    """
+    def digest(value):
+        return hashlib.sha256(canonical_json(value).encode('utf-8')).hexdigest()
+    children = {}
+    for ou in snapshot.ou:
+        parent_id = snapshot.ou.parent(ou, 'Id')
+        if parent_id:
+            children.setdefault(parent_id, []).append([ou['Id'], ou['Name']])
+    fingerprint = {}
+    for ou in snapshot.ou:
+        fingerprint['ou:%s' % ou['Id']] = digest([ou['Name'],
+                sorted(children.get(ou['Id'], [])),
+                sorted([a_id, snapshot.accounts.by_id(a_id, 'Name')]
+                        for a_id in snapshot.parents.accounts_in(ou['Id'])),
+                sorted(attachment_index.policies_for(ou['Id']))])
+    for policy in snapshot.policies:
+        fingerprint['policy:%s' % policy['Id']] = digest([policy['Name'],
+                policy.get('Description'), policy_store.digest(policy['Id'])])
+    return fingerprint
+
+
+class AttachmentIndex(object):
+    """
+    Service Control Policy attachments indexed both ways: target Id to
+    policy Ids and policy Id to target Ids.  'complete' is False when the
+    index was built per OU and so does not cover accounts as targets.
+    """
+    def __init__(self, complete=True):
+        self.complete = complete
+        self._policies = {}
+        self._targets = {}
+        self._lock = threading.Lock()
+
+    def add(self, policy_id, target_id):
+        with self._lock:
+            self._policies.setdefault(target_id, set()).add(policy_id)
+            self._targets.setdefault(policy_id, set()).add(target_id)
+
+    def set_targets(self, policy_id, target_ids):
+        """
+        Replace the targets of 'policy_id' with 'target_ids'.
+        """
+        with self._lock:
+            for target_id in self._targets.pop(policy_id, ()):
+                self._policies[target_id].discard(policy_id)
+        for target_id in target_ids:
+            self.add(policy_id, target_id)
+
+    def set_policies(self, target_id, policy_ids):
+        """
+        Replace the policies attached to 'target_id' with 'policy_ids'.
+        """
+        with self._lock:
+            for policy_id in self._policies.pop(target_id, ()):
+                self._targets[policy_id].discard(target_id)
+        for policy_id in policy_ids:
+            self.add(policy_id, target_id)
+
+    def policies_for(self, target_id):
+        """
+        Return set of Ids of policies attached to 'target_id'.
+        """
+        return set(self._policies.get(target_id, ()))
+
+    def targets_for(self, policy_id):
+        """
+        Return set of Ids of targets 'policy_id' is attached to.
+        """
+        return set(self._targets.get(policy_id, ()))
+
+
+def get_attachment_index(org_client, snapshot, complete=False,
+        max_workers=CRAWL_WORKERS):
+    """
+    Build an AttachmentIndex for the policies and OUs in 'snapshot'.
+    Query list_targets_for_policy once per policy or
+    list_policies_for_target once per OU, whichever takes fewer calls.
+    Set 'complete' to always query per policy, which also covers
+    policies attached directly to accounts.
+    """
+    policy_ids = [p['Id'] for p in snapshot.policies]
+    target_ids = [ou['Id'] for ou in snapshot.ou]
+    by_policy = complete or len(policy_ids) <= len(target_ids)
+    index = AttachmentIndex(complete=by_policy)
+    def index_policy(policy_id):
+        for target in paginate(org_client.list_targets_for_policy, 'Targets',
+                PolicyId=policy_id):
+            index.add(policy_id, target['TargetId'])
+    def index_target(target_id):
+        for policy in paginate(org_client.list_policies_for_target,
+                'Policies', TargetId=target_id,
+                Filter='SERVICE_CONTROL_POLICY'):
+            index.add(policy['Id'], target_id)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if by_policy:
+            list(executor.map(index_policy, policy_ids))
+        else:
+            list(executor.map(index_target, target_ids))
+    return index
+
+
+def refresh_inventory(org_client, previous, snapshot, policy_store,
+        attachment_index, policy_ids, max_workers=CRAWL_WORKERS):
+    """
+    Bring 'policy_store' and 'attachment_index', built for snapshot
+    'previous', up to date for the newer 'snapshot'.  The policies in
+    'policy_ids' get their targets listed and their document downloaded
+    again, so attachments and edits of those are always seen.  Other
+    policies only get their targets listed again if they are new or
+    their name or description changed.  New OUs get their policies
+    listed.  Removed policies and OUs are dropped.  Returns the number
+    of policies and OUs scanned.
+    """
+    changed_policies = set(p['Id'] for p in snapshot.policies
+            if (p['Name'], p.get('Description')) != (previous.policies.by_id(
+                    p['Id'], 'Name'), previous.policies.by_id(p['Id'],
+                    'Description')))
+    scanned_policies = sorted(changed_policies.union(policy_ids))
+    new_ou = [ou['Id'] for ou in snapshot.ou if not previous.ou.by_id(ou['Id'])]
+    for policy in previous.policies:
+        if not snapshot.policies.by_id(policy['Id']):
+            policy_store.discard(policy['Id'])
+            attachment_index.set_targets(policy['Id'], [])
+    for ou in previous.ou:
+        if not snapshot.ou.by_id(ou['Id']):
+            attachment_index.set_policies(ou['Id'], [])
+    def scan_policy(policy_id):
+        attachment_index.set_targets(policy_id, [t['TargetId'] for t in
+                paginate(org_client.list_targets_for_policy, 'Targets',
+                        PolicyId=policy_id)])
+    def scan_target(target_id):
+        attachment_index.set_policies(target_id, [p['Id'] for p in
+                paginate(org_client.list_policies_for_target, 'Policies',
+                        TargetId=target_id, Filter='SERVICE_CONTROL_POLICY')])
+    for policy_id in scanned_policies:
+        policy_store.discard(policy_id)
+    policy_store.fetch(org_client, policy_ids, max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(scan_policy, scanned_policies))
+        list(executor.map(scan_target, new_ou))
+    return len(scanned_policies) + len(new_ou)
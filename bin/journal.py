@@ -0,0 +1,314 @@
+"""Append-only journal of the writes of --exec runs, for resuming them """
+import json
+import os
+import threading
+import time
+
+from orgclient import error_code
+from plan import Operation, Plan
+from utils import paginate
+
+JOURNAL_VERSION = 1
+# the journal is kept next to the first spec file
+JOURNAL_SUFFIX = '.journal.jsonl'
+# where the Id of the created resource is found in a create response
+RESULT_PATHS = dict(
+    create_organizational_unit = ('OrganizationalUnit', 'Id'),
+    create_policy = ('Policy', 'PolicySummary', 'Id'),
+)
+
+
+def journal_file(spec_files):
+    """
+    Return the name of the journal for a run with 'spec_files'.
+    """
+    return spec_files[0].rstrip(os.sep) + JOURNAL_SUFFIX
+
+
+class Journal(object):
+    """
+    Append-only journal in 'file_name'.  A run starts with a 'begin'
+    entry naming its kind and a digest of its spec and ends with an
+    'end' entry.  Every entry is flushed to disk before the write it
+    announces is made, so a run that dies leaves a journal telling which
+    writes completed and which are uncertain.  Starting a new run
+    replaces the journal of a finished one.
+    """
+    def __init__(self, log, file_name):
+        self.log = log
+        self.file_name = file_name
+        self._lock = threading.Lock()
+        self._file = None
+
+    def load(self):
+        """
+        Return list of entries in the journal.  A last line cut short by
+        the death of the writer is ignored.
+        """
+        entries = []
+        try:
+            with open(self.file_name) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break
+        except (IOError, OSError):
+            return []
+        return entries
+
+    def interrupted(self, kind, digest):
+        """
+        Return the entries of the unfinished run of 'kind' for spec
+        'digest', or None if the last run finished or was for something
+        else.
+        """
+        entries = self.load()
+        begins = [i for i, e in enumerate(entries) if e['event'] == 'begin']
+        if not begins:
+            return None
+        run = entries[begins[-1]:]
+        begin = run[0]
+        if run[-1]['event'] == 'end' or begin.get('version') != JOURNAL_VERSION:
+            return None
+        if begin['kind'] != kind or begin['digest'] != digest:
+            self.log.info("Ignoring interrupted %s run in journal '%s' for "
+                    "another spec" % (begin['kind'], self.file_name))
+            return None
+        return run
+
+    def begin(self, kind, digest, **fields):
+        """
+        Start the journal of a new run, dropping earlier runs.
+        """
+        self.log.debug("starting journal '%s'" % self.file_name)
+        self._file = open(self.file_name, 'w')
+        self.append('begin', version=JOURNAL_VERSION, kind=kind, digest=digest,
+                **fields)
+
+    def resume(self):
+        """
+        Continue the journal of the interrupted run.
+        """
+        self._file = open(self.file_name, 'a')
+        self.append('resume')
+
+    def append(self, event, **fields):
+        self.extend([dict(fields, event=event)])
+
+    def extend(self, entries):
+        """
+        Append 'entries' and sync them to disk.
+        """
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        data = ''.join(json.dumps(dict(e, time=stamp), sort_keys=True) + '\n'
+                for e in entries)
+        with self._lock:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def end(self):
+        self.append('end')
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def latest(entries, event, key):
+    """
+    Return dict of the entries of 'event' keyed by field 'key'.  Fields
+    of later entries for the same key update earlier ones.
+    """
+    found = {}
+    for entry in entries:
+        if entry['event'] == event:
+            found.setdefault(entry[key], {}).update(entry)
+    return found
+
+
+def journal_plan(journal, plan, **fields):
+    """
+    Begin an 'organization' run in 'journal' with every op of 'plan' and
+    make the plan record the progress of its ops there.  Ops get unique
+    keys from their descriptions.  References to ops creating resources
+    are journaled as {"$ref": key}.
+    """
+    keys = {}
+    used = set()
+    entries = []
+    for level in plan.levels():
+        for op in level:
+            key = op.describe()
+            if key in used:
+                key = '%s #%d' % (key, len(used))
+            used.add(key)
+            keys[op] = op.key = key
+            entries.append(dict(event='op', key=key, action=op.action,
+                    params=ref_params(op, keys), status='planned',
+                    deps=[keys[d] for d in op.deps]))
+    journal.begin('organization', **fields)
+    journal.extend(entries)
+    plan.journal = journal
+
+
+def ref_params(op, keys):
+    """
+    Return params() of 'op' with the Ids its dependencies will create
+    replaced by references to their keys.
+    """
+    saved = [(d, d.result) for d in op.deps]
+    for d in op.deps:
+        d.result = {'$ref': keys[d]}
+    try:
+        return op.params()
+    finally:
+        for d, result in saved:
+            d.result = result
+
+
+class JournalOp(Operation):
+    """
+    Operation rebuilt from its journal entry.  References to other ops
+    are resolved from their results when the op is applied.
+    """
+    def __init__(self, entry, refs):
+        Operation.__init__(self)
+        self.key = entry['key']
+        self.action = entry['action']
+        self.template = entry['params']
+        self.result = entry.get('result')
+        self.refs = refs
+
+    def describe(self):
+        return self.key
+
+    def params(self):
+        params = {}
+        for name, value in self.template.items():
+            if isinstance(value, dict) and '$ref' in value:
+                ref = self.refs[value['$ref']]
+                value = ref.result if isinstance(ref, Operation) else ref
+            params[name] = value
+        return params
+
+    def handle(self, response):
+        path = RESULT_PATHS.get(self.action)
+        if path:
+            for step in path:
+                response = response[step]
+            self.result = response
+
+
+def resume_plan(entries):
+    """
+    Return (plan, uncertain) rebuilt from the journal 'entries' of an
+    interrupted run.  The plan holds the ops not known to be done, in
+    their original order and with their dependencies.  'uncertain' lists
+    the ops that were started but not seen to finish.
+    """
+    ops = latest(entries, 'op', 'key')
+    refs = {}
+    plan = Plan(None)
+    uncertain = []
+    for entry in entries:
+        if entry['event'] != 'op' or entry['key'] in refs:
+            continue
+        state = ops[entry['key']]
+        if state['status'] == 'done':
+            refs[entry['key']] = state.get('result')
+            continue
+        op = JournalOp(state, refs)
+        op.depends_on(*[refs[d] for d in state['deps']
+                if isinstance(refs[d], Operation)])
+        refs[op.key] = op
+        plan.add(op)
+        if state['status'] == 'started':
+            uncertain.append(op)
+    return plan, uncertain
+
+
+def _in_paginated(api_call, result_key, name=None, **kwargs):
+    """
+    Return the item listed by 'api_call' with Name 'name', or with Id
+    'kwargs[Id]', or None.
+    """
+    item_id = kwargs.pop('Id', None)
+    for item in paginate(api_call, result_key, **kwargs):
+        if name and item.get('Name') == name:
+            return item
+        if item_id and item['Id'] == item_id:
+            return item
+    return None
+
+
+def _not_found(api_call, **kwargs):
+    try:
+        api_call(**kwargs)
+    except Exception as e:
+        if error_code(e) is None or not error_code(e).endswith('NotFoundException'):
+            raise
+        return True
+    return False
+
+
+def is_done(org_client, action, params):
+    """
+    Ask the AWS Organization whether the write 'action' with 'params'
+    took effect.  Return (done, Id of the created resource).
+    """
+    if action == 'move_account':
+        parents = org_client.list_parents(ChildId=params['AccountId'])['Parents']
+        return parents[0]['Id'] == params['DestinationParentId'], None
+    if action in ('attach_policy', 'detach_policy'):
+        attached = _in_paginated(org_client.list_policies_for_target,
+                'Policies', TargetId=params['TargetId'],
+                Filter='SERVICE_CONTROL_POLICY', Id=params['PolicyId'])
+        return (attached is not None) == (action == 'attach_policy'), None
+    if action == 'create_organizational_unit':
+        ou = _in_paginated(org_client.list_organizational_units_for_parent,
+                'OrganizationalUnits', name=params['Name'],
+                ParentId=params['ParentId'])
+        return ou is not None, ou and ou['Id']
+    if action == 'create_policy':
+        policy = _in_paginated(org_client.list_policies, 'Policies',
+                name=params['Name'], Filter='SERVICE_CONTROL_POLICY')
+        return policy is not None, policy and policy['Id']
+    if action == 'update_policy':
+        policy = org_client.describe_policy(PolicyId=params['PolicyId'])['Policy']
+        return (policy['Content'] == params['Content'] and policy[
+                'PolicySummary'].get('Description') == params['Description'],
+                None)
+    if action == 'delete_policy':
+        return _not_found(org_client.describe_policy,
+                PolicyId=params['PolicyId']), None
+    if action == 'delete_organizational_unit':
+        return _not_found(org_client.describe_organizational_unit,
+                OrganizationalUnitId=params['OrganizationalUnitId']), None
+    return False, None
+
+
+def verify_uncertain(log, org_client, journal, plan, uncertain):
+    """
+    Check each op in 'uncertain' against the AWS Organization.  Ops that
+    took effect are journaled done and dropped from 'plan'.  The others
+    stay in it to be applied again.
+    """
+    for op in uncertain:
+        done, result = is_done(org_client, op.action, op.params())
+        if done:
+            log.info("Completed by the interrupted run: %s" % op.describe())
+            op.result = result
+            op.finish('APPLIED')
+            journal.append('op', key=op.key, status='done', result=result)
+            plan.ops.remove(op)
+            op.refs[op.key] = result
+            for other in plan.ops:
+                if op in other.deps:
+                    other.deps.remove(op)
+        else:
+            log.info("Not completed by the interrupted run: %s" %
+                    op.describe())
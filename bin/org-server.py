@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+"""Warm process server for the AWS Organization management scripts.
+
+Usage:
+  org-server serve [--socket FILE] [--cache-ttl N] [-vd]
+  org-server stop [--socket FILE]
+  org-server [--socket FILE] run <script> [<args>...]
+  org-server (-h | --help)
+
+Modes of operation:
+  serve          Listen on a unix socket and run the scripts sent by
+                 'run' in this process.  Imports, AWS clients and their
+                 credentials stay loaded between runs.  Runs are served
+                 one at a time.
+  stop           Stop the server.
+  run            Run <script> with <args> in the server and relay its
+                 output and exit status.  Relative paths are resolved in
+                 the current directory.  Runs the script locally if no
+                 server is listening.  Options of org-server go before
+                 'run'; everything after <script> is passed to it.
+
+Options:
+  -h, --help                 Show this help message and exit.
+  --socket FILE              Unix socket of the server.  Defaults to
+                             $ORG_SERVER_SOCKET or
+                             ~/.cache/aws-org-manager/server.sock.
+  --cache-ttl N              Seconds a deployed Organization inventory is
+                             reused by read-only runs.  Runs with --exec,
+                             --save-snapshot or --from-snapshot never use
+                             it, and a run with --exec clears it.  0
+                             disables the cache. [default: 60]
+  -v, --verbose              Log to activity to STDOUT at log level INFO.
+  -d, --debug                Increase log level to 'DEBUG'. Implies '--verbose'.
+
+Example:
+  org-server.py serve &
+  org-server.py run organization-manager.py organization -s org-spec.yaml
+
+"""
+
+# the client side must stay cheap to start, so only the standard library
+# and docopt are imported here.  The server imports the scripts it runs.
+import json
+import os
+import socket
+import sys
+from docopt import docopt
+
+SOCKET_FILE = os.environ.get('ORG_SERVER_SOCKET',
+        os.path.join(os.path.expanduser('~'), '.cache', 'aws-org-manager',
+                'server.sock'))
+# scripts the server runs
+SCRIPTS = ('account-manager.py', 'organization-manager.py',
+        'spec-generator.py')
+# script options that must see the deployed Organization as it is now
+UNCACHED_OPTIONS = ('--exec', '--save-snapshot', '--from-snapshot')
+
+
+def send_message(f, **message):
+    f.write((json.dumps(message) + '\n').encode('utf-8'))
+    f.flush()
+
+
+def run_local(script, argv):
+    """
+    Replace this process with a local run of 'script'.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    os.execv(sys.executable, [sys.executable, path] + argv)
+
+
+def run_remote(socket_file, script, argv):
+    """
+    Send 'script' and 'argv' to the server on 'socket_file' and relay its
+    output.  Return the exit status of the run.
+    """
+    script = os.path.basename(script)
+    if script not in SCRIPTS:
+        sys.stderr.write("Unknown script '%s'. Use one of: %s\n" %
+                (script, ', '.join(SCRIPTS)))
+        return 1
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_file)
+    except socket.error:
+        sock.close()
+        run_local(script, argv)
+    try:
+        f = sock.makefile('rwb')
+        send_message(f, script=script, argv=argv, cwd=os.getcwd())
+        for line in f:
+            message = json.loads(line.decode('utf-8'))
+            if 'exit' in message:
+                return message['exit']
+            stream = sys.stdout if 'stdout' in message else sys.stderr
+            stream.write(message.get('stdout', message.get('stderr')))
+            stream.flush()
+    finally:
+        sock.close()
+    sys.stderr.write("Connection to org-server on '%s' was lost\n" %
+            socket_file)
+    return 1
+
+
+def stop_server(socket_file):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_file)
+    except socket.error:
+        sys.stderr.write("No org-server listening on '%s'\n" % socket_file)
+        return 1
+    f = sock.makefile('rwb')
+    send_message(f, stop=True)
+    f.readline()
+    sock.close()
+    return 0
+
+
+class StreamRelay(object):
+    """
+    File-like object sending everything written to it to the client as
+    messages for output stream 'name'.  Thread safe, as scripts log from
+    worker threads.
+    """
+    def __init__(self, f, name, lock):
+        self.f = f
+        self.name = name
+        self.lock = lock
+
+    def write(self, data):
+        if data:
+            with self.lock:
+                send_message(self.f, **{self.name: data})
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class RunCallbacks(object):
+    """
+    Stand-in for the atexit module of a script run by the server.
+    Callbacks run when the script returns, not when the server exits.
+    """
+    def __init__(self):
+        self.callbacks = []
+
+    def register(self, func, *args, **kwargs):
+        self.callbacks.append((func, args, kwargs))
+        return func
+
+    def run(self):
+        while self.callbacks:
+            func, args, kwargs = self.callbacks.pop()
+            func(*args, **kwargs)
+
+
+class InventoryCache(object):
+    """
+    Results of the inventory functions of the scripts, reused for 'ttl'
+    seconds by read-only runs.  Results derived from a snapshot are
+    keyed by that snapshot, so they expire with it.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.enabled = False
+        self._entries = {}
+
+    def clear(self):
+        self._entries.clear()
+
+    def wrap(self, func):
+        import time
+        from inventory import OrgSnapshot
+        def cached(*args, **kwargs):
+            if not (self.enabled and self.ttl):
+                return func(*args, **kwargs)
+            key = (func.__name__, tuple(id(a) for a in args
+                    if isinstance(a, OrgSnapshot)),
+                    tuple(sorted(kwargs.items())))
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                entry = (time.time(), func(*args, **kwargs))
+                self._entries[key] = entry
+            return entry[1]
+        cached.__name__ = func.__name__
+        return cached
+
+
+class OrgServer(object):
+    """
+    Runs the main() of the scripts for clients connecting to a unix
+    socket.  Each script is imported once.  The scripts get their AWS
+    clients from orgclient, which keeps them for the life of the process.
+    """
+    INVENTORY_FUNCTIONS = ('get_org_snapshot', 'get_policy_store',
+            'get_attachment_index')
+
+    def __init__(self, log, socket_file, cache_ttl):
+        self.log = log
+        self.socket_file = socket_file
+        self.cache = InventoryCache(cache_ttl)
+        self.stopped = False
+        self._args = {}
+        self._installed = set()
+
+    def install(self, script):
+        """
+        Route the docopt and inventory calls of 'script' through the
+        server, once per script module.
+        """
+        if script.__name__ in self._installed:
+            return
+        parse = script.docopt
+        def parse_args(*args, **kwargs):
+            self._args = parse(*args, **kwargs)
+            self.cache.enabled = not any(self._args.get(option)
+                    for option in UNCACHED_OPTIONS)
+            return self._args
+        script.docopt = parse_args
+        for name in self.INVENTORY_FUNCTIONS:
+            if hasattr(script, name):
+                setattr(script, name, self.cache.wrap(getattr(script, name)))
+        self._installed.add(script.__name__)
+
+    def run(self, request, f):
+        """
+        Run the script of 'request' with its output sent to file 'f'.
+        Return the exit status.
+        """
+        import logging
+        import threading
+        import traceback
+        from utils import load_script
+        if request['script'] not in SCRIPTS:
+            send_message(f, stderr="Unknown script '%s'\n" % request['script'])
+            return 1
+        script = load_script(request['script'])
+        self.install(script)
+        callbacks = RunCallbacks()
+        script.atexit = callbacks
+        lock = threading.Lock()
+        root_logger = logging.getLogger()
+        handlers = list(root_logger.handlers)
+        level = root_logger.level
+        saved = sys.argv, sys.stdout, sys.stderr, os.getcwd()
+        self._args = {}
+        self.cache.enabled = False
+        status = 0
+        try:
+            os.chdir(request['cwd'])
+            sys.argv = [request['script']] + request['argv']
+            sys.stdout = StreamRelay(f, 'stdout', lock)
+            sys.stderr = StreamRelay(f, 'stderr', lock)
+            root_logger.handlers = []
+            try:
+                script.main()
+            except SystemExit as e:
+                status = e.code
+            finally:
+                callbacks.run()
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.argv, sys.stdout, sys.stderr = saved[:3]
+            os.chdir(saved[3])
+            root_logger.handlers = handlers
+            root_logger.setLevel(level)
+        if self._args.get('--exec'):
+            self.cache.clear()
+        # like the interpreter: a message as exit status means failure
+        if status is not None and not isinstance(status, int):
+            send_message(f, stderr='%s\n' % status)
+            status = 1
+        return status or 0
+
+    def serve(self):
+        try:
+            import socketserver
+        except ImportError:
+            import SocketServer as socketserver
+        server = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+                if request.get('stop'):
+                    server.stopped = True
+                    send_message(self.wfile, exit=0)
+                    return
+                server.log.info("running %s %s" % (request['script'],
+                        ' '.join(request['argv'])))
+                send_message(self.wfile, exit=server.run(request, self.wfile))
+        socket_dir = os.path.dirname(self.socket_file)
+        if socket_dir and not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir)
+        if os.path.exists(self.socket_file):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_file)
+            except socket.error:
+                os.remove(self.socket_file)
+            else:
+                probe.close()
+                self.log.critical("An org-server is already listening on '%s'"
+                        % self.socket_file)
+                sys.exit(1)
+        # only the owner may run scripts with the server's credentials
+        umask = os.umask(0o077)
+        try:
+            unix_server = socketserver.UnixStreamServer(self.socket_file,
+                    Handler)
+        finally:
+            os.umask(umask)
+        self.log.info("listening on '%s'" % self.socket_file)
+        try:
+            while not self.stopped:
+                unix_server.handle_request()
+        finally:
+            unix_server.server_close()
+            os.remove(self.socket_file)
+        self.log.info("stopped")
+
+
+def main():
+    argv = sys.argv[1:]
+    # options after 'run <script>' belong to the script
+    args = docopt(__doc__, argv, options_first='run' in argv)
+    socket_file = args['--socket'] or SOCKET_FILE
+    if args['run']:
+        sys.exit(run_remote(socket_file, args['<script>'], args['<args>']))
+    if args['stop']:
+        sys.exit(stop_server(socket_file))
+    from utils import get_logger
+    args['report'] = False
+    log = get_logger(args, os.path.basename(__file__).split('.')[0])
+    OrgServer(log, socket_file, float(args['--cache-ttl'])).serve()
+
+if __name__ == "__main__":
+    main()
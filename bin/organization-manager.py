@@ -3,146 +3,179 @@
 """Manage recources in an AWS Organization.
 
 Usage:
-  organization-manager report [-d] [--boto-log]
-  organization-manager organization (--spec-file FILE) [--exec] [-vd] [--boto-log]
+  organization-manager report [--format FMT] [--engine ENGINE] [--concurrency N] [--threads N] [-d] [--boto-log] [--save-snapshot FILE | --from-snapshot FILE] [--profile] [--profile-out FILE]
+  organization-manager organization (--spec-file FILE)... [--exec] [--full] [--engine ENGINE] [--concurrency N] [--threads N] [-vd] [--boto-log] [--save-snapshot FILE] [--profile] [--profile-out FILE]
+  organization-manager organization (--spec-file FILE)... (--from-snapshot FILE) [-vd] [--profile] [--profile-out FILE]
+  organization-manager watch (--spec-file FILE)... [--interval N] [--count N] [--deep-every N] [-vd] [--boto-log] [--profile] [--profile-out FILE]
   organization-manager --version
   organization-manager --help
 
 Modes of operation:
   report         Display organization status report only.
   orgnanizaion   Run AWS Org management tasks per specification.
+  watch          Scan the AWS Org every interval and write drift from the
+                 specification to STDOUT as json lines.  Makes no changes.
 
 Options:
   -h, --help                 Show this help message and exit.
   --version                  Display version info and exit.
   -s FILE, --spec-file FILE  AWS Org specification file in yaml format. (../config/org-spec.yaml)
-  --exec                     Execute proposed changes to AWS Org.
+                             May be a directory of yaml fragments merged into one spec.
+                             Repeat to reconcile several specs in one run.
+  --exec                     Execute proposed changes to AWS Org.  After a
+                             successful run the spec digests are saved to
+                             a last-applied record next to the first spec
+                             file.
+  --full                     Reconcile the whole spec.  By default only OUs
+                             and policies whose spec changed since the
+                             last-applied record are reconciled, and
+                             unmanaged accounts are only placed in the
+                             changed OUs.  Implied by --save-snapshot.
+  --format FMT               Report output format: text, json, csv or ndjson.
+                             [default: text]
   -v, --verbose              Log to activity to STDOUT at log level INFO.
   -d, --debug                Increase log level to 'DEBUG'. Implies '--verbose'.
   --boto-log                 Include botocore and boto3 logs in log stream.
+  --save-snapshot FILE       Save deployed Organization state to FILE.
+  --from-snapshot FILE       Read deployed Organization state from a saved
+                             snapshot FILE instead of AWS.  Makes no API calls.
+  --engine ENGINE            Execution backend for the inventory crawl and
+                             for applying changes: 'threads' or 'async'.
+                             'async' requires Python 3. [default: threads]
+  --concurrency N            Max API calls in flight with --engine async.
+                             [default: 64]
+  --threads N                Threads running the boto3 calls of --engine
+                             async.  botocore has no asyncio transport, so
+                             each call in flight holds a thread.  Defaults
+                             to --concurrency.
+  --interval N               Seconds between watch scans. [default: 300]
+  --count N                  Stop watching after N scans.  0 watches until
+                             interrupted. [default: 0]
+  --deep-every N             Re-read every policy attachment every N watch
+                             scans.  Other scans only read the attachments
+                             of managed policies and of what their
+                             listings show changed.
+                             0 never does. [default: 12]
+  --profile                  Print API call statistics and phase timings to
+                             STDERR at exit.
+  --profile-out FILE         Write API call statistics and phase timings to
+                             FILE in json format.
 
 """
 
+import atexit
+import copy
 import json
-import boto3
+import time
+from apistats import ApiProfile, report_profile
 from docopt import docopt
+from incremental import (find_changes, get_partial_inventory,
+        last_applied_file, load_last_applied, managed_account_ids,
+        save_last_applied, spec_digest, spec_hashes)
+from inventory import (PolicyStore, get_attachment_index, get_org_snapshot,
+        get_placement_snapshot, get_policy_store, policy_digest,
+        refresh_inventory, state_fingerprint)
+from journal import (Journal, journal_file, journal_plan, resume_plan,
+        verify_uncertain)
+from orgclient import get_org_client
+from plan import (APPLY_WORKERS, AttachPolicy, CreateOrganizationalUnit,
+        CreatePolicy, DeleteOrganizationalUnit, DeletePolicy, DetachPolicy,
+        MoveAccount, Operation, Plan, UpdatePolicy)
+from report import ou_report, policy_report, write_report
+from snapshot import save_snapshot
+from specindex import SpecIndex
 from utils import *
 
 
-def enable_policy_type_in_root(org_client, root_id):
+def enable_policy_type_in_root(org_client, args, log, root):
     """
     Ensure policy type 'SERVICE_CONTROL_POLICY' is enabled in the
     organization root.
     """
-    p_type = org_client.list_roots()['Roots'][0]['PolicyTypes']
+    p_type = root['PolicyTypes']
     if(not p_type or (p_type[0]['Type'] == 'SERVICE_CONTROL_POLICY' and p_type[0]['Status'] != 'ENABLED')):
-        org_client.enable_policy_type(RootId=root_id, PolicyType='SERVICE_CONTROL_POLICY')
-
-def get_parent_id(org_client, account_id):
-    """
-    Query deployed AWS organanization for 'account_id. Return the 'Id' of
-    the parent OrganizationalUnit or 'None'.
-    """
-    parents = org_client.list_parents(ChildId=account_id)['Parents']
-    try:
-        len(parents) == 1
-        return parents[0]['Id']
-    except:
-        raise RuntimeError("API Error: account '%s' has more than one parent: "
-                % (account_id, parents))
+        log.info("Enabling policy type 'SERVICE_CONTROL_POLICY' in root")
+        if args['--exec']:
+            org_client.enable_policy_type(RootId=root['Id'], PolicyType='SERVICE_CONTROL_POLICY')
 
-def validate_accounts_unique_in_org(log, root_spec):
+def validate_accounts_unique_in_org(log, spec_index):
     """
     Ensure accounts are unique across org
     """
-    # recursively build mapping of accounts to ou_names
-    def map_accounts(spec, account_map={}):
-        if 'Accounts' in spec and spec['Accounts']:
-            for account in spec['Accounts']:
-                if account in account_map:
-                    account_map[account].append(spec['Name'])
-                else:
-                    account_map[account] = [(spec['Name'])]
-        if 'Child_OU' in spec and spec['Child_OU']:
-            for child_spec in spec['Child_OU']:
-                map_accounts(child_spec, account_map)
-        return account_map
     # find accounts set to more than one OU
     unique = True
-    for account, ou in map_accounts(root_spec).items():
-        if len(ou) > 1:
-            log.error("Account '%s' set in multiple OU: %s" % (account, ou))
-            unique = False
+    for account, ou in sorted(spec_index.duplicates.items()):
+        log.error("Account '%s' set in multiple OU: %s" % (account, ou))
+        unique = False
     if not unique:
         log.critical("Invalid org_spec: Do not assign accounts to multiple "
                 "Organizatinal Units")
         print("Invalid org_spec... ")
         sys.exit(1)
 
-def display_provisioned_ou(org_client, log, deployed_ou, parent_name, indent=0):
-    """
-    Recursive function to display the deployed AWS Organization structure.
-    """
-    # query aws for child orgs
-    parent_id = lookup(deployed_ou, 'Name', parent_name, 'Id')
-    child_ou_list = lookup(deployed_ou, 'Name', parent_name, 'Child_OU')
-    child_accounts = lookup(deployed_ou, 'Name', parent_name, 'Accounts')
-    # display parent ou name
-    tab = '  '
-    log.info(tab*indent + parent_name + ':')
-    # look for policies
-    policy_names = list_policies_in_ou(org_client, parent_id)
-    if len(policy_names) > 0:
-        log.info(tab*indent + tab + 'Policies: ' + ', '.join(policy_names))
-    # look for accounts
-    account_list = sorted(child_accounts)
-    if len(account_list) > 0:
-        log.info(tab*indent + tab + 'Accounts: ' + ', '.join(account_list))
-    # look for child OUs
-    if child_ou_list:
-        log.info(tab*indent + tab + 'Child_OU:')
-        indent+=2
-        for ou_name in child_ou_list:
-            # recurse
-            display_provisioned_ou(org_client, log, deployed_ou, ou_name, indent)
-
-def display_provisioned_policies(org_client, log, deployed):
-    """
-    Print report of currently deployed Service Control Policies in
-    AWS Organization.
-    """
-    header = "Provisioned Service Control Policies:"
-    overbar = '_' * len(header)
-    log.info("\n\n%s\n%s" % (overbar, header))
-    for policy in deployed['policies']:
-        log.info("\nName:\t\t%s" % policy['Name'])
-        log.info("Description:\t%s" % policy['Description'])
-        log.info("Id:\t%s" % policy['Id'])
-        log.info("Content:")
-        log.info(json.dumps(json.loads(org_client.describe_policy(
-                PolicyId=policy['Id'])['Policy']['Content']),
-                indent=2,
-                separators=(',', ': ')))
-
-def place_unmanged_accounts(org_client, log, deployed, account_list, dest_parent):
-    """
-    Move any unmanaged accounts into the default OU.
+def combine_org_specs(log, specs):
     """
+    Merge list of (spec_file, org_spec) into one org spec.  OUs and
+    policies with the same name are merged.  Settings that differ
+    between specs, policies defined differently and OUs placed under
+    different parents are conflicts.  Exit on any conflict.
+    """
+    if len(specs) == 1:
+        return specs[0][1]
+    conflicts = []
+    policies = {}
+    ou_parents = {}
+    def check_ou(spec_file, ou_spec_list, parent_name):
+        for ou_spec in ou_spec_list or []:
+            known = ou_parents.setdefault(ou_spec['Name'],
+                    (parent_name, spec_file))
+            if known[0] != parent_name:
+                conflicts.append("%s: OU '%s' is placed under '%s' but under "
+                        "'%s' in %s" % (spec_file, ou_spec['Name'],
+                        parent_name, known[0], known[1]))
+            check_ou(spec_file, ou_spec.get('Child_OU'), ou_spec['Name'])
+    org_spec = {}
+    for spec_file, spec in specs:
+        for p_spec in spec.get('sc_policies') or []:
+            known = policies.setdefault(p_spec['Name'], (p_spec, spec_file))
+            if known[0] != p_spec:
+                conflicts.append("%s: policy '%s' differs from its "
+                        "definition in %s" % (spec_file, p_spec['Name'],
+                        known[1]))
+        check_ou(spec_file, spec.get('organizational_units'), None)
+        try:
+            merge_spec(org_spec, copy.deepcopy(spec))
+        except RuntimeError as e:
+            conflicts.append("%s: %s" % (spec_file, e))
+    exit_on_conflicts(log, conflicts)
+    log.info("Merged %d spec files" % len(specs))
+    return org_spec
+
+def policy_names_for(attachment_index, snapshot, target_id):
+    """
+    Return sorted list of names of policies attached to 'target_id'.
+    """
+    return sorted(snapshot.policies.by_id(p_id, 'Name')
+            for p_id in attachment_index.policies_for(target_id))
+
+def place_unmanged_accounts(plan, log, snapshot, account_list, dest_parent):
+    """
+    Plan moving any unmanaged accounts into the default OU.
+    """
+    dest_parent_ref = plan.ou_ref(dest_parent)
+    if not dest_parent_ref:
+        return
     for account in account_list:
-        account_id = lookup(deployed['accounts'], 'Name', account, 'Id')
-        dest_parent_id   = lookup(deployed['ou'], 'Name', dest_parent, 'Id')
-        source_parent_id = get_parent_id(org_client, account_id)
-        if dest_parent_id and dest_parent_id != source_parent_id:
-            log.info("Moving unmanged account '%s' to default OU '%s'" % (account, dest_parent))
-            org_client.move_account(AccountId=account_id, SourceParentId=source_parent_id,
-                                    DestinationParentId=dest_parent_id)
+        plan.move(log, snapshot.accounts.by_name(account, 'Id'), account,
+                dest_parent_ref, dest_parent, reason='unmanaged')
 
 
-def manage_policies(org_client, args, log, deployed, org_spec):
+def manage_policies(policy_store, plan, log, snapshot, org_spec):
     """
-    Manage Service Control Policies in the AWS Organization.  Make updates
-    according to the sc_policies specification.  Do not touch
-    the default policy.  Do not delete an attached policy.
+    Plan management of Service Control Policies in the AWS Organization.
+    Make updates according to the sc_policies specification.  Do not touch
+    the default policy.  Policies to delete are planned last by
+    manage_deletions().
     """
     for p_spec in org_spec['sc_policies']:
         policy_name = p_spec['Name']
@@ -150,17 +183,11 @@ def manage_policies(org_client, args, log, deployed, org_spec):
         # dont touch default policy
         if policy_name == org_spec['default_policy']:
             continue
-        policy = lookup(deployed['policies'], 'Name', policy_name)
+        policy = snapshot.policies.by_name(policy_name)
         # delete existing sc_policy
         if ensure_absent(p_spec):
             if policy:
-                log.info("Deleting policy '%s'" % (policy_name))
-                # dont delete attached policy
-                if org_client.list_targets_for_policy( PolicyId=policy['Id'])['Targets']:
-                    log.error("Cannot delete policy '%s'. Still attached to OU" %
-                            policy_name)
-                elif args['--exec']:
-                    org_client.delete_policy(PolicyId=policy['Id'])
+                plan.policies_to_delete.append(policy)
             continue
         # create or update sc_policy
         statement = dict(Effect=p_spec['Effect'], Action=p_spec['Actions'], Resource='*')
@@ -168,87 +195,76 @@ def manage_policies(org_client, args, log, deployed, org_spec):
         log.debug("spec sc_policy_doc: %s" % policy_doc)
         # create new policy
         if not policy:
-            log.info("Creating policy '%s'" % policy_name)
-            if args['--exec']:
-                org_client.create_policy(Content=policy_doc, Description=p_spec['Description'], Name=p_spec['Name'], Type='SERVICE_CONTROL_POLICY')
+            plan.add(CreatePolicy(policy_name, p_spec['Description'], policy_doc))
         # check for policy updates
         else:
-            deployed_policy_doc = json.dumps(json.loads(org_client.describe_policy(
-                    PolicyId=policy['Id'])['Policy']['Content']))
-            log.debug("real sc_policy_doc: %s" % deployed_policy_doc)
+            log.debug("real sc_policy_doc: %s" % policy_store.content(policy['Id']))
             if (p_spec['Description'] != policy['Description']
-                or policy_doc != deployed_policy_doc):
-                log.info("Updating policy '%s'" % policy_name)
-                if args['--exec']:
-                    org_client.update_policy(PolicyId=policy['Id'], Content=policy_doc, Description=p_spec['Description'])
+                or policy_digest(policy_doc) != policy_store.digest(policy['Id'])):
+                plan.add(UpdatePolicy(policy['Id'], policy_name,
+                        p_spec['Description'], policy_doc))
 
-def manage_ou(org_client, args, log, deployed, org_spec, ou_spec_list, parent_name):
+def manage_ou(attachment_index, plan, log, snapshot, org_spec, ou_spec_list, parent_name, parent_ref=None, changed=None):
     """
-    Recursive function to manage OrganizationalUnits in the AWS
-    Organization.
+    Recursive function to plan management of OrganizationalUnits in the
+    AWS Organization.  OUs to delete are planned last by
+    manage_deletions().  If set 'changed' is provided, only the policies,
+    accounts and deletion of the OUs named in it are managed.
     """
+    if parent_ref is None:
+        parent_ref = plan.ou_ref(parent_name)
     for ou_spec in ou_spec_list:
         # ou exists
-        ou = lookup(deployed['ou'], 'Name', ou_spec['Name'])
+        ou = snapshot.ou.by_name(ou_spec['Name'])
         if ou:
             # check for child_ou. recurse before other tasks.
-            if 'Child_OU' in ou_spec:
-                manage_ou(org_client, args, log, deployed, org_spec, ou_spec['Child_OU'], ou_spec['Name'])
+            if ou_spec.get('Child_OU'):
+                manage_ou(attachment_index, plan, log, snapshot, org_spec, ou_spec['Child_OU'], ou_spec['Name'], ou['Id'], changed)
+            if changed is not None and ou_spec['Name'] not in changed:
+                continue
             # check if ou 'absent'
             if ensure_absent(ou_spec):
-                log.info("Deleting OU %s" % ou_spec['Name'])
-                # error if ou contains anything
-                error_flag = False
-                for key in ['Accounts', 'SC_Policies', 'Child_OU']:
-                    if key in ou and ou[key]:
-                        log.error("Can not delete OU '%s'. deployed '%s' exists." % (ou_spec['Name'], key))
-                        error_flag = True
-                if error_flag:
-                    continue
-                elif args['--exec']:
-                    org_client.delete_organizational_unit(OrganizationalUnitId=ou['Id'])
+                plan.ou_to_delete.append(ou)
             # manage account and sc_policy placement in OU
             else:
-                manage_policy_attachments(org_client, args, log, deployed, org_spec, ou_spec, ou['Id'])
-                manage_account_moves(org_client, args, log, deployed, ou_spec, ou['Id'])
+                manage_policy_attachments(attachment_index, plan, log, snapshot, org_spec, ou_spec, ou['Id'])
+                manage_account_moves(plan, log, snapshot, ou_spec, ou['Id'])
         # create new OU
         elif not ensure_absent(ou_spec):
-            log.info("Creating new OU '%s' under parent '%s'" % (ou_spec['Name'], parent_name))
-            if args['--exec']:
-                new_ou = org_client.create_organizational_unit(ParentId=lookup(deployed['ou'],'Name',parent_name,'Id'),
-                        Name=ou_spec['Name'])['OrganizationalUnit']
-                # account and sc_policy placement
-                manage_policy_attachments(org_client, args, log, deployed, org_spec, ou_spec, new_ou['Id'])
-                manage_account_moves(org_client, args, log, deployed, ou_spec, new_ou['Id'])
-                # recurse if child OU
-                if ('Child_OU' in ou_spec and isinstance(new_ou, dict) and 'Id' in new_ou):
-                    manage_ou(org_client, args, log, deployed, org_spec, ou_spec['Child_OU'], new_ou['Name'])
-
-def manage_account_moves(org_client, args, log, deployed, ou_spec, dest_parent_id):
-    """
-    Alter deployed AWS Organization.  Ensure accounts are contained
-    by designated OrganizationalUnits based on OU specification.
+            new_ou = plan.add(CreateOrganizationalUnit(ou_spec['Name'], parent_ref, parent_name))
+            # account and sc_policy placement
+            manage_policy_attachments(attachment_index, plan, log, snapshot, org_spec, ou_spec, new_ou)
+            manage_account_moves(plan, log, snapshot, ou_spec, new_ou)
+            # recurse if child OU
+            if ou_spec.get('Child_OU'):
+                manage_ou(attachment_index, plan, log, snapshot, org_spec, ou_spec['Child_OU'], ou_spec['Name'], new_ou, changed)
+
+def manage_account_moves(plan, log, snapshot, ou_spec, dest_parent_ref):
+    """
+    Plan changes to deployed AWS Organization.  Ensure accounts are
+    contained by designated OrganizationalUnits based on OU specification.
     """
     if 'Accounts' in ou_spec and ou_spec['Accounts']:
         for account in ou_spec['Accounts']:
-            account_id = lookup(deployed['accounts'], 'Name', account, 'Id')
+            account_id = snapshot.accounts.by_name(account, 'Id')
             if not account_id:
                 log.warn("Account '%s' not yet in Organization" % account)
             else:
-                source_parent_id = get_parent_id(org_client, account_id)
-                if dest_parent_id != source_parent_id:
-                    log.info("Moving account '%s' to OU '%s'" % (account, ou_spec['Name']))
-                    if args['--exec']:
-                        org_client.move_account(AccountId=account_id, SourceParentId=source_parent_id,
-                                DestinationParentId=dest_parent_id)
+                plan.move(log, account_id, account, dest_parent_ref,
+                        ou_spec['Name'])
 
-def manage_policy_attachments(org_client, args, log, deployed, org_spec, ou_spec, ou_id):
+def manage_policy_attachments(attachment_index, plan, log, snapshot, org_spec, ou_spec, ou_ref):
     """
-    Attach or detach specified Service Control Policy to a deployed
-    OrganizatinalUnit.  Do not detach the default policy ever.
+    Plan to attach or detach specified Service Control Policy to a
+    deployed or planned OrganizatinalUnit.  Do not detach the default
+    policy ever.
     """
     # create lists policies_to_attach and policies_to_detach
-    attached_policy_list = list_policies_in_ou(org_client, ou_id)
+    if isinstance(ou_ref, Operation):
+        # new OUs get the default policy attached on creation
+        attached_policy_list = [org_spec['default_policy']]
+    else:
+        attached_policy_list = policy_names_for(attachment_index, snapshot, ou_ref)
     if 'SC_Policies' in ou_spec and isinstance(ou_spec['SC_Policies'], list):
         spec_policy_list = ou_spec['SC_Policies']
     else:
@@ -260,99 +276,425 @@ def manage_policy_attachments(org_client, args, log, deployed, org_spec, ou_spec
             and p != org_spec['default_policy']]
     # attach policies
     for policy_name in policies_to_attach:
-        if not lookup(deployed['policies'],'Name',policy_name):
-            if args['--exec']:
-                raise RuntimeError("spec-file: ou_spec: policy '%s' not defined" % policy_name)
-        if not ensure_absent(ou_spec):
-            log.info("Attaching policy '%s' to OU '%s'" % (policy_name, ou_spec['Name']))
-            if args['--exec']:
-                org_client.attach_policy(PolicyId=lookup(deployed['policies'], 'Name', policy_name, 'Id'), TargetId=ou_id)
+        policy_ref = plan.policy_ref(policy_name)
+        if not policy_ref:
+            plan.error(log, "spec-file: ou_spec: policy '%s' not defined" %
+                    policy_name)
+        elif not ensure_absent(ou_spec):
+            plan.add(AttachPolicy(policy_ref, policy_name, ou_ref, ou_spec['Name']))
     # detach policies
     for policy_name in policies_to_detach:
-        log.info("Detaching policy '%s' from OU '%s'" % (policy_name, ou_spec['Name']))
-        if args['--exec']:
-            org_client.detach_policy(PolicyId=lookup(deployed['policies'], 'Name', policy_name, 'Id'), TargetId=ou_id)
+        plan.add(DetachPolicy(snapshot.policies.by_name(policy_name, 'Id'),
+                policy_name, ou_ref, ou_spec['Name']))
+
+def manage_deletions(org_client, attachment_index, plan, log, snapshot):
+    """
+    Plan deletion of OUs and policies set 'absent'.  An OU is deleted
+    after all its accounts are moved out and its child OUs are deleted.
+    A policy is deleted after it is detached from all targets.  Refuse
+    deletions the plan can not satisfy.
+    """
+    deleted_ou = {}
+    # ou_to_delete lists child OUs before their parent
+    for ou in plan.ou_to_delete:
+        op = DeleteOrganizationalUnit(ou['Id'], ou['Name'])
+        error_flag = False
+        moves_out = dict((m.account_id, m) for m in plan.moves_from(ou['Id']))
+        for account_id in snapshot.parents.accounts_in(ou['Id']):
+            if account_id in moves_out:
+                op.depends_on(moves_out[account_id])
+            else:
+                error_flag = True
+        if error_flag:
+            log.error("Can not delete OU '%s'. deployed '%s' exists." % (ou['Name'], 'Accounts'))
+        for child_name in ou.get('Child_OU', []):
+            if child_name in deleted_ou:
+                op.depends_on(deleted_ou[child_name])
+            else:
+                log.error("Can not delete OU '%s'. deployed '%s' exists." % (ou['Name'], 'Child_OU'))
+                error_flag = True
+        if any(new_ou.parent == ou['Id'] for new_ou in plan.new_ou.values()):
+            log.error("Can not delete OU '%s'. Child_OU are planned." % ou['Name'])
+            error_flag = True
+        if not error_flag:
+            deleted_ou[ou['Name']] = plan.add(op)
+    for policy in plan.policies_to_delete:
+        op = DeletePolicy(policy['Id'], policy['Name'])
+        detaches = dict((d.target_id, d) for d in plan.ops
+                if isinstance(d, DetachPolicy) and d.policy_id == policy['Id'])
+        if attachment_index.complete:
+            targets = attachment_index.targets_for(policy['Id'])
+        else:
+            targets = [t['TargetId'] for t in paginate(
+                    org_client.list_targets_for_policy, 'Targets',
+                    PolicyId=policy['Id'])]
+        # dont delete attached policy
+        if all(t in detaches for t in targets):
+            plan.add(op.depends_on(*[detaches[t] for t in targets]))
+        else:
+            log.error("Cannot delete policy '%s'. Still attached to OU" %
+                    policy['Name'])
+
+
+def manage_unmanaged(plan, log, snapshot, org_spec, spec_index):
+    """
+    Warn about deployed accounts, OUs and policies not in the spec and
+    plan moving unmanaged accounts into the default OU.  Return dict of
+    the unmanaged names by kind.
+    """
+    found = {}
+    for key in ('accounts', 'ou', 'policies'):
+        unmanaged = spec_index.unmanaged(key, getattr(snapshot, key).names())
+        if unmanaged:
+            found[key] = unmanaged
+            log.warn("Unmanaged %s in Organization: %s" % (key,', '.join(unmanaged)))
+            if key ==  'accounts':
+                # append unmanaged accounts to default_ou
+                place_unmanged_accounts(plan, log, snapshot, unmanaged, org_spec['default_ou'])
+    return found
+
+# drift type reported by watch for each planned action
+DRIFT_TYPES = dict(
+    create_policy = 'policy_missing',
+    update_policy = 'policy_changed',
+    create_organizational_unit = 'ou_missing',
+    attach_policy = 'policy_not_attached',
+    detach_policy = 'policy_attached',
+    move_account = 'account_misplaced',
+)
+# drift type reported by watch for unmanaged resources of each kind
+UNMANAGED_DRIFT_TYPES = dict(ou='ou_unmanaged', policies='policy_unmanaged')
+
+def find_drift(log, snapshot, policy_store, attachment_index, org_spec, spec_index):
+    """
+    Plan reconciliation of 'org_spec' without applying it and return
+    sorted list of (drift type, message) for every difference found.
+    Uses the same comparisons as the 'organization' mode.
+    """
+    plan = Plan(snapshot)
+    manage_policies(policy_store, plan, log, snapshot, org_spec)
+    manage_ou(attachment_index, plan, log, snapshot, org_spec, org_spec['organizational_units'], 'root')
+    unmanaged = manage_unmanaged(plan, log, snapshot, org_spec, spec_index)
+    drift = set()
+    for op in plan.ops:
+        if isinstance(op, MoveAccount) and op.reason == 'unmanaged':
+            drift.add(('account_unmanaged', op.describe()))
+        else:
+            drift.add((DRIFT_TYPES[op.action], op.describe()))
+    for key, drift_type in UNMANAGED_DRIFT_TYPES.items():
+        for name in unmanaged.get(key, []):
+            drift.add((drift_type, "Unmanaged %s '%s'" % (key, name)))
+    for ou in plan.ou_to_delete:
+        drift.add(('ou_not_absent', "OU '%s' set absent is deployed" % ou['Name']))
+    for policy in plan.policies_to_delete:
+        drift.add(('policy_not_absent', "Policy '%s' set absent is deployed" % policy['Name']))
+    return sorted(drift)
+
+def emit_event(out, event, **fields):
+    """
+    Write one watch event to 'out' as a json line.
+    """
+    fields.update(event=event,
+            time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+    out.write(json.dumps(fields, sort_keys=True) + '\n')
+    out.flush()
 
+def watch(log, args, org_client, org_spec, spec_index, out=None):
+    """
+    Scan the deployed AWS Organization every '--interval' seconds.  Each
+    scan lists the OU tree, the accounts of each OU and the policies.
+    Every scan reads the documents and targets of the managed policies.
+    The other attachments read by the first scan are kept and later
+    scans only read them again for the policies and OUs their listings
+    show changed, except every '--deep-every' scans, which read them
+    all.  Per OU and per policy fingerprints of the scan are
+    compared to the previous scan, and drift from the spec is only
+    re-evaluated when a fingerprint changed.  Drift that appears or
+    disappears is written to 'out' as 'drift' and 'resolved' events.
+    Every scan ends with a 'scan' event.  'out' defaults to STDOUT.
+    """
+    out = out or sys.stdout
+    root = org_client.list_roots()['Roots'][0]
+    master_account_id = org_client.describe_organization(
+            )['Organization']['MasterAccountId']
+    validate_master_id(master_account_id, org_spec)
+    interval = float(args['--interval'])
+    count = int(args['--count'])
+    deep_every = int(args['--deep-every'])
+    fingerprint = {}
+    drift = []
+    snapshot = None
+    scan = 0
+    while True:
+        scan += 1
+        start = time.time()
+        previous = snapshot
+        snapshot = get_placement_snapshot(org_client, root, master_account_id)
+        # the default policy is never compared
+        described = [p['Id'] for p in snapshot.policies
+                if p['Name'] in spec_index.managed['policies']
+                and p['Name'] != org_spec['default_policy']]
+        deep = previous is None or (deep_every and (scan - 1) % deep_every == 0)
+        if deep:
+            policy_store = PolicyStore().fetch(org_client, described)
+            attachment_index = get_attachment_index(org_client, snapshot)
+            scanned = len(snapshot.policies) + len(snapshot.ou)
+        else:
+            scanned = refresh_inventory(org_client, previous, snapshot,
+                    policy_store, attachment_index, described)
+        current = state_fingerprint(snapshot, attachment_index, policy_store)
+        changed = [scope for scope in set(current).union(fingerprint)
+                if current.get(scope) != fingerprint.get(scope)]
+        if changed:
+            found = find_drift(log, snapshot, policy_store, attachment_index, org_spec, spec_index)
+            for drift_type, message in sorted(set(found).difference(drift)):
+                emit_event(out, 'drift', scan=scan, type=drift_type, message=message)
+            for drift_type, message in sorted(set(drift).difference(found)):
+                emit_event(out, 'resolved', scan=scan, type=drift_type, message=message)
+            drift = found
+        emit_event(out, 'scan', scan=scan, deep=bool(deep), scanned=scanned,
+                changed=len(changed), drift=len(drift),
+                seconds=round(time.time() - start, 3))
+        fingerprint = current
+        if count and scan >= count:
+            return
+        time.sleep(interval)
+
+def display_move_summary(plan):
+    """
+    Print one table with the result of every planned account move.
+    """
+    moves = sorted(plan.moves.values(), key=lambda op: op.account_name)
+    if not moves:
+        return
+    header = "Account move summary:"
+    sys.stdout.write("\n%s\n%s\n" % ('_' * len(header), header))
+    for op in moves:
+        row = "%-24s%-24s%-10s%s" % (op.account_name, op.dest_name,
+                op.state, op.detail)
+        sys.stdout.write(row.rstrip() + '\n')
+
+def display_resume_summary(ops):
+    """
+    Print one table with the result of every operation of a resumed run.
+    """
+    header = "Resumed operation summary:"
+    sys.stdout.write("\n%s\n%s\n" % ('_' * len(header), header))
+    for op in ops:
+        row = "%-10s%-64s%s" % (op.state, op.describe(), op.detail)
+        sys.stdout.write(row.rstrip() + '\n')
+
+def resume_organization(log, org_client, journal, entries, spec_files,
+        hashes, spec_index, record, record_file):
+    """
+    Finish the interrupted --exec run journaled in 'entries' without a
+    new inventory.  Operations the journal shows done are skipped, those
+    it shows started are checked against the AWS Organization first and
+    all others are applied.  Refuse to resume in another Organization
+    than the one the run was journaled in.
+    """
+    begin = entries[0]
+    master_account_id = org_client.describe_organization(
+            )['Organization']['MasterAccountId']
+    if master_account_id != begin['master_account_id']:
+        log.critical("Journal '%s' is of a run in the Organization of master "
+                "account %s, not %s. Use --full to start over" % (
+                journal.file_name, begin['master_account_id'],
+                master_account_id))
+        sys.exit(1)
+    plan, uncertain = resume_plan(entries)
+    log.info("Resuming the run interrupted after %s: %d operations left, "
+            "%d uncertain" % (begin['time'], len(plan), len(uncertain)))
+    journal.resume()
+    ops = list(plan.ops)
+    verify_uncertain(log, org_client, journal, plan, uncertain)
+    plan.journal = journal
+    failed = plan.apply(org_client, log)
+    display_resume_summary(ops)
+    if failed:
+        journal.close()
+        log.critical("%d of %d planned operations failed. Rerun to retry "
+                "them or use --full to start over" % (len(failed), len(plan)))
+        sys.exit(1)
+    journal.end()
+    save_last_applied(log, record_file, spec_files, hashes,
+            begin['master_account_id'], begin['accounts'],
+            spec_index.managed['accounts'], record,
+            full=not begin['incremental'])
 
-def check_accounts_are_live(log, org_client, accounts):
-    #get a list of all the accounts in org
-    live_accounts = get_deployed_accounts(log, org_client)
-    for spec_account in accounts:
-        #check org in spec is in the list of live accounts
-        is_live = False
-        for live_account in live_accounts:
-            if(spec_account == live_account["Name"]):
-                is_live = True
-        if (not is_live):
-            log.warn("Account '%s' not Created. Please run create-account-structure.py first" % spec_account)
+def check_accounts_are_live(log, snapshot, spec_index):
+    """
+    Warn about managed accounts missing from the deployed Organization.
+    """
+    for spec_account in spec_index.missing('accounts', snapshot.accounts.names()):
+        log.warn("Account '%s' not Created. Please run create-account-structure.py first" % spec_account)
 
 
 def main():
     args = docopt(__doc__, version='1.0')
     log = get_logger(args, os.path.basename(__file__).split('.')[0])
 
-    #create the client
-    org_client = boto3.client('organizations')
-    root_id = get_root_org_id(org_client)
-
-    #scan account to see what has been deployed
-    deployed = dict(
-            policies = get_deployed_policies(org_client),
-            accounts = get_deployed_accounts(log, org_client),
-            ou = get_deployed_ou(org_client, root_id))
+    profile = ApiProfile()
+    if args['--profile'] or args['--profile-out']:
+        atexit.register(report_profile, args, profile)
 
     ################# SPEC FILE CHECKS ######################
     #########################################################
     if args['--spec-file']:
         #read in organisation strcture
+        profile.phase('validation')
         log.info("Validating Organization spec file")
-        org_spec = validate_spec_file(log, args['--spec-file'], 'org_spec')
+        org_spec = combine_org_specs(log, validate_spec_files(log,
+                args['--spec-file'], 'org_spec'))
         log.info("Spec Valid...")
-        enable_policy_type_in_root(org_client, root_id)
-        validate_master_id(org_client, org_spec)
-        root_spec = lookup(org_spec['organizational_units'], 'Name', 'root')
+        spec_index = SpecIndex(org_spec)
+        validate_accounts_unique_in_org(log, spec_index)
 
-        validate_accounts_unique_in_org(log, root_spec)
+    ################# INCREMENTAL RECONCILIATION ############
+    #########################################################
+    changes = None
+    journal = None
+    concurrency = max(CRAWL_WORKERS, APPLY_WORKERS)
+    if args['--engine'] == 'async':
+        concurrency = int(args['--concurrency'])
+    if args['organization']:
+        record_file = last_applied_file(args['--spec-file'])
+        hashes = spec_hashes(org_spec)
+        record = load_last_applied(log, record_file)
+        if args['--exec']:
+            journal = Journal(log, journal_file(args['--spec-file']))
+            interrupted = None
+            if not args['--full']:
+                interrupted = journal.interrupted('organization',
+                        spec_digest(hashes))
+            if interrupted:
+                profile.phase('resume')
+                resume_organization(log, get_org_client(log,
+                        concurrency=concurrency, profile=profile), journal,
+                        interrupted, args['--spec-file'], hashes, spec_index,
+                        record, record_file)
+                return
+        if not (args['--full'] or args['--from-snapshot']
+                or args['--save-snapshot']):
+            changes = find_changes(log, args['--spec-file'], hashes, record,
+                    org_spec)
+        if changes is not None:
+            if not changes:
+                log.info("No spec changes since last-applied generation %d"
+                        % changes.generation)
+                return
+            log.info("Reconciling %d changed OU and %d changed policies since "
+                    "last-applied generation %d" % (len(changes.ou),
+                    len(changes.policies), changes.generation))
+            # keep the path to default_ou for placing unmanaged accounts
+            org_spec = changes.prune(org_spec, [org_spec['default_ou']])
 
-        managed = dict(
-                accounts = search_spec(root_spec, 'Accounts', 'Child_OU'),
-                ou = search_spec(root_spec, 'Name', 'Child_OU'),
-                policies = [p['Name'] for p in org_spec['sc_policies']])
+    #create the client
+    profile.phase('inventory')
+    org_client = get_org_client(log, args['--from-snapshot'], concurrency,
+            profile=profile)
 
-        check_accounts_are_live(log, org_client, managed['accounts'])
-        # ensure default_policy is considered 'managed'
-        if org_spec['default_policy'] not in managed['policies']:
-            managed['policies'].append(org_spec['default_policy'])
+    ###################### DRIFT WATCH ######################
+    #########################################################
+    if args['watch']:
+        profile.phase('watch')
+        watch(log, args, org_client, org_spec, spec_index)
+        return
+
+    #scan account to see what has been deployed
+    engine = None
+    if args['--engine'] == 'async':
+        # asyncio is Python 3 only, so the engine is imported on demand
+        from asyncengine import AsyncEngine
+        engine = AsyncEngine(org_client, log, int(args['--concurrency']),
+                int(args['--threads'] or 0))
+        atexit.register(engine.close)
+    elif args['--engine'] != 'threads':
+        log.critical("Unknown engine '%s'. Use 'threads' or 'async'" %
+                args['--engine'])
+        sys.exit(1)
+    if changes:
+        snapshot, policy_store, attachment_index = get_partial_inventory(
+                log, org_client, org_spec, changes, record)
+    elif engine:
+        snapshot, policy_store, attachment_index = engine.inventory()
+    else:
+        snapshot = get_org_snapshot(log, org_client)
+        policy_store = get_policy_store(org_client, snapshot)
+        attachment_index = get_attachment_index(org_client, snapshot)
+    if args['--save-snapshot']:
+        save_snapshot(log, org_client, snapshot, args['--save-snapshot'],
+                policy_store, attachment_index)
+
+    if args['--spec-file']:
+        enable_policy_type_in_root(org_client, args, log, snapshot.root)
+        validate_master_id(snapshot.master_account_id, org_spec)
+        # an incremental pass resolves only the accounts of changed OUs
+        if not changes:
+            check_accounts_are_live(log, snapshot, spec_index)
 
     ###################### REPORT FUNCTION###################
     #########################################################
     if args['report']:
-        header = 'Provisioned Organizational Units in Org:'
-        overbar = '_' * len(header)
-        log.info("\n%s\n%s" % (overbar, header))
-        display_provisioned_ou(org_client, log, deployed['ou'], 'root')
-        display_provisioned_policies(org_client, log, deployed)
+        profile.phase('report')
+        write_report(sys.stdout, args['--format'], [
+                ou_report(attachment_index, snapshot),
+                policy_report(policy_store, snapshot)])
 
     ###################### ORG CRUD ######################
     ######################################################
     if args['organization']:
-        # all information is present now preform CRUD operations on policies
-        manage_policies(org_client, args, log, deployed, org_spec)
-        # rescan deployed policies
-        deployed['policies'] = get_deployed_policies(org_client)
+        # all information is present now plan CRUD operations on policies
+        profile.phase('policy management')
+        plan = Plan(snapshot)
+        manage_policies(policy_store, plan, log, snapshot, org_spec)
 
         # OU CRUD
-        manage_ou(org_client, args, log, deployed, org_spec, org_spec['organizational_units'], 'root')
+        profile.phase('OU management')
+        manage_ou(attachment_index, plan, log, snapshot, org_spec,
+                org_spec['organizational_units'], 'root',
+                changed=changes.ou if changes else None)
 
         #MANAGE ORPHAN ACCOUNTS
         # check for unmanaged resources
-        for key in managed.keys():
-            unmanaged= [a['Name'] for a in deployed[key] if a['Name'] not in managed[key]]
-            if unmanaged:
-                log.warn("Unmanaged %s in Organization: %s" % (key,', '.join(unmanaged)))
-                if key ==  'accounts':
-                    # append unmanaged accounts to default_ou
-                    place_unmanged_accounts(org_client, log, deployed, unmanaged, org_spec['default_ou'])
+        profile.phase('orphan placement')
+        manage_unmanaged(plan, log, snapshot, org_spec, spec_index)
+        profile.phase('deletions')
+        manage_deletions(org_client, attachment_index, plan, log, snapshot)
+
+        # apply the plan, or just display it on dry run
+        profile.phase('apply')
+        if args['--exec'] and plan.errors:
+            log.critical("%d errors in the plan. Nothing applied." %
+                    len(plan.errors))
+            sys.exit(1)
+        if args['--exec']:
+            account_ids = managed_account_ids(snapshot,
+                    spec_index.managed['accounts'])
+            if plan.ops:
+                # the journal lets a rerun finish this run if it dies
+                journal_plan(journal, plan, digest=spec_digest(hashes),
+                        master_account_id=snapshot.master_account_id,
+                        accounts=account_ids, incremental=bool(changes))
+            if engine:
+                failed = engine.apply(plan)
+            else:
+                failed = plan.apply(org_client, log)
+            display_move_summary(plan)
+            if failed:
+                journal.close()
+                log.critical("%d of %d planned operations failed. Rerun to "
+                        "retry them or use --full to start over" %
+                        (len(failed), len(plan)))
+                sys.exit(1)
+            if plan.ops:
+                journal.end()
+            save_last_applied(log, record_file, args['--spec-file'], hashes,
+                    snapshot.master_account_id, account_ids,
+                    spec_index.managed['accounts'], record,
+                    full=not changes)
+        else:
+            plan.display(log)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,226 @@
+"""Throttle-aware wrapper for AWS service clients """
+import logging
+import random
+import threading
+import time
+
+from snapshot import SnapshotClient, load_snapshot_file
+from utils import get_client
+
+# sustained calls per second and burst size for each operation
+READ_RATE = 10.0
+READ_BURST = 20
+WRITE_RATE = 2.0
+WRITE_BURST = 5
+# slowest rate adaptive backoff will throttle an operation down to
+MIN_RATE = 0.2
+# retry policy
+MAX_ATTEMPTS = 8
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 20.0
+
+THROTTLE_ERRORS = (
+    'TooManyRequestsException',
+    'ThrottlingException',
+    'Throttling',
+    'RequestLimitExceeded',
+)
+CONFLICT_ERRORS = (
+    'ConcurrentModificationException',
+)
+READ_PREFIXES = ('describe_', 'get_', 'list_', 'validate_')
+# client attributes that are not API operations
+NON_API_METHODS = (
+    'can_paginate',
+    'close',
+    'generate_presigned_url',
+    'get_paginator',
+    'get_waiter',
+)
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket.  acquire() blocks until a token is
+    available.  The refill rate is lowered when the service throttles us
+    and recovers slowly as calls succeed again.
+    """
+    def __init__(self, rate, burst, min_rate=MIN_RATE):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(float(min_rate), self.rate)
+        self.burst = float(burst)
+        self._tokens = float(burst)
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def reserve(self):
+        """
+        Take a token if one is available and return 0.  Otherwise return
+        the seconds to wait before trying again.
+        """
+        with self._lock:
+            self._refill(time.time())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def throttled(self):
+        """
+        Multiplicative decrease of the refill rate.  Drain the bucket so
+        bursts stop immediately.
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0
+
+    def succeeded(self):
+        """
+        Additive increase of the refill rate, up to the configured rate.
+        """
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+def error_code(exc):
+    """
+    Return the AWS error code of a botocore ClientError or None.
+    """
+    response = getattr(exc, 'response', None)
+    if isinstance(response, dict):
+        return response.get('Error', {}).get('Code')
+    return None
+
+
+def is_read_operation(operation):
+    return operation.startswith(READ_PREFIXES)
+
+
+def retry_delay(attempt):
+    """
+    Exponential backoff with full jitter for retry number 'attempt'.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY,
+            RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+class ThrottledClient(object):
+    """
+    Wrap a boto3 client.  Every API call takes a token from a per
+    operation bucket sized by the read or write budget.  Throttling
+    errors are retried with backoff and slow the operation down.
+    ConcurrentModificationException is retried on mutating calls.
+    Every attempt is recorded in ApiProfile 'profile', if provided.
+    Any other attribute is passed through to the wrapped client.
+    """
+    def __init__(self, client, read_rate=READ_RATE, read_burst=READ_BURST,
+            write_rate=WRITE_RATE, write_burst=WRITE_BURST,
+            max_attempts=MAX_ATTEMPTS, log=None, profile=None):
+        self.client = client
+        self.profile = profile
+        self.read_budget = (read_rate, read_burst)
+        self.write_budget = (write_rate, write_burst)
+        self.max_attempts = max_attempts
+        self.log = log or logging.getLogger(__name__)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, operation):
+        """
+        Return the token bucket for 'operation', creating it on first use.
+        """
+        with self._lock:
+            if operation not in self._buckets:
+                if is_read_operation(operation):
+                    rate, burst = self.read_budget
+                else:
+                    rate, burst = self.write_budget
+                self._buckets[operation] = TokenBucket(rate, burst)
+            return self._buckets[operation]
+
+    def call(self, operation, **kwargs):
+        """
+        Call API 'operation' on the wrapped client with rate limiting
+        and retries.
+        """
+        api_call = getattr(self.client, operation)
+        bucket = self.bucket(operation)
+        retry_conflicts = not is_read_operation(operation)
+        page = bool(kwargs.get('NextToken'))
+        attempt = 0
+        while True:
+            bucket.acquire()
+            start = time.time()
+            try:
+                response = api_call(**kwargs)
+            except Exception as e:
+                code = error_code(e)
+                if self.profile is not None:
+                    self.profile.record(operation, time.time() - start,
+                            page=page, retry=attempt > 0,
+                            throttled=code in THROTTLE_ERRORS, error=True)
+                attempt += 1
+                if code in THROTTLE_ERRORS:
+                    bucket.throttled()
+                elif not (retry_conflicts and code in CONFLICT_ERRORS):
+                    raise
+                if attempt >= self.max_attempts:
+                    raise
+                delay = retry_delay(attempt)
+                self.log.debug("%s: %s, retry %d in %.2fs" %
+                        (operation, code, attempt, delay))
+                time.sleep(delay)
+                continue
+            if self.profile is not None:
+                self.profile.record(operation, time.time() - start,
+                        page=page, retry=attempt > 0)
+            bucket.succeeded()
+            return response
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if (name.startswith('_') or name in NON_API_METHODS
+                or not callable(attr)):
+            return attr
+        def api_call(**kwargs):
+            return self.call(name, **kwargs)
+        api_call.__name__ = name
+        return api_call
+
+
+def boto_client(service, concurrency=None):
+    """
+    Return the shared boto3 client for 'service' from utils.get_client(),
+    to be wrapped in a ThrottledClient.  botocore does not retry its
+    calls: a throttled call must reach the ThrottledClient to slow its
+    token bucket, and retries of both would multiply.  boto3 is imported
+    only then, so runs that make no API calls start fast.  A long-lived
+    process reuses the client and its credentials.
+    """
+    return get_client(service, concurrency=concurrency, retries=False)
+
+
+def get_org_client(log=None, snapshot_file=None, concurrency=None, **kwargs):
+    """
+    Return a ThrottledClient for AWS Organizations with a connection pool
+    for 'concurrency' calls in flight.  If 'snapshot_file' is provided,
+    return an offline SnapshotClient loaded from it instead.
+    """
+    if snapshot_file:
+        return SnapshotClient(load_snapshot_file(snapshot_file))
+    return ThrottledClient(boto_client('organizations', concurrency), log=log,
+            **kwargs)
@@ -0,0 +1,385 @@
+"""Plan and apply changes to an AWS Organization """
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# max number of operations applied concurrently
+APPLY_WORKERS = 8
+
+
+def resolve(ref):
+    """
+    Return the Id referenced by 'ref'.  A reference is either an Id
+    string or the Operation that creates the resource.
+    """
+    if isinstance(ref, Operation):
+        return ref.result
+    return ref
+
+
+class Operation(object):
+    """
+    A single write against the AWS Organization.  Operations referenced
+    as arguments (e.g. the CreateOrganizationalUnit op passed as a parent)
+    automatically become dependencies.
+    """
+    action = None
+
+    def __init__(self, *refs):
+        self.deps = [r for r in refs if isinstance(r, Operation)]
+        self.result = None
+        # PLANNED, APPLIED, FAILED or SKIPPED, with the error in 'detail'
+        self.state = 'PLANNED'
+        self.detail = ''
+        # journal key, set when the plan is journaled
+        self.key = None
+
+    def finish(self, state, detail=''):
+        self.state = state
+        self.detail = detail
+
+    def depends_on(self, *ops):
+        for op in ops:
+            if op not in self.deps:
+                self.deps.append(op)
+        return self
+
+    def describe(self):
+        raise NotImplementedError
+
+    def params(self):
+        """
+        Return the keyword arguments of the API call named by 'action'.
+        """
+        raise NotImplementedError
+
+    def handle(self, response):
+        """
+        Store what is needed from the API 'response' in 'result'.
+        """
+        pass
+
+    def apply(self, org_client):
+        """
+        Make the API call synchronously.  Other engines use action,
+        params() and handle() directly.
+        """
+        self.handle(getattr(org_client, self.action)(**self.params()))
+
+    def record(self, snapshot):
+        """
+        Update 'snapshot' indexes after the operation was applied.
+        """
+        pass
+
+
+class CreatePolicy(Operation):
+    action = 'create_policy'
+
+    def __init__(self, name, description, content):
+        Operation.__init__(self)
+        self.name = name
+        self.description = description
+        self.content = content
+
+    def describe(self):
+        return "Creating policy '%s'" % self.name
+
+    def params(self):
+        return dict(Content=self.content, Description=self.description,
+                Name=self.name, Type='SERVICE_CONTROL_POLICY')
+
+    def handle(self, response):
+        self.result = response['Policy']['PolicySummary']['Id']
+
+
+class UpdatePolicy(Operation):
+    action = 'update_policy'
+
+    def __init__(self, policy_id, name, description, content):
+        Operation.__init__(self)
+        self.policy_id = policy_id
+        self.name = name
+        self.description = description
+        self.content = content
+
+    def describe(self):
+        return "Updating policy '%s'" % self.name
+
+    def params(self):
+        return dict(PolicyId=self.policy_id, Content=self.content,
+                Description=self.description)
+
+
+class DeletePolicy(Operation):
+    action = 'delete_policy'
+
+    def __init__(self, policy_id, name):
+        Operation.__init__(self)
+        self.policy_id = policy_id
+        self.name = name
+
+    def describe(self):
+        return "Deleting policy '%s'" % self.name
+
+    def params(self):
+        return dict(PolicyId=self.policy_id)
+
+
+class CreateOrganizationalUnit(Operation):
+    action = 'create_organizational_unit'
+
+    def __init__(self, name, parent, parent_name):
+        Operation.__init__(self, parent)
+        self.name = name
+        self.parent = parent
+        self.parent_name = parent_name
+
+    def describe(self):
+        return "Creating new OU '%s' under parent '%s'" % (self.name,
+                self.parent_name)
+
+    def params(self):
+        return dict(ParentId=resolve(self.parent), Name=self.name)
+
+    def handle(self, response):
+        self.result = response['OrganizationalUnit']['Id']
+
+
+class DeleteOrganizationalUnit(Operation):
+    action = 'delete_organizational_unit'
+
+    def __init__(self, ou_id, name):
+        Operation.__init__(self)
+        self.ou_id = ou_id
+        self.name = name
+
+    def describe(self):
+        return "Deleting OU %s" % self.name
+
+    def params(self):
+        return dict(OrganizationalUnitId=self.ou_id)
+
+
+class AttachPolicy(Operation):
+    action = 'attach_policy'
+
+    def __init__(self, policy, policy_name, target, target_name):
+        Operation.__init__(self, policy, target)
+        self.policy = policy
+        self.policy_name = policy_name
+        self.target = target
+        self.target_name = target_name
+
+    def describe(self):
+        return "Attaching policy '%s' to OU '%s'" % (self.policy_name,
+                self.target_name)
+
+    def params(self):
+        return dict(PolicyId=resolve(self.policy), TargetId=resolve(self.target))
+
+
+class DetachPolicy(Operation):
+    action = 'detach_policy'
+
+    def __init__(self, policy_id, policy_name, target_id, target_name):
+        Operation.__init__(self)
+        self.policy_id = policy_id
+        self.policy_name = policy_name
+        self.target_id = target_id
+        self.target_name = target_name
+
+    def describe(self):
+        return "Detaching policy '%s' from OU '%s'" % (self.policy_name,
+                self.target_name)
+
+    def params(self):
+        return dict(PolicyId=self.policy_id, TargetId=self.target_id)
+
+
+class MoveAccount(Operation):
+    action = 'move_account'
+
+    def __init__(self, account_id, account_name, source_id, dest, dest_name,
+            reason=''):
+        Operation.__init__(self, dest)
+        self.account_id = account_id
+        self.account_name = account_name
+        self.source_id = source_id
+        self.dest = dest
+        self.dest_name = dest_name
+        self.reason = reason
+
+    def describe(self):
+        if self.reason == 'unmanaged':
+            return "Moving unmanged account '%s' to default OU '%s'" % (
+                    self.account_name, self.dest_name)
+        return "Moving account '%s' to OU '%s'" % (self.account_name,
+                self.dest_name)
+
+    def params(self):
+        return dict(AccountId=self.account_id, SourceParentId=self.source_id,
+                DestinationParentId=resolve(self.dest))
+
+    def record(self, snapshot):
+        snapshot.parents.record_move(self.account_id, resolve(self.dest))
+
+
+class Plan(object):
+    """
+    Ordered collection of Operations forming a dependency DAG.  Keeps
+    track of resources the plan will create so later planning steps can
+    reference them by name.
+    """
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.ops = []
+        self.new_ou = {}
+        self.new_policies = {}
+        self.moves = {}
+        # deployed resources set 'absent'.  Deletions are planned last.
+        self.ou_to_delete = []
+        self.policies_to_delete = []
+        # problems of the spec found while planning
+        self.errors = []
+        # journal.Journal recording the progress of --exec runs
+        self.journal = None
+
+    def __len__(self):
+        return len(self.ops)
+
+    def add(self, op):
+        self.ops.append(op)
+        if isinstance(op, CreateOrganizationalUnit):
+            self.new_ou[op.name] = op
+        elif isinstance(op, CreatePolicy):
+            self.new_policies[op.name] = op
+        elif isinstance(op, MoveAccount):
+            self.moves[op.account_id] = op
+        return op
+
+    def error(self, log, message):
+        """
+        Log and record planning problem 'message'.  Planning goes on, so
+        a dry run reports every problem; --exec applies no plan with
+        errors.
+        """
+        log.error(message)
+        self.errors.append(message)
+
+    def ou_ref(self, name):
+        """
+        Return Id of deployed OU 'name', the op creating it, or None.
+        """
+        return self.snapshot.ou.by_name(name, 'Id') or self.new_ou.get(name)
+
+    def policy_ref(self, name):
+        """
+        Return Id of deployed policy 'name', the op creating it, or None.
+        """
+        return (self.snapshot.policies.by_name(name, 'Id')
+                or self.new_policies.get(name))
+
+    def move(self, log, account_id, account_name, dest, dest_name,
+            reason=''):
+        """
+        Plan moving account 'account_id' to OU 'dest', an Id or the op
+        creating it.  Nothing is planned if the account is already
+        there, already has a move planned or has no known parent.
+        Return the MoveAccount op or None.
+        """
+        source_id = self.snapshot.parents.parent_of(account_id)
+        if not source_id:
+            log.error("Account '%s' not found in Organization tree" %
+                    account_name)
+            return None
+        if dest == source_id:
+            return None
+        if account_id in self.moves:
+            if self.moves[account_id].dest != dest:
+                log.error("Account '%s' is already moving to OU '%s', not "
+                        "moving it to '%s'" % (account_name,
+                        self.moves[account_id].dest_name, dest_name))
+            return None
+        return self.add(MoveAccount(account_id, account_name, source_id,
+                dest, dest_name, reason))
+
+    def moves_from(self, parent_id):
+        """
+        Return list of MoveAccount ops taking accounts out of 'parent_id'.
+        """
+        return [op for op in self.moves.values() if op.source_id == parent_id]
+
+    def levels(self):
+        """
+        Return ops grouped by depth in the dependency DAG.  Ops in the
+        same level do not depend on each other.
+        """
+        depth = {}
+        def op_depth(op):
+            if op not in depth:
+                depth[op] = 1 + max([op_depth(d) for d in op.deps] or [-1])
+            return depth[op]
+        levels = []
+        for op in self.ops:
+            d = op_depth(op)
+            while len(levels) <= d:
+                levels.append([])
+            levels[d].append(op)
+        return levels
+
+    def note(self, op, status, **fields):
+        """
+        Record the progress of 'op' in the journal, if there is one.
+        """
+        if self.journal is not None:
+            self.journal.append('op', key=op.key, status=status, **fields)
+
+    def display(self, log):
+        """
+        Log every op in dependency order.
+        """
+        for level in self.levels():
+            for op in level:
+                log.info(op.describe())
+
+    def apply(self, org_client, log, max_workers=APPLY_WORKERS):
+        """
+        Execute the plan.  Ops are started as soon as all their
+        dependencies succeeded, up to 'max_workers' at a time.  Ops
+        depending on a failed op are skipped.  Returns list of failed ops.
+        """
+        waiting = list(self.ops)
+        done = set()
+        failed = set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while waiting or running:
+                for op in list(waiting):
+                    if any(d in failed for d in op.deps):
+                        log.error("Skipped: %s. A dependency failed" %
+                                op.describe())
+                        op.finish('SKIPPED', 'a dependency failed')
+                        self.note(op, 'skipped')
+                        waiting.remove(op)
+                        failed.add(op)
+                    elif all(d in done for d in op.deps):
+                        log.info(op.describe())
+                        waiting.remove(op)
+                        self.note(op, 'started')
+                        running[executor.submit(op.apply, org_client)] = op
+                if not running:
+                    break
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    op = running.pop(future)
+                    if future.exception():
+                        log.error("Failed: %s: %s" % (op.describe(),
+                                future.exception()))
+                        op.finish('FAILED', str(future.exception()))
+                        self.note(op, 'failed', detail=op.detail)
+                        failed.add(op)
+                    else:
+                        op.record(self.snapshot)
+                        op.finish('APPLIED')
+                        self.note(op, 'done', result=op.result)
+                        done.add(op)
+        return [op for op in self.ops if op in failed]
@@ -0,0 +1,121 @@
+"""Compact records of deployed AWS Organization resources """
+import sys
+
+try:
+    intern_string = sys.intern
+except AttributeError:
+    # python 2 only interns byte strings.  boto3 returns unicode.
+    _strings = {}
+    def intern_string(value):
+        return _strings.setdefault(value, value)
+
+
+def intern_id(value):
+    """
+    Return the one shared copy of name or Id 'value'.  The same Ids and
+    names are returned by several listings; interned, each is stored once.
+    """
+    if value is None:
+        return None
+    return intern_string(value)
+
+
+class Record(object):
+    """
+    Base of compact read-only records of deployed resources.  A record
+    keeps only the fields named in its __slots__, which are those of the
+    API response the managers use.  It answers the dict reads the code
+    makes on responses: item['Name'], item.get('Email') and 'Id' in item.
+    A field that is None reads as missing.
+    """
+    __slots__ = ()
+
+    def __init__(self, item):
+        for field in self.__slots__:
+            setattr(self, field, item.get(field))
+
+    def __getitem__(self, field):
+        value = getattr(self, field, None) if field in self.__slots__ else None
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in self.__slots__ else None
+        return default if value is None else value
+
+    def __contains__(self, field):
+        return self.get(field) is not None
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (
+                field, getattr(self, field)) for field in self.__slots__))
+
+
+class AccountRecord(Record):
+    __slots__ = ('Id', 'Name', 'Email', 'Status')
+
+    def __init__(self, item):
+        self.Id = intern_id(item.get('Id'))
+        self.Name = intern_id(item.get('Name'))
+        self.Email = item.get('Email')
+        self.Status = intern_id(item.get('Status'))
+
+
+class PolicyRecord(Record):
+    __slots__ = ('Id', 'Name', 'Description', 'Type', 'AwsManaged')
+
+    def __init__(self, item):
+        Record.__init__(self, item)
+        self.Id = intern_id(self.Id)
+        self.Name = intern_id(self.Name)
+        self.Type = intern_id(self.Type)
+
+
+class OURecord(Record):
+    """
+    Deployed root or OU.  'parent' is the position of the parent OU in
+    the list the record belongs to, -1 for the root.  'Child_OU' and
+    'Accounts' are tuples of the names of its child OUs and accounts, if
+    they were listed.
+    """
+    __slots__ = ('Id', 'Name', 'parent', 'Child_OU', 'Accounts')
+
+    def __init__(self, item, parent=-1):
+        self.Id = intern_id(item.get('Id'))
+        self.Name = intern_id(item.get('Name'))
+        self.parent = parent
+        self.Child_OU = _names(item.get('Child_OU'))
+        self.Accounts = _names(item.get('Accounts'))
+
+
+def _names(names):
+    if names is None:
+        return None
+    return tuple(intern_id(name) for name in names)
+
+
+def account_records(items):
+    """
+    Return list of AccountRecord for the account responses in 'items'
+    that have a 'Name'.
+    """
+    return [a if isinstance(a, Record) else AccountRecord(a)
+            for a in items if 'Name' in a]
+
+
+def policy_records(items):
+    return [p if isinstance(p, Record) else PolicyRecord(p) for p in items]
+
+
+def ou_records(items):
+    """
+    Return list of OURecord for the OU dicts in 'items', in the same
+    order.  The 'ParentId' of each OU is replaced by the position of its
+    parent in the list.
+    """
+    if all(isinstance(ou, Record) for ou in items):
+        return list(items)
+    position = dict((ou['Id'], i) for i, ou in enumerate(items))
+    return [ou if isinstance(ou, Record) else OURecord(ou,
+            position.get(ou.get('ParentId'), -1)) for ou in items]
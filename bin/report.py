@@ -0,0 +1,180 @@
+"""Streaming reports of a deployed AWS Organization """
+import csv
+import json
+
+REPORT_FORMATS = ('text', 'json', 'csv', 'ndjson')
+
+# text report layout
+TAB = '  '
+NAME_WIDTH = 24
+
+
+def account_rows(snapshot):
+    """
+    Yield one row per deployed account, sorted by name.
+    """
+    for account in sorted(snapshot.accounts, key=lambda a: a['Name']):
+        yield dict(
+            Name = account['Name'],
+            Id = account.get('Id'),
+            Email = account.get('Email'),
+            Status = account.get('Status'),
+        )
+
+
+def ou_rows(attachment_index, snapshot, root_name='root'):
+    """
+    Yield one row per deployed OU in depth first order, starting at
+    'root_name'.  Each OU is visited once.  Child OUs are found through
+    their parent, so OUs of the same name under different parents are
+    told apart.
+    """
+    children = {}
+    for ou in snapshot.ou:
+        parent_id = snapshot.ou.parent(ou, 'Id')
+        if parent_id:
+            children.setdefault(parent_id, {})[ou['Name']] = ou
+    stack = [(snapshot.ou.by_name(root_name), None, 0)]
+    while stack:
+        ou, parent_name, depth = stack.pop()
+        child_ou = ou.get('Child_OU') or []
+        yield dict(
+            Name = ou['Name'],
+            Id = ou['Id'],
+            Parent = parent_name,
+            Depth = depth,
+            Policies = sorted(snapshot.policies.by_id(p_id, 'Name')
+                    for p_id in attachment_index.policies_for(ou['Id'])),
+            Accounts = sorted(ou.get('Accounts') or []),
+            Child_OU = list(child_ou),
+        )
+        named = children.get(ou['Id'], {})
+        for name in reversed(child_ou):
+            stack.append((named.get(name) or snapshot.ou.by_name(name),
+                    ou['Name'], depth + 1))
+
+
+def policy_rows(policy_store, snapshot):
+    """
+    Yield one row per deployed Service Control Policy.
+    """
+    for policy in snapshot.policies:
+        yield dict(
+            Name = policy['Name'],
+            Id = policy['Id'],
+            Description = policy.get('Description'),
+            Content = policy_store.document(policy['Id']),
+        )
+
+
+def account_text(row):
+    spacer = ' ' * (NAME_WIDTH - len(row['Name']))
+    return ["%s%s%s\t\t%s" % (row['Name'], spacer, row['Id'], row['Email'])]
+
+
+def ou_text(row):
+    indent = TAB * 2 * row['Depth']
+    lines = [indent + row['Name'] + ':']
+    if row['Policies']:
+        lines.append(indent + TAB + 'Policies: ' + ', '.join(row['Policies']))
+    if row['Accounts']:
+        lines.append(indent + TAB + 'Accounts: ' + ', '.join(row['Accounts']))
+    if row['Child_OU']:
+        lines.append(indent + TAB + 'Child_OU:')
+    return lines
+
+
+def policy_text(row):
+    return [
+        "\nName:\t\t%s" % row['Name'],
+        "Description:\t%s" % row['Description'],
+        "Id:\t%s" % row['Id'],
+        "Content:",
+        json.dumps(row['Content'], indent=2, separators=(',', ': ')),
+    ]
+
+
+class Section(object):
+    """
+    One table of a report: 'name' keys it in json output, 'title' heads
+    it in text output, 'fields' are the csv columns and 'text' renders a
+    row as a list of text lines.  'rows' may be any iterable and is
+    consumed once.
+    """
+    def __init__(self, name, title, fields, rows, text):
+        self.name = name
+        self.title = title
+        self.fields = fields
+        self.rows = rows
+        self.text = text
+
+
+def _csv_value(value):
+    if isinstance(value, list):
+        return ';'.join(value)
+    if isinstance(value, dict):
+        return json.dumps(value, sort_keys=True, separators=(',', ':'))
+    return value
+
+
+def write_report(out, report_format, sections):
+    """
+    Write 'sections' to file object 'out' in 'report_format'.  Rows are
+    written as they are produced, nothing is buffered.  json output is a
+    mapping of section name to list of rows.  ndjson and csv rows carry
+    the section name in a 'Report' column.
+    """
+    if report_format not in REPORT_FORMATS:
+        raise RuntimeError("Unknown report format '%s'. Use one of: %s"
+                % (report_format, ', '.join(REPORT_FORMATS)))
+    if report_format == 'json':
+        out.write('{')
+    for i, section in enumerate(sections):
+        if report_format == 'text':
+            overbar = '_' * len(section.title)
+            out.write("\n%s\n%s\n" % (overbar, section.title))
+            for row in section.rows:
+                for line in section.text(row):
+                    out.write(line + '\n')
+        elif report_format == 'json':
+            out.write('%s\n%s: [' % (',' if i else '', json.dumps(section.name)))
+            for j, row in enumerate(section.rows):
+                out.write('%s\n  %s' % (',' if j else '',
+                        json.dumps(row, sort_keys=True)))
+            out.write('\n]')
+        elif report_format == 'ndjson':
+            for row in section.rows:
+                row['Report'] = section.name
+                out.write(json.dumps(row, sort_keys=True) + '\n')
+        elif report_format == 'csv':
+            writer = csv.writer(out, lineterminator='\n')
+            if i:
+                out.write('\n')
+            writer.writerow(['Report'] + section.fields)
+            for row in section.rows:
+                writer.writerow([section.name] +
+                        [_csv_value(row.get(f)) for f in section.fields])
+        out.flush()
+    if report_format == 'json':
+        out.write('\n}\n')
+        out.flush()
+
+
+def account_report(snapshot):
+    return Section('accounts', "Provisioned Accounts in Org:",
+            ['Name', 'Id', 'Email', 'Status'],
+            account_rows(snapshot), account_text)
+
+
+def ou_report(attachment_index, snapshot):
+    return Section('organizational_units',
+            "Provisioned Organizational Units in Org:",
+            ['Name', 'Id', 'Parent', 'Depth', 'Policies', 'Accounts',
+                'Child_OU'],
+            ou_rows(attachment_index, snapshot), ou_text)
+
+
+def policy_report(policy_store, snapshot):
+    return Section('policies', "Provisioned Service Control Policies:",
+            ['Name', 'Id', 'Description', 'Content'],
+            policy_rows(policy_store, snapshot), policy_text)
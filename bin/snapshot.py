@@ -0,0 +1,154 @@
+"""Save and load deployed AWS Organization state for offline runs """
+import json
+import os
+import time
+
+from inventory import PolicyStore, get_attachment_index
+from utils import paginate
+
+SNAPSHOT_VERSION = 1
+CREATE_ACCOUNT_STATES = ['SUCCEEDED', 'IN_PROGRESS']
+
+
+def save_snapshot(log, org_client, snapshot, file_name, policy_store=None,
+        attachment_index=None):
+    """
+    Serialize OrgSnapshot 'snapshot' plus policy contents, policy
+    attachments and account creation status to 'file_name'.  Policy
+    documents already in 'policy_store' and a complete 'attachment_index'
+    are not downloaded again.  The file is replaced atomically.
+    """
+    log.info("Saving snapshot to '%s'" % file_name)
+    if policy_store is None:
+        policy_store = PolicyStore()
+    policy_store.fetch(org_client, [p['Id'] for p in snapshot.policies])
+    if attachment_index is None or not attachment_index.complete:
+        attachment_index = get_attachment_index(org_client, snapshot,
+                complete=True)
+    policy_content = {}
+    attachments = {}
+    for policy in snapshot.policies:
+        policy_content[policy['Id']] = policy_store.content(policy['Id'])
+        for target_id in sorted(attachment_index.targets_for(policy['Id'])):
+            attachments.setdefault(target_id, []).append(policy['Id'])
+    data = dict(
+        version = SNAPSHOT_VERSION,
+        created = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        root = snapshot.root,
+        master_account_id = snapshot.master_account_id,
+        accounts = [_pick(a, 'Id', 'Name', 'Email', 'Status')
+                for a in snapshot.accounts],
+        ou = [dict(Id=ou['Id'], Name=ou['Name'],
+                ParentId=snapshot.ou.parent(ou, 'Id'))
+                for ou in snapshot.ou if ou['Id'] != snapshot.root_id],
+        parents = dict((a['Id'], snapshot.parents.parent_of(a['Id']))
+                for a in snapshot.accounts if a['Id'] in snapshot.parents),
+        policies = [_pick(p, 'Id', 'Name', 'Description', 'Type', 'AwsManaged')
+                for p in snapshot.policies],
+        policy_content = policy_content,
+        attachments = attachments,
+        create_account_status = paginate(org_client.list_create_account_status,
+                'CreateAccountStatuses', States=CREATE_ACCOUNT_STATES),
+    )
+    tmp_file = '%s.%d.tmp' % (file_name, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f, separators=(',', ':'), default=str)
+    os.rename(tmp_file, file_name)
+
+
+def _pick(d, *keys):
+    return dict((k, d[k]) for k in keys if k in d)
+
+
+def load_snapshot_file(file_name):
+    """
+    Load a snapshot file written by save_snapshot().
+    """
+    with open(file_name) as f:
+        data = json.load(f)
+    if data.get('version') != SNAPSHOT_VERSION:
+        raise RuntimeError("Snapshot file '%s' has version '%s', expected '%s'"
+                % (file_name, data.get('version'), SNAPSHOT_VERSION))
+    return data
+
+
+class SnapshotClient(object):
+    """
+    Read-only stand-in for the AWS Organizations client, answering the
+    API calls used by the managers from a loaded snapshot.  Makes no
+    network calls.  Mutating calls raise RuntimeError.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.root = data['root']
+        self.accounts = dict((a['Id'], a) for a in data['accounts'])
+        self.ou = dict((ou['Id'], ou) for ou in data['ou'])
+        self.policies = dict((p['Id'], p) for p in data['policies'])
+        self.parents = data['parents']
+        self.attachments = data['attachments']
+        self.child_ou = {}
+        for ou in data['ou']:
+            self.child_ou.setdefault(ou['ParentId'], []).append(ou)
+        self.child_accounts = {}
+        for account_id, parent_id in self.parents.items():
+            if account_id in self.accounts:
+                self.child_accounts.setdefault(parent_id, []).append(
+                        self.accounts[account_id])
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def read_only(**kwargs):
+            raise RuntimeError("Snapshot client is read-only. Can not call "
+                    "'%s' when running from a snapshot" % name)
+        return read_only
+
+    def list_roots(self, **kwargs):
+        return dict(Roots=[self.root])
+
+    def describe_organization(self):
+        return dict(Organization=dict(
+                MasterAccountId=self.data['master_account_id']))
+
+    def list_accounts(self, **kwargs):
+        return dict(Accounts=list(self.data['accounts']))
+
+    def list_policies(self, Filter, **kwargs):
+        return dict(Policies=[p for p in self.data['policies']
+                if p.get('Type', Filter) == Filter])
+
+    def list_organizational_units_for_parent(self, ParentId, **kwargs):
+        return dict(OrganizationalUnits=[dict(Id=ou['Id'], Name=ou['Name'])
+                for ou in self.child_ou.get(ParentId, [])])
+
+    def list_accounts_for_parent(self, ParentId, **kwargs):
+        return dict(Accounts=list(self.child_accounts.get(ParentId, [])))
+
+    def list_parents(self, ChildId, **kwargs):
+        if ChildId in self.parents:
+            parent_id = self.parents[ChildId]
+        else:
+            parent_id = self.ou[ChildId]['ParentId']
+        if parent_id == self.root['Id']:
+            parent_type = 'ROOT'
+        else:
+            parent_type = 'ORGANIZATIONAL_UNIT'
+        return dict(Parents=[dict(Id=parent_id, Type=parent_type)])
+
+    def describe_policy(self, PolicyId):
+        return dict(Policy=dict(PolicySummary=self.policies[PolicyId],
+                Content=self.data['policy_content'][PolicyId]))
+
+    def list_policies_for_target(self, TargetId, Filter, **kwargs):
+        return dict(Policies=[self.policies[p_id]
+                for p_id in self.attachments.get(TargetId, [])])
+
+    def list_targets_for_policy(self, PolicyId, **kwargs):
+        return dict(Targets=[dict(TargetId=target_id)
+                for target_id, p_ids in sorted(self.attachments.items())
+                if PolicyId in p_ids])
+
+    def list_create_account_status(self, States, **kwargs):
+        return dict(CreateAccountStatuses=[s
+                for s in self.data['create_account_status']
+                if s['State'] in States])
@@ -6,29 +6,48 @@
 Usage:
   spec-generator generate [options] <account_name> <account_email> <business_contact_email> <tech_contact_email>
   spec-generator report [options] <account_name> <account_email> <business_contact_email> <tech_contact_email>
+  spec-generator bulk [options] --input FILE [--existing FILE]... [--split DIR]
   spec-generator (-h | --help)
   spec-generator --version
 
 Modes of operation:
   generate                      Generators a new spec file based on params.
   report                        Prints a generated spec file based on params.
+  bulk                          Generates specs for every account listed in a
+                                csv or json input file.
 
 options:
   -h, --help                            Show this help message and exit.
   -o FILE. --output-file FILE           Output location of the generated spec file.
   --version                             Display version info and exit.
+  -i FILE, --input FILE                 Csv file with a header row, or json list of
+                                        objects, with fields account_name,
+                                        account_email, business_contact_email and
+                                        tech_contact_email.
+  -e FILE, --existing FILE              Existing account spec file.  Accounts whose
+                                        name or email it already uses are rejected.
+                                        May be repeated.
+  --split DIR                           Write one spec file per account to new
+                                        directory DIR instead of one merged spec.
   -v, --verbose                         Log to activity to STDOUT at log level INFO.
   -d, --debug                           Increase log level to 'DEBUG'. Implies '--verbose'.
 
 """
 
+import csv
+import json
 from docopt import docopt
-import jinja2
 from utils import *
 from validate_email import validate_email
 
 OUTPUT_FILENAME = "output.yaml"
-SPEC_TEMPLATE_FILE =  jinja2.Template("""
+# columns of a bulk input file, named like the positional arguments
+BULK_FIELDS = ['account_name', 'account_email', 'business_contact_email',
+        'tech_contact_email']
+EMAIL_FIELDS = BULK_FIELDS[1:]
+# max number of concurrent email syntax checks
+VALIDATE_WORKERS = 8
+SPEC_TEMPLATE_FILE = """
 master_account_id: '599791326092'
 
 default_domain: adidas-group.com
@@ -46,7 +65,20 @@ accounts:
     Team: application_account_{{ account_name }}
     Template: https://github.com/contino/aws-terraform-open-digital-platform-template-account/tree/terraform
 
-""")
+"""
+# SPEC_TEMPLATE_FILE compiled on first use
+_spec_template = None
+
+def get_spec_template():
+    """
+    Return compiled SPEC_TEMPLATE_FILE.  jinja2 is imported on first use
+    only, so '--help' and invalid input do not pay for it.
+    """
+    global _spec_template
+    if _spec_template is None:
+        import jinja2
+        _spec_template = jinja2.Template(SPEC_TEMPLATE_FILE)
+    return _spec_template
 
 def is_args_validate(log, args):
     is_valid = True
@@ -73,10 +105,155 @@ def is_args_validate(log, args):
     return is_valid
 
 
+def load_bulk_input(log, file_name):
+    """
+    Return list of account dictionaries read from 'file_name'.  Files
+    ending in '.json' hold a list of objects, anything else is read as
+    csv with a header row.
+    """
+    log.debug("loading bulk input '%s'", file_name)
+    with open(file_name) as f:
+        if file_name.lower().endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    return [dict((field, (row.get(field) or '').strip())
+            for field in BULK_FIELDS) for row in rows]
+
+def validate_emails(emails, max_workers=VALIDATE_WORKERS):
+    """
+    Syntax check every address in 'emails' concurrently.  No DNS or SMTP
+    lookups are made.  Return dict of address to result.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    unique = sorted(set(emails))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(unique, executor.map(validate_email, unique)))
+
+def existing_accounts(log, spec_files):
+    """
+    Return sets of the names and of the lower case emails of accounts in
+    account spec files 'spec_files'.  An account without 'Email' uses its
+    spec's default_domain.
+    """
+    names = set()
+    emails = set()
+    for spec_file in spec_files:
+        spec = load_spec_file(log, spec_file) or {}
+        for a_spec in spec.get('accounts') or []:
+            names.add(a_spec['Name'])
+            email = a_spec.get('Email') or '%s@%s' % (a_spec['Name'],
+                    spec.get('default_domain'))
+            emails.add(email.lower())
+    return names, emails
+
+def is_bulk_input_valid(log, accounts, existing_names, existing_emails):
+    """
+    Check every account of a bulk input.  Log all missing fields, invalid
+    emails and names or account emails used twice in the input or
+    already used by an existing spec.  Entries are numbered from 1.
+    """
+    is_valid = True
+    results = validate_emails([account[field] for account in accounts
+            for field in EMAIL_FIELDS if account[field]])
+    seen = dict(account_name={}, account_email={})
+    existing = dict(account_name=existing_names, account_email=existing_emails)
+    for entry, account in enumerate(accounts, 1):
+        for field in BULK_FIELDS:
+            if not account[field]:
+                log.error("Entry %d: %s is required.", entry, field)
+                is_valid = False
+            elif field in EMAIL_FIELDS and not results[account[field]]:
+                log.error("Entry %d: Email entered is not valid: %s",
+                        entry, account[field])
+                is_valid = False
+        for field in ('account_name', 'account_email'):
+            value = account[field]
+            if field == 'account_email':
+                value = value.lower()
+            if not value:
+                continue
+            if value in seen[field]:
+                log.error("Entry %d: %s '%s' already used by entry %d",
+                        entry, field, account[field], seen[field][value])
+                is_valid = False
+            elif value in existing[field]:
+                log.error("Entry %d: %s '%s' already used by an existing "
+                        "spec", entry, field, account[field])
+                is_valid = False
+            seen[field].setdefault(value, entry)
+    return is_valid
+
+def render_spec(account):
+    return get_spec_template().render(**account)
+
+def write_atomic(file_name, content):
+    """
+    Write 'content' to a temporary file and rename it to 'file_name'.
+    """
+    tmp_file = '%s.%d.tmp' % (file_name, os.getpid())
+    with open(tmp_file, 'w') as f:
+        f.write(content)
+    os.rename(tmp_file, file_name)
+
+def write_split_specs(log, dir_name, rendered):
+    """
+    Write dict of account name to rendered spec as one file per account
+    into new directory 'dir_name'.  The files are written to a temporary
+    directory that is renamed to 'dir_name' once complete.
+    """
+    dir_name = dir_name.rstrip(os.sep)
+    if os.path.exists(dir_name):
+        log.error("Output directory '%s' already exists.", dir_name)
+        sys.exit(1)
+    tmp_dir = '%s.%d.tmp' % (dir_name, os.getpid())
+    os.makedirs(tmp_dir)
+    for account_name, spec_text in sorted(rendered.items()):
+        with open(os.path.join(tmp_dir, account_name + '.yaml'), 'w') as f:
+            f.write(spec_text)
+    os.rename(tmp_dir, dir_name)
+
+def generate_bulk(log, args):
+    """
+    Validate the whole bulk input first, then render every account with
+    SPEC_TEMPLATE_FILE and write all specs in one atomic step.
+    """
+    import yaml
+    from utils import SpecLoader
+    accounts = load_bulk_input(log, args['--input'])
+    existing_names, existing_emails = existing_accounts(log, args['--existing'])
+    if not is_bulk_input_valid(log, accounts, existing_names, existing_emails):
+        log.error("Input file '%s' is not valid.", args['--input'])
+        sys.exit(1)
+    rendered = dict((account['account_name'], render_spec(account))
+            for account in accounts)
+    # the merged spec is validated even when writing one file per account
+    spec = {}
+    for account in accounts:
+        merge_spec(spec, yaml.load(rendered[account['account_name']],
+                Loader=SpecLoader))
+    if not validate_spec(log, 'account_spec', spec, args['--input']):
+        log.error("Generated specs failed syntax validation.")
+        sys.exit(1)
+    if args['--split']:
+        log.info("generating %d files in: %s", len(rendered), args['--split'])
+        write_split_specs(log, args['--split'], rendered)
+        return
+    filename = OUTPUT_FILENAME
+    if(args["--output-file"]):
+        filename = args["--output-file"] + "/" + OUTPUT_FILENAME
+    log.info("generating file with %d accounts: %s", len(accounts), filename)
+    write_atomic(filename, yaml.safe_dump(spec, default_flow_style=False))
+
+
 def main():
     args = docopt(__doc__, version='1.0')
     log = get_logger(args, os.path.basename(__file__).split('.')[0])
 
+    if args['bulk']:
+        generate_bulk(log, args)
+        return
+
     #validate args
     log.debug("validating params...")
     if(not is_args_validate(log, args)):
@@ -92,7 +269,7 @@ def main():
             filename = args["--output-file"] + "/" + OUTPUT_FILENAME
 
         with open(filename, "w") as yaml_file:
-            yaml_file.write(SPEC_TEMPLATE_FILE.render(
+            yaml_file.write(get_spec_template().render(
                 account_name = args["<account_name>"],
                 account_email = args["<account_email>"],
                 business_contact_email = args["<business_contact_email>"],
@@ -101,7 +278,7 @@ def main():
             ))
 
     if args['report']:
-        sys.stdout.write(SPEC_TEMPLATE_FILE.render(
+        sys.stdout.write(get_spec_template().render(
                 account_name = args["<account_name>"],
                 account_email = args["<account_email>"],
                 business_contact_email = args["<business_contact_email>"],
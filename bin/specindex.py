@@ -0,0 +1,59 @@
+"""Indexed view of an org spec for cross-checks """
+
+
+class SpecIndex(object):
+    """
+    Maps over the OU tree of an org spec, built in one walk: account to
+    OU, OU to parent, OU to policies and policy to OUs.  'managed' holds
+    the sets of account, OU and policy names the spec manages.  The
+    default policy is always managed.  Accounts listed in more than one
+    OU are kept in 'duplicates'.
+    """
+    def __init__(self, org_spec):
+        self.account_ou = {}
+        self.ou_parent = {}
+        self.ou_policies = {}
+        self.policy_ou = {}
+        self.duplicates = {}
+        stack = [(ou_spec, None) for ou_spec in
+                reversed(org_spec.get('organizational_units') or [])]
+        while stack:
+            ou_spec, parent_name = stack.pop()
+            name = ou_spec['Name']
+            self.ou_parent[name] = parent_name
+            policies = ou_spec.get('SC_Policies')
+            self.ou_policies[name] = list(policies) if isinstance(policies, list) else []
+            for policy_name in self.ou_policies[name]:
+                self.policy_ou.setdefault(policy_name, set()).add(name)
+            for account in ou_spec.get('Accounts') or []:
+                if account in self.account_ou:
+                    self.duplicates.setdefault(account,
+                            [self.account_ou[account]]).append(name)
+                else:
+                    self.account_ou[account] = name
+            stack += [(child_spec, name) for child_spec in
+                    reversed(ou_spec.get('Child_OU') or [])]
+        policies = set(p_spec['Name'] for p_spec in
+                org_spec.get('sc_policies') or [])
+        if org_spec.get('default_policy'):
+            policies.add(org_spec['default_policy'])
+        self.managed = dict(
+            accounts = set(self.account_ou),
+            ou = set(self.ou_parent),
+            policies = policies,
+        )
+
+    def unmanaged(self, key, names):
+        """
+        Return list of the names in 'names' not managed as 'key', one of
+        'accounts', 'ou' or 'policies'.  The order of 'names' is kept.
+        """
+        managed = self.managed[key]
+        return [name for name in names if name not in managed]
+
+    def missing(self, key, names):
+        """
+        Return sorted list of names managed as 'key' that are not in
+        'names'.
+        """
+        return sorted(self.managed[key].difference(names))
@@ -0,0 +1,339 @@
+"""Cross-account CloudFormation baseline stack deployment """
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from inventory import canonical_json
+from orgclient import ThrottledClient, boto_client, error_code
+from templates import check_template
+from utils import assume_role_credentials, get_client
+
+BASELINE_CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'config', 'create-account.json')
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'cloudformation')
+DEFAULT_ROLE_NAME = 'OrganizationAccountAccessRole'
+DEPLOYED_VERSION = 1
+# the deployed record is kept next to the config file
+DEPLOYED_SUFFIX = '.deployed.json'
+# threads starting and polling stacks.  Stacks in flight are capped per
+# region separately.
+DEPLOY_WORKERS = 16
+CAPABILITIES = ['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM']
+STACK_SUCCEEDED = ('CREATE_COMPLETE', 'UPDATE_COMPLETE')
+# a stack in one of these states can not be updated
+STACK_UNUSABLE = ('ROLLBACK_COMPLETE', 'ROLLBACK_FAILED', 'DELETE_FAILED')
+
+
+def load_baseline_config(log, config_file=BASELINE_CONFIG_FILE):
+    """
+    Return dict of account entries in create-account.json 'config_file',
+    keyed by entry name.  The file holds a list of dicts of entries.
+    """
+    log.debug("loading '%s'" % config_file)
+    with open(config_file) as f:
+        data = json.load(f)
+    entries = {}
+    for item in data if isinstance(data, list) else [data]:
+        entries.update(item)
+    return entries
+
+
+def template_digest(template_body, parameters):
+    """
+    Return sha256 hex digest of a template and its stack parameters.
+    """
+    return hashlib.sha256(canonical_json([template_body, parameters]).encode(
+            'utf-8')).hexdigest()
+
+
+class StackDeployment(object):
+    """
+    One baseline stack to create or update in one account and region.
+    'state' is PENDING, SKIPPED, IN_PROGRESS, SUCCEEDED or FAILED.
+    """
+    def __init__(self, name, account_name, account_id, region, stack_name,
+            role_name, template_file, template_body, parameters):
+        self.name = name
+        self.account_name = account_name
+        self.account_id = account_id
+        self.region = region
+        self.stack_name = stack_name
+        self.role_name = role_name
+        self.template_file = template_file
+        self.template_body = template_body
+        self.parameters = parameters
+        self.digest = template_digest(template_body, parameters)
+        self.state = 'PENDING'
+        self.action = None
+        self.stack_id = None
+        self.detail = ''
+        self.client = None
+
+    @property
+    def key(self):
+        return '%s:%s:%s' % (self.account_id, self.region, self.stack_name)
+
+    def describe(self):
+        return "stack '%s' in account '%s' (%s) in %s" % (self.stack_name,
+                self.account_name, self.account_id, self.region)
+
+    def fail(self, detail):
+        self.state = 'FAILED'
+        self.detail = detail
+
+
+def get_deployments(log, entries, regions, account_ids, stack_prefix,
+        template_dir=TEMPLATE_DIR):
+    """
+    Return list of StackDeployment for every entry of 'entries' with a
+    'cloudformationTemplate', in each of 'regions'.  Accounts are looked
+    up by 'accountName' in dict 'account_ids', unless the entry has an
+    'accountId'.  Stack parameters are read from the optional
+    'cloudformationParameters' dict.  Entries that can not be deployed
+    are returned FAILED.
+    """
+    deployments = []
+    for name in sorted(entries):
+        entry = entries[name]
+        template = entry.get('cloudformationTemplate')
+        if not template:
+            log.debug("no cloudformationTemplate for '%s'" % name)
+            continue
+        template_file = os.path.join(template_dir, template)
+        account_id = entry.get('accountId') or account_ids.get(
+                entry.get('accountName'))
+        template_body = ''
+        detail = ''
+        if not account_id:
+            detail = "Account '%s' not found in Organization" % entry.get(
+                    'accountName')
+        elif not os.path.isfile(template_file):
+            detail = "Template '%s' not found" % template_file
+        else:
+            with open(template_file) as f:
+                template_body = f.read()
+            errors = check_template(template_body)
+            if errors:
+                detail = "Template '%s': %s" % (template_file,
+                        '; '.join(errors))
+        parameters = entry.get('cloudformationParameters') or {}
+        stack_name = stack_prefix + os.path.splitext(os.path.basename(
+                template))[0]
+        for region in regions:
+            deployment = StackDeployment(name, entry.get('accountName', name),
+                    account_id, region, stack_name,
+                    entry.get('iamRoleName') or DEFAULT_ROLE_NAME,
+                    template_file, template_body, parameters)
+            if detail:
+                log.error("Can not deploy %s: %s" % (deployment.describe(),
+                        detail))
+                deployment.fail(detail)
+            deployments.append(deployment)
+    return deployments
+
+
+def deployed_record_file(config_file):
+    return config_file + DEPLOYED_SUFFIX
+
+
+def load_deployed(log, file_name):
+    """
+    Return dict of deployed stacks keyed by StackDeployment.key from
+    record 'file_name'.  Empty if there is no usable record.
+    """
+    try:
+        with open(file_name) as f:
+            record = json.load(f)
+    except (IOError, OSError, ValueError):
+        log.debug("no deployed record '%s'" % file_name)
+        return {}
+    if record.get('version') != DEPLOYED_VERSION:
+        log.info("Ignoring deployed record '%s' with version '%s'" %
+                (file_name, record.get('version')))
+        return {}
+    return record['stacks']
+
+
+def save_deployed(log, file_name, deployed, deployments):
+    """
+    Add the stacks that succeeded in 'deployments' to record 'deployed'
+    and write it to 'file_name'.  Failed stacks are dropped from the
+    record, so the next run deploys them again.  The file is replaced
+    atomically.
+    """
+    stacks = dict(deployed)
+    for d in deployments:
+        if d.state == 'SUCCEEDED':
+            stacks[d.key] = dict(digest=d.digest, stack_id=d.stack_id,
+                    template=os.path.basename(d.template_file),
+                    deployed=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+        elif d.state == 'FAILED':
+            stacks.pop(d.key, None)
+    log.info("Saving deployed record to '%s'" % file_name)
+    tmp_file = '%s.%d.tmp' % (file_name, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(dict(version=DEPLOYED_VERSION, stacks=stacks), f, indent=1,
+                sort_keys=True)
+    os.rename(tmp_file, file_name)
+
+
+def skip_unchanged(log, deployments, deployed):
+    """
+    Mark SKIPPED the pending deployments whose template and parameters
+    digest matches the last successful deploy in 'deployed'.
+    """
+    for d in deployments:
+        if d.state == 'PENDING' and deployed.get(d.key, {}).get(
+                'digest') == d.digest:
+            log.debug("unchanged: %s" % d.describe())
+            d.state = 'SKIPPED'
+            d.stack_id = deployed[d.key].get('stack_id')
+            d.detail = 'unchanged'
+
+
+class RoleClients(object):
+    """
+    CloudFormation clients acting in member accounts through an assumed
+    role.  Credentials come from utils.assume_role_credentials(), so each
+    account's role is assumed once, shared by the clients for all
+    regions and reused by later runs until shortly before it expires.
+    """
+    def __init__(self, log, profile=None, concurrency=DEPLOY_WORKERS):
+        self.log = log
+        self.profile = profile
+        self.concurrency = concurrency
+        self.sts_client = None
+        self._lock = threading.Lock()
+
+    def __call__(self, account_id, region, role_name):
+        with self._lock:
+            if self.sts_client is None:
+                self.sts_client = ThrottledClient(boto_client('sts',
+                        self.concurrency), log=self.log, profile=self.profile)
+        credentials = assume_role_credentials(self.log, account_id, role_name,
+                'baseline-manager', self.sts_client)
+        return ThrottledClient(get_client('cloudformation', region,
+                credentials, self.concurrency, retries=False), log=self.log,
+                profile=self.profile)
+
+
+def start_deployment(log, deployment, client_factory):
+    """
+    Create the stack of 'deployment', or update it if it exists.  An
+    update with no changes succeeds at once.
+    """
+    d = deployment
+    try:
+        d.client = client_factory(d.account_id, d.region, d.role_name)
+        try:
+            stack = d.client.describe_stacks(StackName=d.stack_name)['Stacks'][0]
+        except Exception as e:
+            if error_code(e) != 'ValidationError':
+                raise
+            stack = None
+        request = dict(StackName=d.stack_name, TemplateBody=d.template_body,
+                Parameters=[dict(ParameterKey=k, ParameterValue=str(v))
+                        for k, v in sorted(d.parameters.items())],
+                Capabilities=CAPABILITIES)
+        if stack is None:
+            d.action = 'create'
+            log.info("Creating %s" % d.describe())
+            d.stack_id = d.client.create_stack(**request)['StackId']
+        elif stack['StackStatus'] in STACK_UNUSABLE:
+            d.fail("Stack is %s. Delete it to deploy again" %
+                    stack['StackStatus'])
+            return
+        else:
+            d.action = 'update'
+            d.stack_id = stack['StackId']
+            log.info("Updating %s" % d.describe())
+            try:
+                d.client.update_stack(**request)
+            except Exception as e:
+                if (error_code(e) != 'ValidationError'
+                        or 'No updates are to be performed' not in str(e)):
+                    raise
+                d.state = 'SUCCEEDED'
+                d.detail = 'no changes'
+                return
+        d.state = 'IN_PROGRESS'
+    except Exception as e:
+        if error_code(e) is None:
+            raise
+        d.fail(str(e))
+
+
+def poll_deployment(deployment):
+    """
+    Update the state of an IN_PROGRESS 'deployment' from its stack status.
+    """
+    d = deployment
+    try:
+        stack = d.client.describe_stacks(StackName=d.stack_id)['Stacks'][0]
+    except Exception as e:
+        if error_code(e) is None:
+            raise
+        d.fail(str(e))
+        return
+    status = stack['StackStatus']
+    if status.endswith('_IN_PROGRESS'):
+        return
+    if status in STACK_SUCCEEDED:
+        d.state = 'SUCCEEDED'
+        d.detail = ''
+    else:
+        d.fail('%s: %s' % (status, stack.get('StackStatusReason', '')))
+
+
+def deploy_stacks(log, deployments, client_factory, max_per_region,
+        poll_interval, timeout, max_workers=DEPLOY_WORKERS):
+    """
+    Deploy the PENDING 'deployments' concurrently.  At most
+    'max_per_region' stacks are in flight per region; as stacks finish
+    the next ones start.  All stacks in flight are polled together every
+    'poll_interval' seconds.  'client_factory(account_id, region,
+    role_name)' returns the CloudFormation client for a deployment.
+    Stacks still in flight after 'timeout' seconds are left IN_PROGRESS.
+    """
+    queues = {}
+    for d in deployments:
+        if d.state == 'PENDING':
+            queues.setdefault(d.region, []).append(d)
+    in_flight = []
+    deadline = time.time() + timeout
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while any(queues.values()) or in_flight:
+            starting = []
+            for region, queue in sorted(queues.items()):
+                free = max_per_region - len([d for d in in_flight
+                        if d.region == region])
+                starting += queue[:free]
+                del queue[:free]
+            list(executor.map(lambda d: start_deployment(log, d,
+                    client_factory), starting))
+            for d in starting:
+                if d.state == 'IN_PROGRESS':
+                    in_flight.append(d)
+                elif d.state == 'FAILED':
+                    log.error("Failed: %s: %s" % (d.describe(), d.detail))
+            if not in_flight:
+                continue
+            if time.time() > deadline:
+                log.warn("Stack deployment still in progress. Moving on!")
+                break
+            time.sleep(poll_interval)
+            list(executor.map(poll_deployment, in_flight))
+            for d in in_flight:
+                if d.state == 'SUCCEEDED':
+                    log.info("Deployed %s" % d.describe())
+                elif d.state == 'FAILED':
+                    log.error("Failed: %s: %s" % (d.describe(), d.detail))
+            in_flight = [d for d in in_flight if d.state == 'IN_PROGRESS']
+            if in_flight:
+                log.debug("in progress: %s" % ', '.join(d.key
+                        for d in in_flight))
+    return deployments
@@ -0,0 +1,165 @@
+"""Local checks and cached validation of CloudFormation templates """
+import hashlib
+import json
+import os
+import re
+import time
+
+import yaml
+from orgclient import error_code
+from utils import SpecLoader
+
+# largest template CloudFormation accepts as TemplateBody
+MAX_TEMPLATE_BODY = 51200
+MAX_RESOURCES = 500
+MAX_PARAMETERS = 200
+MAX_OUTPUTS = 200
+MAX_MAPPINGS = 200
+TEMPLATE_SECTIONS = ('AWSTemplateFormatVersion', 'Description', 'Metadata',
+        'Parameters', 'Rules', 'Mappings', 'Conditions', 'Transform',
+        'Resources', 'Outputs')
+RESOURCE_TYPE = re.compile(r'^((AWS|Alexa)::[A-Za-z0-9]+::[A-Za-z0-9]+'
+        r'|Custom::[A-Za-z0-9_@-]+|[A-Za-z0-9]+::[A-Za-z0-9]+::[A-Za-z0-9]+::MODULE)$')
+TEMPLATE_SUFFIXES = ('.template', '.json', '.yaml', '.yml')
+# on-disk cache of validate_template results, keyed by content hash
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'aws-org-manager',
+                'templates'))
+
+
+class TemplateLoader(SpecLoader):
+    """
+    Safe yaml loader that reads the CloudFormation short form of
+    intrinsic functions, like '!Ref' and '!Sub', into their long form.
+    """
+
+def _construct_intrinsic(loader, suffix, node):
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+        if suffix == 'GetAtt':
+            value = value.split('.', 1)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    return {suffix if suffix in ('Ref', 'Condition') else 'Fn::' + suffix: value}
+
+TemplateLoader.add_multi_constructor('!', _construct_intrinsic)
+
+
+def template_hash(template_body):
+    return hashlib.sha256(template_body.encode('utf-8')).hexdigest()
+
+
+def parse_template(template_body):
+    """
+    Parse a JSON or yaml template.  Raise ValueError if it does not parse.
+    """
+    if template_body.lstrip().startswith('{'):
+        return json.loads(template_body)
+    try:
+        return yaml.load(template_body, Loader=TemplateLoader)
+    except yaml.YAMLError as e:
+        raise ValueError(str(e))
+
+
+def check_template(template_body):
+    """
+    Check a template without calling AWS: it parses, fits the size and
+    count limits, has only known sections and every resource has a well
+    formed type.  Return list of errors found.
+    """
+    size = len(template_body.encode('utf-8'))
+    if size > MAX_TEMPLATE_BODY:
+        return ["Template is %d bytes, more than the limit of %d" %
+                (size, MAX_TEMPLATE_BODY)]
+    try:
+        template = parse_template(template_body)
+    except ValueError as e:
+        return ["Template does not parse: %s" % e]
+    if not isinstance(template, dict):
+        return ["Template is not a mapping"]
+    errors = ["Unknown template section '%s'" % key for key in sorted(template)
+            if key not in TEMPLATE_SECTIONS]
+    for section, limit in (('Parameters', MAX_PARAMETERS),
+            ('Outputs', MAX_OUTPUTS), ('Mappings', MAX_MAPPINGS),
+            ('Resources', MAX_RESOURCES)):
+        items = template.get(section)
+        if items is not None and not isinstance(items, dict):
+            errors.append("Section '%s' is not a mapping" % section)
+        elif items and len(items) > limit:
+            errors.append("Section '%s' has %d entries, more than the limit "
+                    "of %d" % (section, len(items), limit))
+    resources = template.get('Resources')
+    if not resources:
+        errors.append("Template has no resources")
+        return errors
+    if not isinstance(resources, dict):
+        return errors
+    for name in sorted(resources):
+        resource = resources[name]
+        if not isinstance(resource, dict) or 'Type' not in resource:
+            errors.append("Resource '%s' has no Type" % name)
+        elif not RESOURCE_TYPE.match(str(resource['Type'])):
+            errors.append("Resource '%s' has invalid Type '%s'" %
+                    (name, resource['Type']))
+    for name, parameter in sorted((template.get('Parameters') or {}).items()):
+        if not isinstance(parameter, dict) or 'Type' not in parameter:
+            errors.append("Parameter '%s' has no Type" % name)
+    return errors
+
+
+class ValidationCache(object):
+    """
+    validate_template results stored in 'cache_dir', one file per
+    template content hash.  Only answers from CloudFormation are cached,
+    never errors of the call itself.
+    """
+    def __init__(self, log, cache_dir=TEMPLATE_CACHE_DIR):
+        self.log = log
+        self.cache_dir = cache_dir
+
+    def get(self, digest):
+        try:
+            with open(os.path.join(self.cache_dir, digest + '.json')) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, digest, result):
+        # best effort: an unwritable cache is not an error
+        cache_file = os.path.join(self.cache_dir, digest + '.json')
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(result, f)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError):
+            self.log.debug("not caching result for '%s'" % digest)
+
+
+def validate_template(log, cf_client, template_body, cache=None):
+    """
+    Return (valid, detail) for 'template_body' from CloudFormation
+    validate_template, or from 'cache' if this content was validated
+    before.
+    """
+    digest = template_hash(template_body)
+    result = cache.get(digest) if cache is not None else None
+    if result is not None:
+        log.debug("validation result for '%s' from cache" % digest)
+        return result['valid'], result['detail']
+    try:
+        cf_client.validate_template(TemplateBody=template_body)
+        result = dict(valid=True, detail='')
+    except Exception as e:
+        if error_code(e) != 'ValidationError':
+            raise
+        result = dict(valid=False, detail=e.response['Error']['Message'])
+    if cache is not None:
+        result['validated'] = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                time.gmtime())
+        cache.put(digest, result)
+    return result['valid'], result['detail']
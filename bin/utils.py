@@ -1,47 +1,346 @@
 """Utility functions used by the various scripts """
+import calendar
+import hashlib
+import json
 import logging
 import os
-import pkg_resources
+import stat
 import sys
+import threading
+import time
 import yaml
+from concurrent.futures import ThreadPoolExecutor
+from records import account_records
+from validator import compile_patterns
+
+# use the libyaml C loader when available
+try:
+    from yaml import CSafeLoader as SpecLoader
+except ImportError:
+    from yaml import SafeLoader as SpecLoader
 
 PATTERN_FILE = '../data/spec-validation-patterns.yaml'
+# compiled spec validators, keyed by pattern file
+_spec_validators = {}
+# max number of concurrent API calls when crawling the OU tree
+CRAWL_WORKERS = 8
+# on-disk cache of parsed spec fragments, keyed by content hash
+SPEC_CACHE_DIR = os.environ.get('SPEC_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'aws-org-manager', 'specs'))
+SPEC_FRAGMENT_SUFFIXES = ('.yaml', '.yml')
+# boto3 client settings.  Pools never shrink below the botocore default.
+CLIENT_POOL_CONNECTIONS = 10
+# botocore retries after the first attempt, for clients not wrapped in a
+# ThrottledClient
+CLIENT_RETRY_ATTEMPTS = 3
+# on-disk cache of assumed role credentials
+CREDENTIAL_CACHE_DIR = os.environ.get('CREDENTIAL_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'aws-org-manager', 'credentials'))
+# cached credentials are renewed this many seconds before they expire
+CREDENTIAL_REFRESH_MARGIN = 300
+# one boto3 session per process, its clients and assumed role credentials
+_session = None
+_clients = {}
+_credentials = {}
+_credential_locks = {}
+_client_lock = threading.Lock()
 
-def load_validation_patterns(log):
+def load_validation_patterns(log, pattern_file=PATTERN_FILE):
     """
     Return dict of patterns for use when validating specification syntax
     """
 
-    log.debug("loading file: '%s'" % PATTERN_FILE)
-    filename =  os.path.abspath(pkg_resources.resource_filename(__name__, PATTERN_FILE))
-            # __name__, '../data/spec-validation-patterns.yaml'))
+    log.debug("loading file: '%s'" % pattern_file)
+    filename = os.path.abspath(os.path.join(os.path.dirname(__file__), pattern_file))
+    return load_yaml_file(log, filename)
+
+def _private_file(file_name):
+    '''
+    Return True if 'file_name' belongs to the current user and no one
+    else may write to it.
+    '''
+    st = os.stat(file_name)
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        return False
+    return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def load_yaml_file(log, file_name):
+    '''
+    Parse a yaml file with the safe loader.  The parsed data is cached as
+    json in SPEC_CACHE_DIR under the sha256 of the file content, so
+    unchanged files are not parsed again.  Data json does not round trip,
+    like dates or keys that are not strings, is not cached.  Cache files
+    other users could have written are ignored.
+    '''
+    with open(file_name, 'rb') as f:
+        content = f.read()
+    key = hashlib.sha256(content)
+    key.update(('json:%s' % yaml.__version__).encode('utf-8'))
+    cache_file = os.path.join(SPEC_CACHE_DIR, key.hexdigest())
+    try:
+        if _private_file(SPEC_CACHE_DIR) and _private_file(cache_file):
+            with open(cache_file) as f:
+                data = json.load(f)
+            log.debug("loaded '%s' from cache" % file_name)
+            return data
+    except (IOError, OSError, ValueError):
+        pass
+    data = yaml.load(content, Loader=SpecLoader)
+    # best effort: an unwritable cache or data json can not hold is not an error
+    try:
+        text = json.dumps(data)
+        if json.loads(text) != data:
+            raise ValueError('json does not round trip')
+        if not os.path.isdir(SPEC_CACHE_DIR):
+            os.makedirs(SPEC_CACHE_DIR, 0o700)
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError, ValueError, TypeError):
+        log.debug("not caching '%s'" % file_name)
+    return data
 
-    with open(filename) as f:
-        return yaml.load(f.read())
+def merge_spec(spec, fragment, path=''):
+    '''
+    Merge spec 'fragment' into 'spec' in place.  Dictionaries are merged
+    recursively.  In lists, dictionaries with the same 'Name' are merged,
+    other items are appended.  Conflicting scalar values raise an error.
+    '''
+    for key, value in fragment.items():
+        key_path = '%s.%s' % (path, key) if path else key
+        if key not in spec or spec[key] is None:
+            spec[key] = value
+        elif value is None:
+            continue
+        elif isinstance(spec[key], dict) and isinstance(value, dict):
+            merge_spec(spec[key], value, key_path)
+        elif isinstance(spec[key], list) and isinstance(value, list):
+            named = dict((item['Name'], item) for item in spec[key]
+                    if isinstance(item, dict) and 'Name' in item)
+            for item in value:
+                if isinstance(item, dict) and item.get('Name') in named:
+                    merge_spec(named[item['Name']], item,
+                            '%s[%s]' % (key_path, item['Name']))
+                elif item not in spec[key]:
+                    spec[key].append(item)
+        elif spec[key] != value:
+            raise RuntimeError("Spec fragments conflict at '%s': '%s' != '%s'"
+                    % (key_path, spec[key], value))
+    return spec
 
 def load_spec_file(log, file_name):
     '''
-    Load spec file.
+    Load spec file.  If 'file_name' is a directory, load all yaml
+    fragments in it, in name order, and merge them into one spec.
     '''
-    log.debug("loading file '%s'" % file_name)
-    with open(file_name) as f:
-        return yaml.load(f.read())
+    if not os.path.isdir(file_name):
+        log.debug("loading file '%s'" % file_name)
+        return load_yaml_file(log, file_name)
+    spec = {}
+    for name in sorted(os.listdir(file_name)):
+        if name.endswith(SPEC_FRAGMENT_SUFFIXES):
+            fragment_file = os.path.join(file_name, name)
+            log.debug("loading fragment '%s'" % fragment_file)
+            merge_spec(spec, load_yaml_file(log, fragment_file) or {})
+    return spec
 
 def validate_spec_file(log, spec_file, pattern_name):
     '''
     Validate spec-file is properly formed.
     '''
-    log.debug("loading spec file '%s'" % spec_file)
-    validation_patterns = load_validation_patterns(log)
-    #load spec file
-    spec = load_spec_file(log, spec_file)
-    log.debug("calling validate_spec() for pattern '%s'" % pattern_name)
-    if validate_spec(log, validation_patterns, pattern_name, spec):
-        return spec
-    else:
-        log.critical("Spec file '%s' failed syntax validation" % spec_file)
+    return validate_spec_files(log, [spec_file], pattern_name)[0][1]
+
+def validate_spec_files(log, spec_files, pattern_name):
+    '''
+    Load and validate every spec file in 'spec_files' before any of them
+    is used.  Exit if any failed validation.  Return list of
+    (spec_file, spec) tuples.  A file listed twice is loaded once.
+    '''
+    specs = []
+    failed = []
+    seen = set()
+    for spec_file in spec_files:
+        if spec_file in seen:
+            continue
+        seen.add(spec_file)
+        log.debug("loading spec file '%s'" % spec_file)
+        spec = load_spec_file(log, spec_file)
+        log.debug("calling validate_spec() for pattern '%s'" % pattern_name)
+        if validate_spec(log, pattern_name, spec, spec_file):
+            specs.append((spec_file, spec))
+        else:
+            log.critical("Spec file '%s' failed syntax validation" % spec_file)
+            failed.append(spec_file)
+    if failed:
+        sys.exit(1)
+    return specs
+
+def exit_on_conflicts(log, conflicts):
+    '''
+    Log every conflict found between spec files and exit if there is any.
+    '''
+    for conflict in conflicts:
+        log.error(conflict)
+    if conflicts:
+        log.critical("Spec files conflict in %d places" %
+                len(conflicts))
         sys.exit(1)
 
+# manager scripts imported as modules, keyed by file name
+_scripts = {}
+
+def load_script(file_name):
+    """
+    Import one of the manager scripts in this directory as a module.
+    """
+    if file_name not in _scripts:
+        name = os.path.splitext(file_name)[0].replace('-', '_')
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                file_name)
+        try:
+            import importlib.util
+        except ImportError:
+            import imp
+            _scripts[file_name] = imp.load_source(name, path)
+        else:
+            spec = importlib.util.spec_from_file_location(name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            _scripts[file_name] = module
+    return _scripts[file_name]
+
+def get_session():
+    """
+    Return the boto3 session shared by all clients of this process,
+    created on first use.  boto3 is imported only then.  Credentials of
+    profiles assuming a role are cached on disk like the AWS CLI does.
+    """
+    global _session
+    with _client_lock:
+        if _session is None:
+            import boto3
+            _session = boto3.session.Session()
+            try:
+                from botocore.credentials import JSONFileCache
+                _session._session.get_component('credential_provider'
+                        ).get_provider('assume-role').cache = JSONFileCache(
+                        CREDENTIAL_CACHE_DIR)
+            except (ImportError, AttributeError, KeyError):
+                pass
+        return _session
+
+def client_config(max_pool_connections, retries=True):
+    """
+    Return botocore Config with 'max_pool_connections', TCP keepalive
+    and the standard retry mode.  Unless 'retries', botocore makes each
+    call once, for clients wrapped in a ThrottledClient that does its own
+    retries.  Options older botocore releases do not know are left out.
+    """
+    from botocore.config import Config
+    from botocore.exceptions import BotoCoreError
+    options = dict(max_pool_connections=max_pool_connections,
+            retries=dict(mode='standard',
+                max_attempts=CLIENT_RETRY_ATTEMPTS if retries else 0),
+            tcp_keepalive=True)
+    for option in ('tcp_keepalive', 'retries'):
+        try:
+            return Config(**options)
+        except (TypeError, BotoCoreError):
+            options.pop(option)
+    return Config(**options)
+
+def get_client(service, region=None, credentials=None, concurrency=None,
+        retries=True):
+    """
+    Return a boto3 client for 'service' from the shared session.  Clients
+    are kept for the life of the process, keyed by service, region and
+    'credentials', a dict as returned by assume_role_credentials().  The
+    connection pool fits 'concurrency' calls in flight; a client with a
+    smaller pool is replaced.  'retries' is passed to client_config().
+    Clients are created with endpoint
+    $AWS_ENDPOINT_URL when it is set, to run against a local stand-in
+    such as moto in server mode.
+    """
+    pool = max(CLIENT_POOL_CONNECTIONS, concurrency or 0)
+    key = (service, region, credentials and credentials['AccessKeyId'],
+            retries)
+    session = get_session()
+    with _client_lock:
+        now = time.time()
+        for stale in [k for k, v in _clients.items() if v[2] < now]:
+            del _clients[stale]
+        if key not in _clients or _clients[key][1] < pool:
+            kwargs = {}
+            if credentials:
+                kwargs = dict(aws_access_key_id=credentials['AccessKeyId'],
+                        aws_secret_access_key=credentials['SecretAccessKey'],
+                        aws_session_token=credentials['SessionToken'])
+            if os.environ.get('AWS_ENDPOINT_URL'):
+                kwargs['endpoint_url'] = os.environ['AWS_ENDPOINT_URL']
+            # boto3 sessions are not thread safe: create clients one at a time
+            client = session.client(service, region_name=region,
+                    config=client_config(pool, retries), **kwargs)
+            _clients[key] = (client, pool, credentials['Expiration']
+                    if credentials else float('inf'))
+        return _clients[key][0]
+
+def _credential_file(role_arn, base_key):
+    digest = hashlib.sha256(('%s:%s' % (role_arn, base_key)).encode('utf-8'))
+    return os.path.join(CREDENTIAL_CACHE_DIR, 'role-%s.json' % digest.hexdigest())
+
+def assume_role_credentials(log, account_id, role_name,
+        session_name='aws-org-manager', sts_client=None):
+    """
+    Return credentials for 'role_name' in 'account_id', a dict with
+    AccessKeyId, SecretAccessKey, SessionToken and Expiration in epoch
+    seconds.  Credentials are kept in memory and in CREDENTIAL_CACHE_DIR,
+    readable by the owner only, until CREDENTIAL_REFRESH_MARGIN seconds
+    before they expire.  The cache is keyed by role and by the caller's
+    own access key.  Roles of different accounts are assumed concurrently.
+    """
+    role_arn = 'arn:aws:iam::%s:role/%s' % (account_id, role_name)
+    base_key = get_session().get_credentials().access_key
+    key = (role_arn, base_key)
+    with _client_lock:
+        lock = _credential_locks.setdefault(key, threading.Lock())
+    with lock:
+        credentials = _credentials.get(key)
+        cache_file = _credential_file(role_arn, base_key)
+        if credentials is None:
+            try:
+                with open(cache_file) as f:
+                    credentials = json.load(f)
+                log.debug("loaded credentials for '%s' from cache" % role_arn)
+            except (IOError, OSError, ValueError):
+                pass
+        if (credentials is None or credentials['Expiration'] -
+                CREDENTIAL_REFRESH_MARGIN < time.time()):
+            log.debug("assuming role '%s'" % role_arn)
+            response = (sts_client or get_client('sts')).assume_role(
+                    RoleArn=role_arn, RoleSessionName=session_name)
+            expiration = response['Credentials']['Expiration']
+            credentials = dict((k, response['Credentials'][k]) for k in
+                    ('AccessKeyId', 'SecretAccessKey', 'SessionToken'))
+            credentials['Expiration'] = (calendar.timegm(
+                    expiration.utctimetuple()) if hasattr(expiration,
+                    'utctimetuple') else float(expiration))
+            # best effort: an unwritable cache is not an error
+            try:
+                if not os.path.isdir(CREDENTIAL_CACHE_DIR):
+                    os.makedirs(CREDENTIAL_CACHE_DIR, 0o700)
+                tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+                fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                        0o600)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(credentials, f)
+                os.rename(tmp_file, cache_file)
+            except (IOError, OSError):
+                log.debug("not caching credentials for '%s'" % role_arn)
+        _credentials[key] = credentials
+        return credentials
+
 def get_template(template_file):
 
     '''
@@ -76,55 +375,78 @@ def get_root_org_id(org_client):
 def get_deployed_accounts(log, org_client):
     '''
     Query AWS Organization for deployed accounts.
-    Returns a list of dictionary.
+    Returns a list of compact account records.  Each page is reduced to
+    records as it arrives, so the full responses are never all held.
     '''
     log.debug('running')
     accounts = org_client.list_accounts()
-    deployed_accounts = accounts['Accounts']
+    # only return accounts that have an 'Name' key
+    deployed_accounts = account_records(accounts['Accounts'])
     while 'NextToken' in accounts and accounts['NextToken']:
         log.debug("NextToken: %s" % accounts['NextToken'])
         accounts = org_client.list_accounts(NextToken=accounts['NextToken'])
-        deployed_accounts += accounts['Accounts']
-    # only return accounts that have an 'Name' key
-    return [d for d in deployed_accounts if 'Name' in d ]
-    return created_accounts
+        deployed_accounts += account_records(accounts['Accounts'])
+    return deployed_accounts
 
 
 def get_deployed_policies(org_client):
     '''
     Return list of Service Control Policies deployed in Organization
     '''
-    return org_client.list_policies(Filter='SERVICE_CONTROL_POLICY')['Policies']
+    return paginate(org_client.list_policies, 'Policies',
+            Filter='SERVICE_CONTROL_POLICY')
 
-def get_deployed_ou(org_client, root_id):
+def paginate(api_call, result_key, **kwargs):
     '''
-    Recursively traverse deployed AWS Organization.  Return list of
-    organizational unit dictionaries.
+    Call a paginated AWS API until NextToken is exhausted.  Return the
+    combined list of items found under 'result_key'.
     '''
-    def build_deployed_ou_table(org_client, parent_name, parent_id, deployed_ou):
-        # recusive sub function to build the 'deployed_ou' table
-        child_ou = org_client.list_organizational_units_for_parent(
-                ParentId=parent_id)['OrganizationalUnits']
-        accounts = org_client.list_accounts_for_parent(
-                ParentId=parent_id)['Accounts']
-        if not deployed_ou:
-            deployed_ou.append(dict(
-                    Name = parent_name,
-                    Id = parent_id,
-                    Child_OU = [ou['Name'] for ou in child_ou if 'Name' in ou],
-                    Accounts = [acc['Name'] for acc in accounts if 'Name' in acc]))
-        else:
-            for ou in deployed_ou:
-                if ou['Name'] == parent_name:
-                    ou['Child_OU'] = map(lambda d: d['Name'], child_ou)
-                    ou['Accounts'] = map(lambda d: d['Name'], accounts)
-        for ou in child_ou:
-            ou['ParentId'] = parent_id
-            deployed_ou.append(ou)
-            build_deployed_ou_table(org_client, ou['Name'], ou['Id'], deployed_ou)
-    # build the table
-    deployed_ou = []
-    build_deployed_ou_table(org_client, 'root', root_id, deployed_ou)
+    response = api_call(**kwargs)
+    items = list(response[result_key])
+    while 'NextToken' in response and response['NextToken']:
+        response = api_call(NextToken=response['NextToken'], **kwargs)
+        items += response[result_key]
+    return items
+
+def get_deployed_ou(org_client, root_id, account_parents=None,
+        max_workers=CRAWL_WORKERS, deployed_accounts=None):
+    '''
+    Breadth-first traversal of deployed AWS Organization.  The children
+    and accounts of every parent on a level are fetched concurrently, so
+    the crawl takes time proportional to the depth of the tree.  Return
+    list of organizational unit dictionaries, starting with the root.
+    If dict 'account_parents' is provided, it is filled with a mapping
+    of account Id to parent Id.  If list 'deployed_accounts' is provided,
+    a record of every account found that has a 'Name' is appended to it.
+    '''
+    root = dict(Name='root', Id=root_id)
+    deployed_ou = [root]
+    level = [root]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while level:
+            child_ou_futures = [executor.submit(paginate,
+                    org_client.list_organizational_units_for_parent,
+                    'OrganizationalUnits', ParentId=ou['Id']) for ou in level]
+            accounts_futures = [executor.submit(paginate,
+                    org_client.list_accounts_for_parent,
+                    'Accounts', ParentId=ou['Id']) for ou in level]
+            next_level = []
+            for parent, child_ou_future, accounts_future in zip(
+                    level, child_ou_futures, accounts_futures):
+                child_ou = child_ou_future.result()
+                accounts = accounts_future.result()
+                parent['Child_OU'] = [ou['Name'] for ou in child_ou if 'Name' in ou]
+                parent['Accounts'] = [acc['Name'] for acc in accounts if 'Name' in acc]
+                if account_parents is not None:
+                    for acc in accounts:
+                        account_parents[acc['Id']] = parent['Id']
+                if deployed_accounts is not None:
+                    deployed_accounts += account_records(accounts)
+                for ou in child_ou:
+                    ou['ParentId'] = parent['Id']
+                    next_level.append(ou)
+            deployed_ou += next_level
+            level = next_level
     return deployed_ou
 
 def get_logger(args, file_name):
@@ -162,71 +484,31 @@ def get_logger(args, file_name):
 
     return rootLogger
 
-def validate_spec(log, validation_patterns, pattern_name, spec):
+def get_spec_validators(log, pattern_file=PATTERN_FILE):
+    """
+    Return dict of compiled validators for the patterns in 'pattern_file'.
+    Each pattern file is loaded and compiled once per process.
+    """
+    if pattern_file not in _spec_validators:
+        _spec_validators[pattern_file] = compile_patterns(
+                load_validation_patterns(log, pattern_file))
+    return _spec_validators[pattern_file]
+
+def validate_spec(log, pattern_name, spec, source=None):
     """
     Validate syntax of a given 'spec' dictionary against the
-    named spec_pattern.
+    named spec_pattern.  Log all findings with their location in the
+    spec, prefixed by 'source' if provided.  Return False if any errors
+    were found.
     """
-    pattern = validation_patterns[pattern_name]
-    valid_spec = True
-    # test for required attributes
-    required_attributes = [attr for attr in pattern if pattern[attr]['required']]
-    for attr in required_attributes:
-        if attr not in spec:
-            log.error("Required attribute '%s' not found in '%s' spec. Context: %s" %
-                    (attr, pattern_name, spec))
-            valid_spec = False
-    for attr in spec:
-        log.debug("  considering attribute '%s'" % attr)
-        # test if attribute is permitted
-        if attr not in pattern:
-            log.warn("Attribute '%s' does not exist in validation pattern '%s'" %
-                    (attr, pattern_name))
-            continue
-        # handle recursive patterns
-        if 'spec_pattern' in pattern[attr]:
-            pattern_name = pattern[attr]['spec_pattern']
-            if not isinstance(spec[attr], list):
-                log.error("Attribute '%s' must be a list of '%s' specs.  Context: %s" %
-                        (attr, pattern_name, spec))
-                valid_spec = False
-                continue
-            for sub_spec in spec[attr]:
-                log.debug("calling validate_spec() for pattern '%s'" % pattern_name)
-                log.debug("context: %s" % sub_spec)
-                if not validate_spec(log, validation_patterns, pattern_name, sub_spec):
-                    valid_spec = False
-        # test attribute type. ignore attr if value is None
-        elif spec[attr]:
-            spec_attr_type = spec[attr].__class__.__name__
-            log.debug("    spec attribute object type: '%s'" % (spec_attr_type))
-            # simple attribute pattern
-            if isinstance(pattern[attr]['atype'], str):
-                if spec_attr_type != pattern[attr]['atype']:
-                    log.error("Attribute '%s' must be of type '%s'" %
-                            (attr, pattern[attr]['atype']))
-                    valid_spec = False
-                    continue
-            else:
-                # complex attribute pattern
-                valid_types = pattern[attr]['atype'].keys()
-                log.debug("    pattern attribute types: '%s'" % valid_types)
-                if not spec_attr_type in valid_types:
-                    log.error("Attribute '%s' must be one of type '%s'" %
-                            (attr, valid_types))
-                    valid_spec = False
-                    continue
-                atype = pattern[attr]['atype'][spec_attr_type]
-                # test attributes values
-                if atype and 'values' in atype:
-                    log.debug("    allowed values for attribute '%s': %s" %
-                            (attr, atype['values']))
-                    if not spec[attr] in atype['values']:
-                        log.error("Value of attribute '%s' must be one of '%s'" %
-                                (attr, atype['values']))
-                        valid_spec = False
-                        continue
-    return valid_spec
+    errors = get_spec_validators(log)[pattern_name].validate(spec)
+    prefix = '%s: ' % source if source else ''
+    for error in errors:
+        if error.level == 'warning':
+            log.warn("%s%s: %s" % (prefix, error.path, error.message))
+        else:
+            log.error("%s%s: %s" % (prefix, error.path, error.message))
+    return not [e for e in errors if e.level == 'error']
 
 def lookup(dlist, lkey, lvalue, rkey=None):
     """
@@ -256,45 +538,16 @@ def lookup(dlist, lkey, lvalue, rkey=None):
     return items[0]
 
 
-def validate_master_id(org_client, spec):
+def validate_master_id(master_account_id, spec):
     """
     Don't mangle the wrong org by accident
     """
-    master_account_id = org_client.describe_organization(
-      )['Organization']['MasterAccountId']
     if master_account_id != spec['master_account_id']:
         errmsg = ("The Organization Master Account Id '%s' does not match the "
                 "'master_account_id' set in the spec-file" % master_account_id)
         raise RuntimeError(errmsg)
     return
 
-def list_policies_in_ou (org_client, ou_id):
-    """
-    Query deployed AWS organanization.  Return a list (of type dict)
-    of policies attached to OrganizationalUnit referenced by 'ou_id'.
-    """
-    policies_in_ou = org_client.list_policies_for_target(
-            TargetId=ou_id, Filter='SERVICE_CONTROL_POLICY',)['Policies']
-    return sorted(map(lambda ou: ou['Name'], policies_in_ou))
-
-
-def search_spec(spec, search_key, recurse_key):
-    """
-    Recursively scans spec structure and returns a list of values
-    keyed with 'search_key' or and empty list.  Assumes values
-    are either list or str.
-    """
-    value = []
-    if search_key in spec and spec[search_key]:
-        if isinstance(spec[search_key], str):
-            value.append(spec[search_key])
-        else:
-            value += spec[search_key]
-    if recurse_key in spec and spec[recurse_key]:
-        for child_spec in spec[recurse_key]:
-            value += search_spec(child_spec, search_key, recurse_key)
-    return sorted(value)
-
 def ensure_absent(spec):
     """
     test if an 'Ensure' key is set to absent in dictionary 'spec'
@@ -1,21 +1,114 @@
 #!/usr/bin/env python
 
-import boto3
-from utils import get_template
+"""Validate CloudFormation templates.
 
-def validate_cloudformtion_template(cf_template_json):
-    #create the client
-    cf_client = boto3.client('cloudformation')
-    #Validate the template. This will raise an exception if the template is invalid.
-    cf_client.validate_template(TemplateBody=cf_template_json)
+Usage:
+  validation-template.py [--template-dir DIR] [--config FILE] [--local] [--no-cache] [--workers N] [-vd] [--boto-log] [<template>...]
+  validation-template.py (-h | --help)
 
+Validates every template in the template directory and every template
+the config file references, or only the <template> files given.  Each
+template is checked locally first: it must parse, fit the size limits
+and name well formed resource types.  Templates passing the local
+checks are sent to CloudFormation validate_template.  Its results are
+cached by template content, so unchanged templates are not sent again.
+
+Options:
+  -h, --help                 Show this help message and exit.
+  --template-dir DIR         Directory of templates.  Defaults to
+                             cloudformation/ of this repository.
+  --config FILE              Account config in create-account.json format.
+                             Defaults to config/create-account.json of
+                             this repository.
+  --local                    Run the local checks only.
+  --no-cache                 Do not use cached validation results.
+  --workers N                Max number of templates validated at once.
+                             [default: 8]
+  -v, --verbose              Log to activity to STDOUT at log level INFO.
+  -d, --debug                Increase log level to 'DEBUG'. Implies '--verbose'.
+  --boto-log                 Include botocore and boto3 logs in log stream.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from docopt import docopt
+from orgclient import ThrottledClient, boto_client
+from stacks import BASELINE_CONFIG_FILE, TEMPLATE_DIR, load_baseline_config
+from templates import (TEMPLATE_SUFFIXES, ValidationCache, check_template,
+        validate_template)
+from utils import *
+
+
+def find_templates(log, template_dir, config_file):
+    """
+    Return dict of template file to the names of the config entries
+    referencing it.  Every template in 'template_dir' is included.
+    """
+    templates = {}
+    for name in sorted(os.listdir(template_dir)):
+        if name.endswith(TEMPLATE_SUFFIXES):
+            templates[os.path.join(template_dir, name)] = []
+    if os.path.isfile(config_file):
+        entries = load_baseline_config(log, config_file)
+        for name in sorted(entries):
+            template = entries[name].get('cloudformationTemplate')
+            if template:
+                templates.setdefault(os.path.join(template_dir, template),
+                        []).append(name)
+    return templates
+
+def check_template_file(log, args, cf_client, cache, template_file):
+    """
+    Return list of errors found in 'template_file'.
+    """
+    if not os.path.isfile(template_file):
+        return ["Template not found"]
+    with open(template_file) as f:
+        template_body = f.read()
+    errors = check_template(template_body)
+    if errors or args['--local']:
+        return errors
+    valid, detail = validate_template(log, cf_client, template_body, cache)
+    return [] if valid else [detail]
+
+def display_validation_summary(templates, results):
+    """
+    Print one table with the validation result of every template.
+    """
+    header = "Template validation summary:"
+    sys.stdout.write("\n%s\n%s\n" % ('_' * len(header), header))
+    for template_file, errors in results:
+        name = os.path.basename(template_file)
+        if templates[template_file]:
+            name += " (%s)" % ', '.join(templates[template_file])
+        sys.stdout.write("%-40s%s\n" % (name, 'FAILED' if errors else 'VALID'))
+        for error in errors:
+            sys.stdout.write("    %s\n" % error)
 
 def main():
-    template = get_template('../cloudformation/logging.template')
-    validate_cloudformtion_template(template)
+    args = docopt(__doc__)
+    args['report'] = False
+    log = get_logger(args, os.path.basename(__file__).split('.')[0])
 
+    if args['<template>']:
+        templates = dict((t, []) for t in args['<template>'])
+    else:
+        templates = find_templates(log,
+                args['--template-dir'] or TEMPLATE_DIR,
+                args['--config'] or BASELINE_CONFIG_FILE)
+    cf_client = None
+    if not args['--local']:
+        cf_client = ThrottledClient(boto_client('cloudformation',
+                int(args['--workers'])), log=log)
+    cache = None if args['--no-cache'] else ValidationCache(log)
+    names = sorted(templates)
+    with ThreadPoolExecutor(max_workers=int(args['--workers'])) as executor:
+        results = list(executor.map(lambda t: check_template_file(log, args,
+                cf_client, cache, t), names))
+    display_validation_summary(templates, zip(names, results))
+    if any(results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
     main()
-
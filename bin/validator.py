@@ -0,0 +1,146 @@
+"""Compiled validators for spec-file syntax patterns """
+from collections import namedtuple
+
+# Validation finding.  'level' is 'error' or 'warning', 'path' the
+# location of the offending attribute in the spec, e.g.
+# 'organizational_units[0].Child_OU[2].Name'
+SpecError = namedtuple('SpecError', ['level', 'path', 'message'])
+
+TYPES = dict(
+    str = str,
+    list = list,
+    dict = dict,
+    bool = bool,
+    int = int,
+)
+
+
+def _join(path, attr):
+    if path:
+        return '%s.%s' % (path, attr)
+    return attr
+
+
+def _resolve_type(pattern_name, attr, type_name):
+    if type_name not in TYPES:
+        raise RuntimeError("Validation pattern '%s' attribute '%s': unknown "
+                "type '%s'" % (pattern_name, attr, type_name))
+    return TYPES[type_name]
+
+
+class AttributeRule(object):
+    """
+    Compiled rule for one attribute of a validation pattern.
+    """
+    __slots__ = ('name', 'required', 'types', 'type_names', 'values',
+            'sub_pattern', 'sub_validator')
+
+    def __init__(self, pattern_name, name, rule):
+        self.name = name
+        self.required = bool(rule.get('required'))
+        self.sub_pattern = rule.get('spec_pattern')
+        self.sub_validator = None
+        atype = rule.get('atype')
+        self.values = {}
+        if isinstance(atype, str):
+            self.type_names = [atype]
+        else:
+            self.type_names = list(atype or [])
+            for type_name, constraint in (atype or {}).items():
+                if constraint and 'values' in constraint:
+                    self.values[_resolve_type(pattern_name, name, type_name)] = (
+                            frozenset(constraint['values']), constraint['values'])
+        self.types = frozenset(_resolve_type(pattern_name, name, t)
+                for t in self.type_names)
+
+
+class PatternValidator(object):
+    """
+    Compiled validation pattern.  validate() appends SpecError tuples
+    for a spec dictionary to a list instead of logging them.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.rules = {}
+        self.required = []
+
+    def compile(self, pattern, validators):
+        for attr, rule in pattern.items():
+            compiled = AttributeRule(self.name, attr, rule)
+            if compiled.sub_pattern:
+                if compiled.sub_pattern not in validators:
+                    raise RuntimeError("Validation pattern '%s' references "
+                            "unknown pattern '%s'" % (self.name,
+                            compiled.sub_pattern))
+                compiled.sub_validator = validators[compiled.sub_pattern]
+            self.rules[attr] = compiled
+            if compiled.required:
+                self.required.append(attr)
+
+    def validate(self, spec, path='', errors=None):
+        """
+        Validate 'spec' located at 'path'.  Return list of SpecError.
+        """
+        if errors is None:
+            errors = []
+        if not isinstance(spec, dict):
+            errors.append(SpecError('error', path, "'%s' spec must be a "
+                    "mapping" % self.name))
+            return errors
+        # test for required attributes
+        for attr in self.required:
+            if attr not in spec:
+                errors.append(SpecError('error', _join(path, attr),
+                        "Required attribute '%s' not found in '%s' spec"
+                        % (attr, self.name)))
+        for attr, value in spec.items():
+            rule = self.rules.get(attr)
+            attr_path = _join(path, attr)
+            # test if attribute is permitted
+            if rule is None:
+                errors.append(SpecError('warning', attr_path,
+                        "Attribute '%s' does not exist in validation "
+                        "pattern '%s'" % (attr, self.name)))
+                continue
+            # handle recursive patterns
+            if rule.sub_validator:
+                if not isinstance(value, list):
+                    errors.append(SpecError('error', attr_path,
+                            "Attribute '%s' must be a list of '%s' specs"
+                            % (attr, rule.sub_pattern)))
+                    continue
+                for i, sub_spec in enumerate(value):
+                    rule.sub_validator.validate(sub_spec,
+                            '%s[%d]' % (attr_path, i), errors)
+            # test attribute type. ignore attr if value is None
+            elif value:
+                value_type = type(value)
+                if value_type not in rule.types:
+                    if len(rule.type_names) == 1:
+                        message = "Attribute '%s' must be of type '%s'" % (
+                                attr, rule.type_names[0])
+                    else:
+                        message = "Attribute '%s' must be one of type '%s'" % (
+                                attr, rule.type_names)
+                    errors.append(SpecError('error', attr_path, message))
+                    continue
+                # test attributes values
+                if value_type in rule.values:
+                    allowed, listed = rule.values[value_type]
+                    if value not in allowed:
+                        errors.append(SpecError('error', attr_path,
+                                "Value of attribute '%s' must be one of '%s'"
+                                % (attr, listed)))
+        return errors
+
+
+def compile_patterns(validation_patterns):
+    """
+    Compile dict of validation patterns.  Return dict of
+    PatternValidator keyed by pattern name.
+    """
+    validators = dict((name, PatternValidator(name))
+            for name in validation_patterns)
+    for name, pattern in validation_patterns.items():
+        validators[name].compile(pattern, validators)
+    return validators
@@ -0,0 +1,83 @@
+"""Tests of account-manager account creation against the fake client """
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'bin'))
+
+import fakeorg
+from inventory import get_org_snapshot
+from journal import Journal
+from utils import load_script
+
+LOG = logging.getLogger('test_create')
+
+
+class FakeClock(object):
+    """
+    Stand-in for the time module of account-manager.  sleep() only
+    advances the clock.
+    """
+    def __init__(self):
+        self.now = time.time()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class CreateAccountsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='test-create-')
+        self.script = load_script('account-manager.py')
+        self.script.time = FakeClock()
+        self.org = fakeorg.synthetic_org(10, 2)
+        self.account_spec = dict(master_account_id=fakeorg.MASTER_ACCOUNT_ID,
+                default_domain='example.com',
+                accounts=[dict(Name='new_account_%03d' % i)
+                    for i in range(40)])
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def create(self):
+        journal = Journal(LOG, os.path.join(self.work_dir, 'journal.jsonl'))
+        journal.begin('create', 'digest')
+        try:
+            results = self.script.create_accounts(self.org,
+                    {'--max-in-flight': '5', '--exec': True}, LOG,
+                    get_org_snapshot(LOG, self.org), self.account_spec,
+                    journal)
+        finally:
+            journal.close()
+        return dict((r['Name'], r['State']) for r in results)
+
+    def test_long_batch_is_not_cut_short(self):
+        # the whole batch takes longer than POLL_TIMEOUT, each request not
+        self.script.POLL_TIMEOUT = 60
+        states = self.create()
+        self.assertEqual(set(states.values()), set(['SUCCEEDED']))
+        self.assertEqual(len(states), 40)
+
+    def test_stalled_creations(self):
+        self.org.create_account_polls = 10 ** 6
+        states = self.create()
+        self.assertEqual(sorted(set(states.values())),
+                ['NOT_SUBMITTED', 'PENDING'])
+        self.assertEqual(list(states.values()).count('PENDING'), 5)
+        self.assertEqual(self.org.counts()['create_account'], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
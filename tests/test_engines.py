@@ -0,0 +1,132 @@
+"""Parity of the threaded and async engines against the fake client """
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'bin'))
+
+import benchmark
+import fakeorg
+from inventory import (get_attachment_index, get_org_snapshot,
+        get_policy_store)
+from orgclient import ThrottledClient
+from plan import Plan
+from specindex import SpecIndex
+from utils import load_script
+
+LOG = logging.getLogger('test_engines')
+# token buckets that never make the tests wait
+RATES = dict(read_rate=1e6, read_burst=1000, write_rate=1e6, write_burst=1000)
+
+
+class BlockingClient(object):
+    """
+    Fake client without without_latency(), like a boto3 client, so the
+    async engine runs its calls on its thread pool.
+    """
+    def __init__(self, org):
+        self.org = org
+
+    def __getattr__(self, name):
+        if name == 'without_latency':
+            raise AttributeError(name)
+        return getattr(self.org, name)
+
+
+def org_state(org):
+    """
+    Return the state of fake organization 'org' by name: the parent of
+    every OU and account, and the description, content and targets of
+    every policy.
+    """
+    names = dict((ou_id, ou['Name']) for ou_id, ou in org.ou.items())
+    names[org.root['Id']] = 'root'
+    names.update((a_id, a['Name']) for a_id, a in org.accounts.items())
+    parents = dict((names[child], names[parent])
+            for child, parent in org.parent.items())
+    policies = dict((p['Name'], (p['Description'], p['Content'],
+            sorted(names[t] for t in org.targets.get(p_id, ()))))
+            for p_id, p in org.policies.items())
+    return parents, policies
+
+
+@unittest.skipIf(sys.version_info[0] < 3, "the async engine needs Python 3")
+class EngineParityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.script = load_script('organization-manager.py')
+
+    def plan(self, org, inventory):
+        """
+        Plan the reconciliation of the drifted spec of 'org' like
+        organization-manager main().
+        """
+        snapshot, policy_store, attachment_index = inventory
+        org_spec = self.org_spec
+        plan = Plan(snapshot)
+        self.script.manage_policies(policy_store, plan, LOG, snapshot,
+                org_spec)
+        self.script.manage_ou(attachment_index, plan, LOG, snapshot, org_spec,
+                org_spec['organizational_units'], 'root')
+        self.script.manage_unmanaged(plan, LOG, snapshot, org_spec,
+                SpecIndex(org_spec))
+        self.script.manage_deletions(org, attachment_index, plan, LOG,
+                snapshot)
+        return plan
+
+    def run_threads(self, org):
+        client = ThrottledClient(org, log=LOG, **RATES)
+        snapshot = get_org_snapshot(LOG, client)
+        plan = self.plan(client, (snapshot,
+                get_policy_store(client, snapshot),
+                get_attachment_index(client, snapshot)))
+        descriptions = sorted(op.describe() for op in plan.ops)
+        return descriptions, plan.apply(client, LOG)
+
+    def run_async(self, org):
+        from asyncengine import AsyncEngine
+        client = ThrottledClient(BlockingClient(org), log=LOG, **RATES)
+        engine = AsyncEngine(client, LOG, concurrency=8, threads=4)
+        try:
+            plan = self.plan(client, engine.inventory())
+            descriptions = sorted(op.describe() for op in plan.ops)
+            return descriptions, engine.apply(plan)
+        finally:
+            engine.close()
+
+    def test_same_plan_and_state(self):
+        threaded_org = fakeorg.synthetic_org(200, 3)
+        async_org = fakeorg.synthetic_org(200, 3)
+        self.assertEqual(org_state(threaded_org), org_state(async_org))
+        self.org_spec = benchmark.fake_org_specs(threaded_org)[0]
+
+        threaded_plan, threaded_failed = self.run_threads(threaded_org)
+        async_plan, async_failed = self.run_async(async_org)
+        self.assertTrue(threaded_plan)
+        self.assertEqual(threaded_plan, async_plan)
+        self.assertFalse(threaded_failed)
+        self.assertFalse(async_failed)
+        self.assertEqual(org_state(threaded_org), org_state(async_org))
+        self.assertNotEqual(org_state(threaded_org),
+                org_state(fakeorg.synthetic_org(200, 3)))
+
+    def test_thread_pool_size(self):
+        from asyncengine import AsyncEngine
+        client = ThrottledClient(BlockingClient(fakeorg.synthetic_org(10, 2)),
+                log=LOG, **RATES)
+        engine = AsyncEngine(client, LOG, concurrency=8, threads=2)
+        try:
+            self.assertEqual(engine.aclient._executor._max_workers, 2)
+        finally:
+            engine.close()
+        engine = AsyncEngine(client, LOG, concurrency=8)
+        try:
+            self.assertEqual(engine.aclient._executor._max_workers, 8)
+        finally:
+            engine.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Tests of the deployed organization inventory """
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'bin'))
+
+import benchmark
+import fakeorg
+from inventory import get_attachment_index, get_org_snapshot
+from report import ou_rows
+
+LOG = logging.getLogger('test_inventory')
+
+
+class DuplicateNamesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.org = fakeorg.synthetic_org(20, 3)
+        account = sorted(self.org.accounts.values(),
+                key=lambda a: a['Name'])[2]
+        self.account_name = account['Name']
+        self.org.add_account(self.account_name)
+        ou = sorted(self.org.ou.values(), key=lambda o: o['Name'])[1]
+        self.ou_name = ou['Name']
+        self.org.add_ou(self.ou_name, ou['Id'])
+
+    def test_lookup_of_duplicate_name_fails(self):
+        snapshot = get_org_snapshot(LOG, self.org)
+        self.assertIn(self.account_name, snapshot.accounts)
+        self.assertRaises(RuntimeError, snapshot.accounts.by_name,
+                self.account_name)
+        self.assertRaises(RuntimeError, snapshot.ou.by_name, self.ou_name)
+        self.assertTrue(snapshot.ou.by_name('root'))
+
+    def test_reports(self):
+        snapshot = get_org_snapshot(LOG, self.org)
+        rows = list(ou_rows(get_attachment_index(self.org, snapshot),
+                snapshot))
+        self.assertEqual(sorted(row['Id'] for row in rows),
+                sorted([self.org.root['Id']] + list(self.org.ou)))
+        for script in ('account-manager.py', 'organization-manager.py'):
+            self.assertEqual(benchmark.run_script(script, ['report'],
+                    self.org), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Tests of the run records of organization-manager --exec runs """
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'bin'))
+
+import benchmark
+import fakeorg
+from incremental import last_applied_file
+from journal import journal_file
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='test-resume-')
+        self.org = fakeorg.synthetic_org(50, 2)
+        self.spec_file = benchmark.write_specs(self.work_dir,
+                self.org)['org_spec']
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def organization(self, *argv):
+        return benchmark.run_script('organization-manager.py',
+                ['organization', '--spec-file', self.spec_file, '--exec']
+                + list(argv), self.org)
+
+    def interrupt(self, **begin_fields):
+        """
+        Make the journal of the last run look interrupted before its
+        end, with 'begin_fields' changed in its begin entry.
+        """
+        file_name = journal_file([self.spec_file])
+        with open(file_name) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(entries[-1]['event'], 'end')
+        entries[0].update(begin_fields)
+        with open(file_name, 'w') as f:
+            for entry in entries[:-1]:
+                f.write(json.dumps(entry) + '\n')
+
+    def test_resume(self):
+        self.assertEqual(self.organization('--full'), 0)
+        self.interrupt()
+        before = self.org.counts()
+        self.assertEqual(self.organization(), 0)
+        calls = self.org.counts()
+        # resumed from the journal, without a new inventory
+        self.assertEqual(calls.get('list_accounts_for_parent'),
+                before.get('list_accounts_for_parent'))
+
+    def test_resume_in_other_organization_refused(self):
+        self.assertEqual(self.organization('--full'), 0)
+        self.interrupt(master_account_id='999999999999')
+        before = self.org.counts()
+        self.assertEqual(self.organization(), 1)
+        self.assertEqual(dict((op, n - before.get(op, 0))
+                for op, n in self.org.counts().items()
+                if n != before.get(op, 0)), {'describe_organization': 1})
+
+    def test_full_runs_count_generations(self):
+        for generation in (1, 2):
+            self.assertEqual(self.organization('--full'), 0)
+            with open(last_applied_file([self.spec_file])) as f:
+                self.assertEqual(json.load(f)['generation'], generation)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""Tests of the cache of parsed spec files """
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'bin'))
+
+import utils
+
+LOG = logging.getLogger('test_spec_cache')
+
+
+class SpecCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='test-spec-cache-')
+        self.saved_cache_dir = utils.SPEC_CACHE_DIR
+        utils.SPEC_CACHE_DIR = os.path.join(self.work_dir, 'cache')
+
+    def tearDown(self):
+        utils.SPEC_CACHE_DIR = self.saved_cache_dir
+        shutil.rmtree(self.work_dir)
+
+    def write_spec(self, text):
+        file_name = os.path.join(self.work_dir, 'spec.yaml')
+        with open(file_name, 'w') as f:
+            f.write(text)
+        return file_name
+
+    def cache_files(self):
+        return [os.path.join(utils.SPEC_CACHE_DIR, name)
+                for name in os.listdir(utils.SPEC_CACHE_DIR)]
+
+    def test_cached_as_private_json(self):
+        file_name = self.write_spec('master_account_id: 123456789012\n'
+                'accounts: [{Name: a}]\n')
+        data = utils.load_yaml_file(LOG, file_name)
+        [cache_file] = self.cache_files()
+        with open(cache_file) as f:
+            self.assertEqual(json.load(f), data)
+        self.assertEqual(os.stat(utils.SPEC_CACHE_DIR).st_mode & 0o777, 0o700)
+        self.assertEqual(os.stat(cache_file).st_mode & 0o777, 0o600)
+        self.assertEqual(utils.load_yaml_file(LOG, file_name), data)
+
+    def test_writable_cache_file_ignored(self):
+        file_name = self.write_spec('accounts: [{Name: a}]\n')
+        utils.load_yaml_file(LOG, file_name)
+        [cache_file] = self.cache_files()
+        with open(cache_file, 'w') as f:
+            json.dump({'accounts': [{'Name': 'planted'}]}, f)
+        os.chmod(cache_file, 0o666)
+        self.assertEqual(utils.load_yaml_file(LOG, file_name),
+                {'accounts': [{'Name': 'a'}]})
+
+    def test_data_json_can_not_hold_is_not_cached(self):
+        file_name = self.write_spec('created: 2020-01-01\n1: one\n')
+        data = utils.load_yaml_file(LOG, file_name)
+        self.assertEqual(data[1], 'one')
+        self.assertFalse(os.path.isdir(utils.SPEC_CACHE_DIR)
+                and self.cache_files())
+
+
+if __name__ == '__main__':
+    unittest.main()
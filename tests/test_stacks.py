@@ -0,0 +1,132 @@
+"""Tests of the baseline stack deployer against moto """
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'bin'))
+
+import stacks
+import utils
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+LOG = logging.getLogger('test_stacks')
+ACCOUNT_ID = '123456789012'
+REGION = 'us-east-1'
+TOPIC = {'Type': 'AWS::SNS::Topic', 'Properties': {'TopicName': 'baseline'}}
+QUEUE = {'Type': 'AWS::SQS::Queue', 'Properties': {'QueueName': 'baseline'}}
+FAKE_ENVIRONMENT = dict(AWS_ACCESS_KEY_ID='testing',
+        AWS_SECRET_ACCESS_KEY='testing', AWS_SESSION_TOKEN='testing',
+        AWS_DEFAULT_REGION=REGION)
+
+
+@unittest.skipIf(mock_aws is None, "moto is not installed")
+class DeployStacksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='test-stacks-')
+        self.saved_environment = dict((k, os.environ.get(k))
+                for k in list(FAKE_ENVIRONMENT) + ['AWS_ENDPOINT_URL'])
+        os.environ.update(FAKE_ENVIRONMENT)
+        os.environ.pop('AWS_ENDPOINT_URL', None)
+        self.saved_cache_dir = utils.CREDENTIAL_CACHE_DIR
+        utils.CREDENTIAL_CACHE_DIR = os.path.join(self.work_dir, 'credentials')
+        self.reset_clients()
+        self.mock = mock_aws()
+        self.mock.start()
+        self.config_file = os.path.join(self.work_dir, 'create-account.json')
+        with open(self.config_file, 'w') as f:
+            json.dump([{'logging': {'accountName': 'logging',
+                    'accountId': ACCOUNT_ID,
+                    'cloudformationTemplate': 'logging.template'}}], f)
+
+    def tearDown(self):
+        self.mock.stop()
+        self.reset_clients()
+        utils.CREDENTIAL_CACHE_DIR = self.saved_cache_dir
+        for key, value in self.saved_environment.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(self.work_dir)
+
+    def reset_clients(self):
+        # clients and credentials of other tests must not leak into moto
+        utils._session = None
+        utils._clients.clear()
+        utils._credentials.clear()
+
+    def write_template(self, resources):
+        with open(os.path.join(self.work_dir, 'logging.template'), 'w') as f:
+            json.dump({'AWSTemplateFormatVersion': '2010-09-09',
+                    'Resources': resources}, f)
+
+    def deploy(self):
+        """
+        Run one deploy like 'baseline-manager.py deploy --exec'.  Return
+        the deployments.
+        """
+        record_file = stacks.deployed_record_file(self.config_file)
+        deployed = stacks.load_deployed(LOG, record_file)
+        deployments = stacks.get_deployments(LOG,
+                stacks.load_baseline_config(LOG, self.config_file), [REGION],
+                {}, 'baseline-', self.work_dir)
+        stacks.skip_unchanged(LOG, deployments, deployed)
+        stacks.deploy_stacks(LOG, deployments, stacks.RoleClients(LOG), 2, 0,
+                60)
+        stacks.save_deployed(LOG, record_file, deployed, deployments)
+        return deployments
+
+    def resources(self):
+        client = utils.get_client('cloudformation', REGION)
+        return sorted(r['ResourceType'] for r in client.describe_stack_resources(
+                StackName='baseline-logging')['StackResources'])
+
+    def test_create_skip_update(self):
+        self.write_template({'Topic': TOPIC})
+        created = self.deploy()
+        self.assertEqual([(d.state, d.action) for d in created],
+                [('SUCCEEDED', 'create')])
+        self.assertEqual(self.resources(), ['AWS::SNS::Topic'])
+
+        unchanged = self.deploy()
+        self.assertEqual([(d.state, d.detail) for d in unchanged],
+                [('SKIPPED', 'unchanged')])
+
+        self.write_template({'Topic': TOPIC, 'Queue': QUEUE})
+        updated = self.deploy()
+        self.assertEqual([(d.state, d.action) for d in updated],
+                [('SUCCEEDED', 'update')])
+        self.assertEqual(updated[0].stack_id, created[0].stack_id)
+        self.assertEqual(self.resources(), ['AWS::SNS::Topic',
+                'AWS::SQS::Queue'])
+
+    def test_endpoint_url(self):
+        os.environ['AWS_ENDPOINT_URL'] = 'http://localhost:5000'
+        client = utils.get_client('cloudformation', REGION)
+        self.assertEqual(client.meta.endpoint_url, 'http://localhost:5000')
+
+    def test_throttled_clients_do_not_retry(self):
+        # ThrottledClient retries; botocore must not retry under it
+        wrapped = stacks.RoleClients(LOG)(ACCOUNT_ID, REGION, 'role').client
+        self.assertEqual(wrapped.meta.config.retries['total_max_attempts'], 1)
+        client = utils.get_client('cloudformation', REGION)
+        self.assertEqual(client.meta.config.retries['total_max_attempts'],
+                utils.CLIENT_RETRY_ATTEMPTS + 1)
+
+    def test_missing_template_fails(self):
+        deployments = self.deploy()
+        self.assertEqual([d.state for d in deployments], ['FAILED'])
+
+
+if __name__ == '__main__':
+    unittest.main()
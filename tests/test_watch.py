@@ -0,0 +1,146 @@
+"""Tests of organization-manager watch scans against the fake client """
+import io
+import json
+import logging
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'bin'))
+
+import benchmark
+import fakeorg
+from specindex import SpecIndex
+from utils import load_script
+
+LOG = logging.getLogger('test_watch')
+
+
+class ScanClock(object):
+    """
+    Stand-in for the time module of organization-manager.  Between two
+    watch scans it records the API calls the scan made, then makes the
+    hand change queued for that scan, if any.
+    """
+    def __init__(self, org, changes):
+        self.org = org
+        self.changes = changes
+        self.calls = []
+        self._mark = {}
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, seconds):
+        self.record()
+        change = self.changes.get(len(self.calls))
+        if change:
+            change(self.org)
+        self._mark = self.org.counts()
+
+    def record(self):
+        counts = self.org.counts()
+        self.calls.append(dict((op, n - self._mark.get(op, 0))
+                for op, n in counts.items() if n != self._mark.get(op, 0)))
+
+
+class WatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.org = fakeorg.synthetic_org(100, 3)
+        # every listing fits one page
+        self.org.page_size = 1000
+        self.org_spec = benchmark.fake_org_specs(self.org)[0]
+        self.script = load_script('organization-manager.py')
+
+    def watch(self, count, deep_every=0, changes=None):
+        """
+        Run 'count' watch scans.  Return (events, API calls per scan).
+        """
+        clock = ScanClock(self.org, changes or {})
+        saved = self.script.time
+        self.script.time = clock
+        out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        try:
+            self.script.watch(LOG, {'--interval': '0', '--count': str(count),
+                    '--deep-every': str(deep_every)}, self.org, self.org_spec,
+                    SpecIndex(self.org_spec), out)
+        finally:
+            self.script.time = saved
+        clock.record()
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        return events, clock.calls
+
+    def drift(self, events, scan):
+        return sorted(e['type'] for e in events
+                if e['event'] == 'drift' and e['scan'] == scan)
+
+    def managed_policies(self):
+        return sorted(p_id for p_id, p in self.org.policies.items()
+                if p['Name'] != fakeorg.DEFAULT_POLICY)
+
+    def test_unchanged_scan_reads_managed_policies_only(self):
+        events, calls = self.watch(3)
+        parents = len(self.org.ou) + 1
+        managed = len(self.managed_policies())
+        reads = dict(list_organizational_units_for_parent=parents,
+                list_accounts_for_parent=parents, list_policies=1,
+                list_targets_for_policy=managed, describe_policy=managed)
+        self.assertEqual(calls[1], reads)
+        self.assertEqual(calls[2], reads)
+        scans = [e for e in events if e['event'] == 'scan']
+        self.assertEqual([s['changed'] for s in scans[1:]], [0, 0])
+        self.assertEqual([s['scanned'] for s in scans[1:]], [managed, managed])
+
+    def test_changed_policy_and_move_are_scanned(self):
+        account_id = sorted(a for a in self.org.accounts
+                if a != fakeorg.MASTER_ACCOUNT_ID)[3]
+        dest_id = sorted(ou for ou in self.org.ou
+                if ou != self.org.parent[account_id])[0]
+        def move(org):
+            org.move_account(AccountId=account_id,
+                    SourceParentId=org.parent[account_id],
+                    DestinationParentId=dest_id)
+        def add_policy(org):
+            org.add_policy('by_hand', 'made by hand',
+                    fakeorg.policy_content(['iam:*']), [dest_id])
+        managed = len(self.managed_policies())
+        events, calls = self.watch(3, changes={1: move, 2: add_policy})
+        self.assertEqual(self.drift(events, 2), ['account_misplaced'])
+        self.assertEqual(self.drift(events, 3), ['policy_attached',
+                'policy_unmanaged'])
+        self.assertEqual(calls[1].get('list_targets_for_policy'), managed)
+        # the new policy is scanned too.  It is not managed, so its
+        # content is not read.
+        self.assertEqual(calls[2].get('list_targets_for_policy'), managed + 1)
+        self.assertEqual(calls[2].get('describe_policy'), managed)
+
+    def test_managed_policy_edit_and_attachment_seen_next_scan(self):
+        policy_id = self.managed_policies()[0]
+        target_id = sorted(ou for ou in self.org.ou
+                if ou not in self.org.targets.get(policy_id, ()))[0]
+        def edit(org):
+            org.policies[policy_id]['Content'] = fakeorg.policy_content(
+                    ['iam:*'])
+        def attach(org):
+            org.attach_policy(PolicyId=policy_id, TargetId=target_id)
+        events, calls = self.watch(3, changes={1: edit, 2: attach})
+        scans = [e for e in events if e['event'] == 'scan']
+        self.assertEqual([s['deep'] for s in scans], [True, False, False])
+        # the edit drifts like the changed description the policy has
+        self.assertEqual(scans[1]['changed'], 1)
+        self.assertEqual(self.drift(events, 3), ['policy_attached'])
+
+    def test_deep_scan_reads_every_attachment(self):
+        events, calls = self.watch(3, deep_every=2)
+        scans = [e for e in events if e['event'] == 'scan']
+        self.assertEqual([s['deep'] for s in scans], [True, False, True])
+        self.assertEqual(calls[1].get('list_targets_for_policy'),
+                len(self.managed_policies()))
+        self.assertEqual(calls[2].get('list_targets_for_policy'),
+                len(self.org.policies))
+
+if __name__ == '__main__':
+    unittest.main()